@@ -11,6 +11,7 @@ logging.getLogger("transformers").setLevel(logging.WARNING)
 import click
 import torch
 
+from luke.model import ATTENTION_BACKENDS
 from luke.utils.model_utils import ModelArchive
 
 from .utils.experiment_logger import commet_logger_args, CometLogger, NullLogger
@@ -38,6 +39,7 @@ logger = logging.getLogger(__name__)
 @click.option("--master-port", default=29500)
 @click.option("--local-rank", "--local_rank", default=-1)
 @click.option("--model-file", type=click.Path(exists=True))
+@click.option("--attention-backend", type=click.Choice(ATTENTION_BACKENDS), default="eager")
 @commet_logger_args
 @click.pass_context
 def cli(ctx, **kwargs):
@@ -49,6 +51,10 @@ def cli(ctx, **kwargs):
         current_env["MASTER_PORT"] = str(args.master_port)
         current_env["WORLD_SIZE"] = str(args.num_gpus)
 
+        if args.model_file:
+            # extract the model archive before launching the workers so that they share the extracted files
+            ModelArchive.load(args.model_file)
+
         processes = []
 
         for args.local_rank in range(0, args.num_gpus):
@@ -103,6 +109,7 @@ def cli(ctx, **kwargs):
             ctx.obj["entity_vocab"] = model_archive.entity_vocab
             ctx.obj["bert_model_name"] = model_archive.bert_model_name
             ctx.obj["model_config"] = model_archive.config
+            ctx.obj["model_config"].attention_backend = args.attention_backend
             ctx.obj["max_mention_length"] = model_archive.max_mention_length
             ctx.obj["model_weights"] = model_archive.state_dict
 
@@ -46,6 +46,8 @@ def cli():
 @click.option("--masked-entity-prob", default=0.9)
 @click.option("--use-context-entities/--no-context-entities", default=True)
 @click.option("--context-entity-order", default="highest_prob", type=click.Choice(["natural", "highest_prob"]))
+@click.option("--context-entity-threshold", type=float, default=None)
+@click.option("--eval-batch-size", default=16)
 @click.option("--document-split-mode", default="per_mention", type=click.Choice(["simple", "per_mention"]))
 @click.option("--fix-entity-emb/--update-entity-emb", default=True)
 @click.option("--fix-entity-bias/--update-entity-bias", default=True)
@@ -170,7 +172,7 @@ def run(common_args, **task_args):
                 args.max_mention_length,
             )
             eval_dataloader = DataLoader(
-                eval_data, batch_size=1, collate_fn=functools.partial(collate_fn, is_eval=True)
+                eval_data, batch_size=args.eval_batch_size, collate_fn=functools.partial(collate_fn, is_eval=True)
             )
             predictions_file = os.path.join(args.output_dir, "predictions_%s.jsonl" % dataset_name)
             ret = evaluate(args, eval_dataloader, model, entity_vocab, predictions_file).items()
@@ -246,54 +248,44 @@ def evaluate(args, eval_dataloader, model, entity_vocab, output_file=None):
     documents = []
     mentions = []
     reverse_entity_vocab = {v: k for k, v in entity_vocab.items()}
-    for item in tqdm(eval_dataloader, leave=False):  # the batch size must be 1
+    for item in tqdm(eval_dataloader, leave=False):
         inputs = {
             k: v.to(args.device) for k, v in item.items() if k not in ("document", "mentions", "target_mention_indices")
         }
         entity_ids = inputs.pop("entity_ids")
         entity_attention_mask = inputs.pop("entity_attention_mask")
         input_entity_ids = entity_ids.new_full(entity_ids.size(), 1)  # [MASK]
-        entity_length = entity_ids.size(1)
         with torch.no_grad():
             if args.use_context_entities:
-                result = torch.zeros(entity_length, dtype=torch.long)
-                prediction_order = torch.zeros(entity_length, dtype=torch.long)
-                for n in range(entity_length):
-                    ret = model(entity_ids=input_entity_ids, entity_attention_mask=entity_attention_mask, **inputs)
-                    logits = ret[0]
-                    probs = F.softmax(logits, dim=2) * (input_entity_ids == 1).unsqueeze(-1).type_as(logits)
-                    max_probs, max_indices = torch.max(probs.squeeze(0), dim=1)
-                    if args.context_entity_order == "highest_prob":
-                        target_index = torch.argmax(max_probs, dim=0)
-                    elif args.context_entity_order == "natural":
-                        target_index = (input_entity_ids == 1).squeeze(0).nonzero().view(-1)[0]
-                    input_entity_ids[0, target_index] = max_indices[target_index]
-                    result[target_index] = max_indices[target_index]
-                    prediction_order[target_index] = n
-            else:
-                logits = model(entity_ids=input_entity_ids, entity_attention_mask=entity_attention_mask, **inputs)[0]
-                result = torch.argmax(logits, dim=2).squeeze(0)
-
-        for index in item["target_mention_indices"][0]:
-            predictions.append(result[index].item())
-            labels.append(entity_ids[0, index].item())
-            documents.append(item["document"][0])
-            mentions.append(item["mentions"][0][index])
-            if args.use_context_entities:
-                context_entities.append(
-                    [
-                        dict(
-                            order=prediction_order[n].item(),
-                            prediction=reverse_entity_vocab[result[n].item()],
-                            label=mention.title,
-                            text=mention.text,
-                        )
-                        for n, mention in enumerate(item["mentions"][0])
-                        if prediction_order[n] < prediction_order[index]
-                    ]
+                result, prediction_order = predict_with_context_entities(
+                    args, model, inputs, input_entity_ids, entity_attention_mask
                 )
             else:
-                context_entities.append([])
+                logits = model(entity_ids=input_entity_ids, entity_attention_mask=entity_attention_mask, **inputs)[0]
+                result = inputs["entity_candidate_ids"].gather(2, torch.argmax(logits, dim=2, keepdim=True)).squeeze(2)
+        result = result.cpu()
+
+        for batch_index, target_mention_indices in enumerate(item["target_mention_indices"]):
+            for index in target_mention_indices:
+                predictions.append(result[batch_index, index].item())
+                labels.append(entity_ids[batch_index, index].item())
+                documents.append(item["document"][batch_index])
+                mentions.append(item["mentions"][batch_index][index])
+                if args.use_context_entities:
+                    context_entities.append(
+                        [
+                            dict(
+                                order=prediction_order[batch_index, n].item(),
+                                prediction=reverse_entity_vocab[result[batch_index, n].item()],
+                                label=mention.title,
+                                text=mention.text,
+                            )
+                            for n, mention in enumerate(item["mentions"][batch_index])
+                            if prediction_order[batch_index, n] < prediction_order[batch_index, index]
+                        ]
+                    )
+                else:
+                    context_entities.append([])
 
     num_correct = 0
     num_mentions = 0
@@ -336,3 +328,51 @@ def evaluate(args, eval_dataloader, model, entity_vocab, output_file=None):
     logger.info("#correct: %d", num_correct)
 
     return dict(precision=precision, recall=recall, f1=f1)
+
+
+def predict_with_context_entities(args, model, inputs, input_entity_ids, entity_attention_mask):
+    """
+    Predicts the entities of the mentions iteratively, feeding the predicted entities to the model as the context
+    entities of the remaining mentions. At each step, the most confident prediction (or the first one in the natural
+    order) of each document is committed, together with all predictions whose probabilities are above
+    ``args.context_entity_threshold`` if it is specified.
+    """
+    result = torch.zeros_like(input_entity_ids)
+    prediction_order = torch.zeros_like(input_entity_ids)
+    remaining_mask = entity_attention_mask.bool()
+    step = 0
+    while remaining_mask.any():
+        # run the model only on the documents that have the mentions to be predicted
+        row_indices = remaining_mask.any(dim=1).nonzero().view(-1)
+        row_remaining_mask = remaining_mask[row_indices]
+        logits = model(
+            entity_ids=input_entity_ids[row_indices],
+            entity_attention_mask=entity_attention_mask[row_indices],
+            **{k: v[row_indices] for k, v in inputs.items()},
+        )[0]
+        # the logits are computed over the candidates of each mention
+        row_candidate_ids = inputs["entity_candidate_ids"][row_indices]
+        row_target_mask = row_remaining_mask & (row_candidate_ids != 0).any(dim=2)
+        probs = F.softmax(logits, dim=2) * row_target_mask.unsqueeze(-1).type_as(logits)
+        max_probs, max_indices = torch.max(probs, dim=2)
+        max_indices = row_candidate_ids.gather(2, max_indices.unsqueeze(2)).squeeze(2)
+
+        if args.context_entity_order == "highest_prob":
+            # the mentions without candidates have zero probabilities, so the committed mentions need to be excluded
+            target_indices = torch.argmax(max_probs.masked_fill(~row_remaining_mask, -1.0), dim=1)
+        else:
+            target_indices = torch.argmax(row_remaining_mask.int(), dim=1)
+        commit_mask = torch.zeros_like(row_remaining_mask)
+        commit_mask[torch.arange(row_indices.size(0), device=commit_mask.device), target_indices] = True
+        if args.context_entity_threshold is not None:
+            commit_mask |= row_remaining_mask & (max_probs >= args.context_entity_threshold)
+
+        row_input_entity_ids = input_entity_ids[row_indices]
+        row_input_entity_ids[commit_mask] = max_indices[commit_mask]
+        input_entity_ids[row_indices] = row_input_entity_ids
+        result[row_indices] = torch.where(commit_mask, max_indices, result[row_indices])
+        prediction_order[row_indices] = prediction_order[row_indices].masked_fill(commit_mask, step)
+        remaining_mask[row_indices] = row_remaining_mask & ~commit_mask
+        step += 1
+
+    return result, prediction_order
@@ -71,20 +71,29 @@ class LukeForEntityDisambiguation(LukeModel):
             entity_segment_ids,
             entity_attention_mask,
         )
-        logits = self.entity_predictions(encoder_output[1]).view(-1, self.config.entity_vocab_size)
-
-        if entity_candidate_ids is not None:
-            entity_candidate_ids = entity_candidate_ids.view(-1, entity_candidate_ids.size(-1))
-            entity_candidate_mask = logits.new_zeros(logits.size(), dtype=torch.bool)
-            entity_candidate_mask.scatter_(dim=1, index=entity_candidate_ids, src=(entity_candidate_ids != 0))
-            logits = logits.masked_fill(~entity_candidate_mask, -1e32)
-
-        logits = logits.view(entity_ids.size(0), -1, self.config.entity_vocab_size)
+        if entity_candidate_ids is None:
+            logits = self.entity_predictions(encoder_output[1])
+            if entity_labels is not None:
+                loss = F.cross_entropy(logits.view(-1, logits.size(-1)), entity_labels.view(-1), ignore_index=-1)
+                return loss, logits
+            return (logits,)
+
+        # the entities are scored only against their candidates, resulting in the logits of shape
+        # [batch, entities, candidates]
+        hidden_states = self.entity_predictions.transform(encoder_output[1])
+        candidate_embeddings = self.entity_predictions.decoder.weight[entity_candidate_ids]
+        logits = torch.matmul(candidate_embeddings, hidden_states.unsqueeze(-1)).squeeze(-1)
+        logits = logits + self.entity_predictions.bias[entity_candidate_ids]
+
+        # the padding and duplicate candidates are excluded
+        duplicate_mask = (entity_candidate_ids.unsqueeze(-1) == entity_candidate_ids.unsqueeze(-2)).tril(-1).any(-1)
+        candidate_mask = (entity_candidate_ids != 0) & ~duplicate_mask
+        logits = logits.masked_fill(~candidate_mask, torch.finfo(logits.dtype).min)
 
         if entity_labels is not None:
-            loss = F.cross_entropy(
-                logits.view(entity_labels.view(-1).size(0), -1), entity_labels.view(-1), ignore_index=-1
-            )
+            label_mask = (entity_candidate_ids == entity_labels.unsqueeze(-1)) & candidate_mask
+            candidate_labels = torch.argmax(label_mask.int(), dim=-1).masked_fill(~label_mask.any(-1), -1)
+            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), candidate_labels.view(-1), ignore_index=-1)
             return loss, logits
 
         return (logits,)
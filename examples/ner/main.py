@@ -1,5 +1,7 @@
+import hashlib
 import json
 import logging
+import multiprocessing
 import os
 from argparse import Namespace
 from collections import defaultdict
@@ -7,6 +9,7 @@ from collections import defaultdict
 import click
 import seqeval.metrics
 import torch
+import transformers
 from torch.utils.data import DataLoader, RandomSampler
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm
@@ -15,9 +18,19 @@ from transformers import WEIGHTS_NAME
 from luke.utils.entity_vocab import MASK_TOKEN
 
 from ..utils import set_seed
+from ..utils.quantization import evaluate_quantized_model
 from ..utils.trainer import Trainer, trainer_args
 from .model import LukeForNamedEntityRecognition
-from .utils import CoNLLProcessor, convert_examples_to_features
+from .utils import (
+    FEATURE_CACHE_VERSION,
+    SPAN_FILTERS,
+    CachedFeatures,
+    CoNLLProcessor,
+    SpanFilter,
+    convert_examples_to_features,
+    log_span_stats,
+    save_features,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -40,6 +53,9 @@ def cli():
 @click.option("--do-eval/--no-eval", default=True)
 @click.option("--eval-batch-size", default=32)
 @click.option("--train-on-dev-set", is_flag=True)
+@click.option("--quantize", is_flag=True)
+@click.option("--span-filter", default="none", type=click.Choice(SPAN_FILTERS))
+@click.option("--pool-size", default=multiprocessing.cpu_count())
 @click.option("--seed", default=15)
 @trainer_args
 @click.pass_obj
@@ -90,6 +106,9 @@ def run(common_args, **task_args):
         results.update({f"dev_{k}": v for k, v in evaluate(args, model, "dev", dev_output_file).items()})
         results.update({f"test_{k}": v for k, v in evaluate(args, model, "test", test_output_file).items()})
 
+        if args.quantize:
+            results.update(evaluate_quantized_model(args, model, evaluate))
+
     logger.info("Results: %s", json.dumps(results, indent=2, sort_keys=True))
     args.experiment.log_metrics(results)
     with open(os.path.join(args.output_dir, "results.json"), "w") as f:
@@ -111,9 +130,10 @@ def evaluate(args, model, fold, output_file=None):
 
         for i, feature_index in enumerate(batch["feature_indices"]):
             feature = features[feature_index.item()]
+            predictions = all_predictions[feature.example_index]
             for j, span in enumerate(feature.original_entity_spans):
                 if span is not None:
-                    all_predictions[feature.example_index][span] = logits[i, j].detach().cpu().max(dim=0)
+                    predictions[span] = logits[i, j].detach().cpu().max(dim=0)
 
     assert len(all_predictions) == len(examples)
 
@@ -163,9 +183,11 @@ def evaluate(args, model, fold, output_file=None):
 
 def load_and_cache_examples(args, fold):
     if args.local_rank not in (-1, 0) and fold == "train":
+        # the features are created only by the first process and loaded from the cache by the others
         torch.distributed.barrier()
 
     processor = CoNLLProcessor()
+    data_files = [processor.file_names[fold]]
     if fold == "train":
         examples = processor.get_train_examples(args.data_dir)
     elif fold == "dev":
@@ -175,38 +197,68 @@ def load_and_cache_examples(args, fold):
 
     if fold == "train" and args.train_on_dev_set:
         examples += processor.get_dev_examples(args.data_dir)
+        data_files.append(processor.file_names["dev"])
 
     label_list = processor.get_labels()
 
-    bert_model_name = args.model_config.bert_model_name
-
-    cache_file = os.path.join(
-        args.data_dir,
-        "cached_"
-        + "_".join(
-            (
-                bert_model_name.split("-")[0],
-                str(args.max_seq_length),
-                str(args.max_entity_length),
-                str(args.max_mention_length),
-                str(args.train_on_dev_set),
-                fold,
-            )
-        )
-        + ".pkl",
+    # the spans are pruned only at inference time so that the model is trained on all candidate spans
+    span_filter = None
+    span_filter_name = "none" if fold == "train" else args.span_filter
+    if span_filter_name == "shape":
+        span_filter = SpanFilter()
+    elif span_filter_name == "lexicon":
+        span_filter = SpanFilter(SpanFilter.build_lexicon(processor.get_train_examples(args.data_dir)))
+
+    # the cache is keyed by the hash of the data files, the tokenizer, and the parameters so that a stale cache is
+    # never reused
+    hasher = hashlib.sha1()
+    for data_file in data_files:
+        with open(os.path.join(args.data_dir, data_file), "rb") as f:
+            hasher.update(f.read())
+    cache_params = dict(
+        version=FEATURE_CACHE_VERSION,
+        tokenizer_class=args.tokenizer.__class__.__name__,
+        tokenizer_vocab=sorted(args.tokenizer.get_vocab().items()),
+        transformers_version=transformers.__version__,
+        label_list=label_list,
+        max_seq_length=args.max_seq_length,
+        max_entity_length=args.max_entity_length,
+        max_mention_length=args.max_mention_length,
+        span_filter=span_filter_name,
+        span_lexicon=sorted(span_filter.lexicon) if span_filter is not None else None,
     )
-    if os.path.exists(cache_file):
-        logger.info("Loading features from the cached file %s", cache_file)
-        features = torch.load(cache_file)
+    hasher.update(json.dumps(cache_params, sort_keys=True).encode("utf-8"))
+    cache_dir = os.path.join(args.data_dir, f"cached_{fold}_{hasher.hexdigest()}")
+
+    if os.path.exists(cache_dir):
+        logger.info("Loading features from the cache directory %s", cache_dir)
+        features = CachedFeatures(cache_dir)
+        span_stats = features.span_stats
     else:
         logger.info("Creating features from the dataset...")
 
-        features = convert_examples_to_features(
-            examples, label_list, args.tokenizer, args.max_seq_length, args.max_entity_length, args.max_mention_length
+        pool_size = args.pool_size
+        if args.local_rank not in (-1, 0):
+            # the features of the folds not synchronized with the first process may be created by all processes at
+            # the same time, so the CPUs are divided among them
+            pool_size = max(1, pool_size // torch.distributed.get_world_size())
+
+        features, span_stats = convert_examples_to_features(
+            examples,
+            label_list,
+            args.tokenizer,
+            args.max_seq_length,
+            args.max_entity_length,
+            args.max_mention_length,
+            span_filter=span_filter,
+            pool_size=pool_size,
         )
 
         if args.local_rank in (-1, 0):
-            torch.save(features, cache_file)
+            save_features(features, span_stats, cache_dir)
+
+    if span_filter is not None:
+        log_span_stats(span_stats)
 
     if args.local_rank == 0 and fold == "train":
         torch.distributed.barrier()
@@ -1,9 +1,23 @@
 import itertools
+import logging
 import math
+import multiprocessing
 import os
+import shutil
+import tempfile
 import unicodedata
+from argparse import Namespace
+from contextlib import closing
+from multiprocessing.pool import Pool
+
+import numpy as np
+from tqdm import tqdm
 from transformers.tokenization_roberta import RobertaTokenizer
 
+logger = logging.getLogger(__name__)
+
+SPAN_FILTERS = ("none", "shape", "lexicon")
+
 
 class InputExample(object):
     def __init__(self, guid, words, labels, sentence_boundaries):
@@ -43,15 +57,111 @@ class InputFeatures(object):
         self.labels = labels
 
 
+FEATURE_CACHE_VERSION = 2
+
+_WORD_COLUMNS = ("word_ids", "word_segment_ids", "word_attention_mask")
+_ENTITY_COLUMNS = (
+    "entity_start_positions",
+    "entity_end_positions",
+    "entity_ids",
+    "entity_segment_ids",
+    "entity_attention_mask",
+    "labels",
+)
+
+
+def save_features(features, span_stats, cache_dir):
+    """
+    Saves the features into the directory in a columnar format. Each attribute is stored as a flat int32 array with
+    the offsets of the features, so that the cache can be loaded using memory mapping instead of unpickling. The span
+    statistics returned by :func:`convert_examples_to_features` are stored along with the features. The directory is
+    written atomically so that a partially written cache is never loaded.
+    """
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(cache_dir)))
+
+    def save(name, arr):
+        np.save(os.path.join(tmp_dir, f"{name}.npy"), arr)
+
+    def compute_offsets(name):
+        return np.cumsum([0] + [len(getattr(f, name)) for f in features], dtype=np.int64)
+
+    def concatenate(name, width=None):
+        arr = np.array([v for f in features for v in getattr(f, name)], dtype=np.int32)
+        return arr if width is None else arr.reshape(-1, width)
+
+    save("example_indices", np.array([f.example_index for f in features], dtype=np.int32))
+    save("word_offsets", compute_offsets("word_ids"))
+    for name in _WORD_COLUMNS:
+        save(name, concatenate(name))
+
+    max_mention_length = len(features[0].entity_position_ids[0]) if features else 0
+    save("entity_offsets", compute_offsets("entity_ids"))
+    for name in _ENTITY_COLUMNS:
+        save(name, concatenate(name))
+    save("entity_position_ids", concatenate("entity_position_ids", max_mention_length))
+    spans = [(-1, -1) if span is None else span for f in features for span in f.original_entity_spans]
+    save("original_entity_spans", np.array(spans, dtype=np.int32).reshape(-1, 2))
+    save("span_stats", np.array(span_stats, dtype=np.int64))
+
+    try:
+        os.rename(tmp_dir, cache_dir)
+    except OSError:
+        # another process has already created the cache
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+class CachedFeatures(object):
+    """
+    A read-only sequence of the features stored by :func:`save_features`. The arrays are memory-mapped, and each
+    :class:`InputFeatures` is created from the slices of the arrays when it is accessed.
+    """
+
+    def __init__(self, cache_dir):
+        def load(name):
+            return np.load(os.path.join(cache_dir, f"{name}.npy"), mmap_mode="r")
+
+        self._example_indices = load("example_indices")
+        self._word_offsets = load("word_offsets")
+        self._entity_offsets = load("entity_offsets")
+        self._columns = {name: load(name) for name in _WORD_COLUMNS + _ENTITY_COLUMNS}
+        self._entity_position_ids = load("entity_position_ids")
+        self._original_entity_spans = load("original_entity_spans")
+        self.span_stats = tuple(load("span_stats").tolist())
+
+    def __len__(self):
+        return self._example_indices.size
+
+    def __getitem__(self, index):
+        word_start, word_end = self._word_offsets[index : index + 2]
+        entity_start, entity_end = self._entity_offsets[index : index + 2]
+        kwargs = {name: self._columns[name][word_start:word_end] for name in _WORD_COLUMNS}
+        kwargs.update({name: self._columns[name][entity_start:entity_end] for name in _ENTITY_COLUMNS})
+        return InputFeatures(
+            example_index=int(self._example_indices[index]),
+            entity_position_ids=self._entity_position_ids[entity_start:entity_end],
+            original_entity_spans=[
+                None if start == -1 else (int(start), int(end))
+                for start, end in self._original_entity_spans[entity_start:entity_end].tolist()
+            ],
+            **kwargs
+        )
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
 class CoNLLProcessor(object):
+    file_names = dict(train="eng.train", dev="eng.testa", test="eng.testb")
+
     def get_train_examples(self, data_dir):
-        return list(self._create_examples(self._read_data(os.path.join(data_dir, "eng.train")), "train"))
+        return list(self._create_examples(self._read_data(os.path.join(data_dir, self.file_names["train"])), "train"))
 
     def get_dev_examples(self, data_dir):
-        return list(self._create_examples(self._read_data(os.path.join(data_dir, "eng.testa")), "dev"))
+        return list(self._create_examples(self._read_data(os.path.join(data_dir, self.file_names["dev"])), "dev"))
 
     def get_test_examples(self, data_dir):
-        return list(self._create_examples(self._read_data(os.path.join(data_dir, "eng.testb")), "test"))
+        return list(self._create_examples(self._read_data(os.path.join(data_dir, self.file_names["test"])), "test"))
 
     def get_labels(self):
         return ["NIL", "MISC", "PER", "ORG", "LOC"]
@@ -91,12 +201,129 @@ class CoNLLProcessor(object):
         return [InputExample(f"{fold}-{i}", *args) for i, args in enumerate(data)]
 
 
+class SpanFilter(object):
+    """
+    Cheap filter that prunes the candidate spans that are unlikely to be named entities before they are fed to the
+    model. A span is kept if it neither starts nor ends with a punctuation word and contains an uppercase character,
+    or if its lowercased text is found in the lexicon.
+    """
+
+    def __init__(self, lexicon=()):
+        self.lexicon = frozenset(lexicon)
+
+    @staticmethod
+    def build_lexicon(examples):
+        lexicon = set()
+        for example in examples:
+            for start, end, _ in get_entity_spans(example):
+                lexicon.add(" ".join(example.words[start:end]).lower())
+        return lexicon
+
+    def __call__(self, words):
+        if " ".join(words).lower() in self.lexicon:
+            return True
+        if all(is_punctuation(c) for c in words[0]) or all(is_punctuation(c) for c in words[-1]):
+            return False
+        return any(c.isupper() for word in words for c in word)
+
+
+def get_entity_spans(example):
+    """
+    Yields the start and (exclusive) end word positions and the type of each entity span annotated with the BIO
+    labels of the example. A span is split at the sentence boundaries and where the entity type changes.
+    """
+    sentence_boundaries = frozenset(example.sentence_boundaries)
+    start = None
+    cur_type = None
+    for n, label in enumerate(example.labels):
+        if label == "O" or n in sentence_boundaries:
+            if start is not None:
+                yield start, n, cur_type
+                start = None
+                cur_type = None
+
+        if label.startswith("B"):
+            if start is not None:
+                yield start, n, cur_type
+            start = n
+            cur_type = label[2:]
+
+        elif label.startswith("I"):
+            if start is None:
+                start = n
+                cur_type = label[2:]
+            elif cur_type != label[2:]:
+                yield start, n, cur_type
+                start = n
+                cur_type = label[2:]
+
+    if start is not None:
+        yield start, len(example.labels), cur_type
+
+
 def convert_examples_to_features(
-    examples, label_list, tokenizer, max_seq_length, max_entity_length, max_mention_length
+    examples,
+    label_list,
+    tokenizer,
+    max_seq_length,
+    max_entity_length,
+    max_mention_length,
+    span_filter=None,
+    pool_size=multiprocessing.cpu_count(),
+    chunk_size=30,
 ):
-    max_num_subwords = max_seq_length - 2
-    label_map = {label: i for i, label in enumerate(label_list)}
+    worker_params = Namespace(
+        tokenizer=tokenizer,
+        label_map={label: i for i, label in enumerate(label_list)},
+        max_seq_length=max_seq_length,
+        max_entity_length=max_entity_length,
+        max_mention_length=max_mention_length,
+        span_filter=span_filter,
+    )
     features = []
+    span_stats = [0, 0, 0, 0]
+    with closing(Pool(pool_size, initializer=_initialize_worker, initargs=(worker_params,))) as pool:
+        with tqdm(total=len(examples)) as pbar:
+            for example_features, example_span_stats in pool.imap(
+                _process_example, enumerate(examples), chunksize=chunk_size
+            ):
+                features += example_features
+                span_stats = [a + b for a, b in zip(span_stats, example_span_stats)]
+                pbar.update()
+
+    return features, tuple(span_stats)
+
+
+def log_span_stats(span_stats):
+    num_spans, num_kept_spans, num_entity_spans, num_pruned_entity_spans = span_stats
+    logger.info(
+        "Span filter: kept %d/%d spans (%.2f%%), entity span recall %.2f%% (%d/%d)",
+        num_kept_spans,
+        num_spans,
+        num_kept_spans / max(num_spans, 1) * 100,
+        (num_entity_spans - num_pruned_entity_spans) / max(num_entity_spans, 1) * 100,
+        num_entity_spans - num_pruned_entity_spans,
+        num_entity_spans,
+    )
+
+
+params = None
+
+
+def _initialize_worker(_params):
+    global params
+    params = _params
+
+
+def _process_example(args):
+    example_index, example = args
+
+    tokenizer = params.tokenizer
+    max_num_subwords = params.max_seq_length - 2
+    features = []
+    num_spans = 0
+    num_kept_spans = 0
+    num_pruned_entity_spans = 0
 
     def tokenize_word(text):
         if (
@@ -107,138 +334,124 @@ def convert_examples_to_features(
             return tokenizer.tokenize(text, add_prefix_space=True)
         return tokenizer.tokenize(text)
 
-    for example_index, example in enumerate(examples):
-        tokens = [tokenize_word(w) for w in example.words]
-        subwords = [w for li in tokens for w in li]
-
-        subword2token = list(itertools.chain(*[[i] * len(li) for i, li in enumerate(tokens)]))
-        token2subword = [0] + list(itertools.accumulate(len(li) for li in tokens))
-        subword_start_positions = frozenset(token2subword)
-        subword_sentence_boundaries = [sum(len(li) for li in tokens[:p]) for p in example.sentence_boundaries]
-
-        entity_labels = {}
-        start = None
-        cur_type = None
-        for n, label in enumerate(example.labels):
-            if label == "O" or n in example.sentence_boundaries:
-                if start is not None:
-                    entity_labels[(token2subword[start], token2subword[n])] = label_map[cur_type]
-                    start = None
-                    cur_type = None
-
-            if label.startswith("B"):
-                if start is not None:
-                    entity_labels[(token2subword[start], token2subword[n])] = label_map[cur_type]
-                start = n
-                cur_type = label[2:]
+    tokens = [tokenize_word(w) for w in example.words]
+    subwords = [w for li in tokens for w in li]
+
+    subword2token = list(itertools.chain(*[[i] * len(li) for i, li in enumerate(tokens)]))
+    token2subword = [0] + list(itertools.accumulate(len(li) for li in tokens))
+    subword_start_positions = frozenset(token2subword)
+    subword_sentence_boundaries = [sum(len(li) for li in tokens[:p]) for p in example.sentence_boundaries]
+
+    entity_labels = {
+        (token2subword[start], token2subword[end]): params.label_map[entity_type]
+        for start, end, entity_type in get_entity_spans(example)
+    }
+    num_entity_spans = len(entity_labels)
+
+    for n in range(len(subword_sentence_boundaries) - 1):
+        doc_sent_start, doc_sent_end = subword_sentence_boundaries[n : n + 2]
+
+        left_length = doc_sent_start
+        right_length = len(subwords) - doc_sent_end
+        sentence_length = doc_sent_end - doc_sent_start
+        half_context_length = int((max_num_subwords - sentence_length) / 2)
+
+        if left_length < right_length:
+            left_context_length = min(left_length, half_context_length)
+            right_context_length = min(right_length, max_num_subwords - left_context_length - sentence_length)
+        else:
+            right_context_length = min(right_length, half_context_length)
+            left_context_length = min(left_length, max_num_subwords - right_context_length - sentence_length)
+
+        doc_offset = doc_sent_start - left_context_length
+        target_tokens = subwords[doc_offset : doc_sent_end + right_context_length]
+
+        word_ids = tokenizer.convert_tokens_to_ids([tokenizer.cls_token] + target_tokens + [tokenizer.sep_token])
+        word_attention_mask = [1] * (len(target_tokens) + 2)
+        word_segment_ids = [0] * (len(target_tokens) + 2)
+
+        entity_start_positions = []
+        entity_end_positions = []
+        entity_ids = []
+        entity_attention_mask = []
+        entity_segment_ids = []
+        entity_position_ids = []
+        original_entity_spans = []
+        labels = []
+
+        for entity_start in range(left_context_length, left_context_length + sentence_length):
+            doc_entity_start = entity_start + doc_offset
+            if doc_entity_start not in subword_start_positions:
+                continue
+            for entity_end in range(entity_start + 1, left_context_length + sentence_length + 1):
+                doc_entity_end = entity_end + doc_offset
+                if doc_entity_end not in subword_start_positions:
+                    continue
 
-            elif label.startswith("I"):
-                if start is None:
-                    start = n
-                    cur_type = label[2:]
-                elif cur_type != label[2:]:
-                    entity_labels[(token2subword[start], token2subword[n])] = label_map[cur_type]
-                    start = n
-                    cur_type = label[2:]
-
-        if start is not None:
-            entity_labels[(token2subword[start], len(subwords))] = label_map[cur_type]
-
-        for n in range(len(subword_sentence_boundaries) - 1):
-            doc_sent_start, doc_sent_end = subword_sentence_boundaries[n : n + 2]
-
-            left_length = doc_sent_start
-            right_length = len(subwords) - doc_sent_end
-            sentence_length = doc_sent_end - doc_sent_start
-            half_context_length = int((max_num_subwords - sentence_length) / 2)
-
-            if left_length < right_length:
-                left_context_length = min(left_length, half_context_length)
-                right_context_length = min(right_length, max_num_subwords - left_context_length - sentence_length)
-            else:
-                right_context_length = min(right_length, half_context_length)
-                left_context_length = min(left_length, max_num_subwords - right_context_length - sentence_length)
-
-            doc_offset = doc_sent_start - left_context_length
-            target_tokens = subwords[doc_offset : doc_sent_end + right_context_length]
-
-            word_ids = tokenizer.convert_tokens_to_ids([tokenizer.cls_token] + target_tokens + [tokenizer.sep_token])
-            word_attention_mask = [1] * (len(target_tokens) + 2)
-            word_segment_ids = [0] * (len(target_tokens) + 2)
-
-            entity_start_positions = []
-            entity_end_positions = []
-            entity_ids = []
-            entity_attention_mask = []
-            entity_segment_ids = []
-            entity_position_ids = []
-            original_entity_spans = []
-            labels = []
-
-            for entity_start in range(left_context_length, left_context_length + sentence_length):
-                doc_entity_start = entity_start + doc_offset
-                if doc_entity_start not in subword_start_positions:
+                if entity_end - entity_start > params.max_mention_length:
                     continue
-                for entity_end in range(entity_start + 1, left_context_length + sentence_length + 1):
-                    doc_entity_end = entity_end + doc_offset
-                    if doc_entity_end not in subword_start_positions:
-                        continue
-
-                    if entity_end - entity_start > max_mention_length:
-                        continue
-
-                    entity_start_positions.append(entity_start + 1)
-                    entity_end_positions.append(entity_end)
-                    entity_ids.append(1)
-                    entity_attention_mask.append(1)
-                    entity_segment_ids.append(0)
-
-                    position_ids = list(range(entity_start + 1, entity_end + 1))
-                    position_ids += [-1] * (max_mention_length - entity_end + entity_start)
-                    entity_position_ids.append(position_ids)
-
-                    original_entity_spans.append(
-                        (subword2token[doc_entity_start], subword2token[doc_entity_end - 1] + 1)
-                    )
-
-                    labels.append(entity_labels.get((doc_entity_start, doc_entity_end), 0))
-                    entity_labels.pop((doc_entity_start, doc_entity_end), None)
-
-            if len(entity_ids) == 1:
-                entity_start_positions.append(0)
-                entity_end_positions.append(0)
-                entity_ids.append(0)
-                entity_attention_mask.append(0)
+
+                num_spans += 1
+                original_entity_span = (subword2token[doc_entity_start], subword2token[doc_entity_end - 1] + 1)
+                if params.span_filter is not None and not params.span_filter(
+                    example.words[slice(*original_entity_span)]
+                ):
+                    if entity_labels.pop((doc_entity_start, doc_entity_end), None) is not None:
+                        num_pruned_entity_spans += 1
+                    continue
+                num_kept_spans += 1
+
+                entity_start_positions.append(entity_start + 1)
+                entity_end_positions.append(entity_end)
+                entity_ids.append(1)
+                entity_attention_mask.append(1)
                 entity_segment_ids.append(0)
-                entity_position_ids.append(([-1] * max_mention_length))
-                original_entity_spans.append(None)
-                labels.append(-1)
-
-            split_size = math.ceil(len(entity_ids) / max_entity_length)
-            for i in range(split_size):
-                entity_size = math.ceil(len(entity_ids) / split_size)
-                start = i * entity_size
-                end = start + entity_size
-                features.append(
-                    InputFeatures(
-                        example_index=example_index,
-                        word_ids=word_ids,
-                        word_attention_mask=word_attention_mask,
-                        word_segment_ids=word_segment_ids,
-                        entity_start_positions=entity_start_positions[start:end],
-                        entity_end_positions=entity_end_positions[start:end],
-                        entity_ids=entity_ids[start:end],
-                        entity_position_ids=entity_position_ids[start:end],
-                        entity_segment_ids=entity_segment_ids[start:end],
-                        entity_attention_mask=entity_attention_mask[start:end],
-                        original_entity_spans=original_entity_spans[start:end],
-                        labels=labels[start:end],
-                    )
+
+                position_ids = list(range(entity_start + 1, entity_end + 1))
+                position_ids += [-1] * (params.max_mention_length - entity_end + entity_start)
+                entity_position_ids.append(position_ids)
+
+                original_entity_spans.append(original_entity_span)
+
+                labels.append(entity_labels.get((doc_entity_start, doc_entity_end), 0))
+                entity_labels.pop((doc_entity_start, doc_entity_end), None)
+
+        # a feature needs at least two entity slots; a sentence may have no span left after the filtering
+        while len(entity_ids) < 2:
+            entity_start_positions.append(0)
+            entity_end_positions.append(0)
+            entity_ids.append(0)
+            entity_attention_mask.append(0)
+            entity_segment_ids.append(0)
+            entity_position_ids.append(([-1] * params.max_mention_length))
+            original_entity_spans.append(None)
+            labels.append(-1)
+
+        split_size = math.ceil(len(entity_ids) / params.max_entity_length)
+        for i in range(split_size):
+            entity_size = math.ceil(len(entity_ids) / split_size)
+            start = i * entity_size
+            end = start + entity_size
+            features.append(
+                InputFeatures(
+                    example_index=example_index,
+                    word_ids=word_ids,
+                    word_attention_mask=word_attention_mask,
+                    word_segment_ids=word_segment_ids,
+                    entity_start_positions=entity_start_positions[start:end],
+                    entity_end_positions=entity_end_positions[start:end],
+                    entity_ids=entity_ids[start:end],
+                    entity_position_ids=entity_position_ids[start:end],
+                    entity_segment_ids=entity_segment_ids[start:end],
+                    entity_attention_mask=entity_attention_mask[start:end],
+                    original_entity_spans=original_entity_spans[start:end],
+                    labels=labels[start:end],
                 )
+            )
 
-        assert not entity_labels
+    assert not entity_labels
 
-    return features
+    return features, (num_spans, num_kept_spans, num_entity_spans, num_pruned_entity_spans)
 
 
 def is_punctuation(char):
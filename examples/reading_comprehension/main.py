@@ -155,7 +155,7 @@ def evaluate(args, model, prefix=""):
         for i, example_index in enumerate(batch["example_indices"]):
             eval_feature = features[example_index.item()]
             unique_id = int(eval_feature.unique_id)
-            start_logits, end_logits = [o[i].detach().cpu().tolist() for o in outputs]
+            start_logits, end_logits = [o[i].detach().cpu().float().numpy() for o in outputs]
             all_results.append(Result(unique_id, start_logits, end_logits))
 
     output_prediction_file = os.path.join(args.output_dir, "predictions_{}.json".format(prefix))
@@ -2,8 +2,9 @@ import logging
 import multiprocessing
 import unicodedata
 from argparse import Namespace
+from collections import OrderedDict
 from contextlib import closing
-from itertools import chain, repeat
+from itertools import accumulate, chain, repeat
 from multiprocessing.pool import Pool
 
 from tqdm import tqdm
@@ -91,14 +92,27 @@ def convert_examples_to_features(
     )
     features = []
     unique_id = 1000000000
+    num_cache_hits = 0
+    num_cache_lookups = 0
     with closing(Pool(pool_size, initializer=_initialize_worker, initargs=(worker_params,))) as pool:
         with tqdm(total=len(examples)) as pbar:
-            for ret in pool.imap(_process_example, enumerate(examples), chunksize=chunk_size):
+            for ret, (cache_hits, cache_lookups) in pool.imap(
+                _process_example, enumerate(examples), chunksize=chunk_size
+            ):
                 for feature in ret:
                     feature.unique_id = unique_id
                     features.append(feature)
                     unique_id += 1
+                num_cache_hits += cache_hits
+                num_cache_lookups += cache_lookups
                 pbar.update()
+
+    logger.info(
+        "Mention candidate cache: hit rate %.2f%% (%d/%d)",
+        num_cache_hits / max(num_cache_lookups, 1) * 100,
+        num_cache_hits,
+        num_cache_lookups,
+    )
     return features
 
 
@@ -114,6 +128,7 @@ class PassageEncoder(object):
         min_mention_link_prob,
         add_extra_sep_token,
         segment_b_id,
+        mention_cache_size=100,
     ):
         self._tokenizer = tokenizer
         self._entity_vocab = entity_vocab
@@ -125,6 +140,13 @@ class PassageEncoder(object):
         self._segment_b_id = segment_b_id
         self._min_mention_link_prob = min_mention_link_prob
 
+        # the mention candidates of the recently used titles are cached as the questions and the doc spans of the same
+        # article share the title. the cache is created in each worker process as the encoder is pickled
+        self._mention_cache_size = mention_cache_size
+        self._mention_cache = OrderedDict()
+        self.mention_cache_hits = 0
+        self.mention_cache_lookups = 0
+
     def encode(self, title, tokens_a, tokens_b):
         if self._add_extra_sep_token:
             mid_sep_tokens = [self._tokenizer.sep_token] * 2
@@ -137,30 +159,9 @@ class PassageEncoder(object):
         word_segment_ids = [0] * (len(tokens_a) + len(mid_sep_tokens) + 1) + [self._segment_b_id] * (len(tokens_b) + 1)
         word_attention_mask = [1] * len(all_tokens)
 
-        try:
-            title = self._link_redirect_mappings.get(title, title)
-            mention_candidates = {}
-            ambiguous_mentions = set()
-            for link in self._wiki_link_db.get(title):
-                if link.link_prob < self._min_mention_link_prob:
-                    continue
-
-                link_text = self._normalize_mention(link.text)
-                if link_text in mention_candidates and mention_candidates[link_text] != link.title:
-                    ambiguous_mentions.add(link_text)
-                    continue
-
-                mention_candidates[link_text] = link.title
-
-            for link_text in ambiguous_mentions:
-                del mention_candidates[link_text]
-
-        except KeyError:
-            mention_candidates = {}
-            logger.warning("Not found in the Dump DB: %s", title)
-
-        mentions_a = self._detect_mentions(tokens_a, mention_candidates)
-        mentions_b = self._detect_mentions(tokens_b, mention_candidates)
+        mention_candidates, mention_trie = self._get_mention_candidates(title)
+        mentions_a = self._detect_mentions(tokens_a, mention_candidates, mention_trie)
+        mentions_b = self._detect_mentions(tokens_b, mention_candidates, mention_trie)
         all_mentions = mentions_a + mentions_b
 
         if not all_mentions:
@@ -203,30 +204,142 @@ class PassageEncoder(object):
             entity_attention_mask=entity_attention_mask,
         )
 
-    def _detect_mentions(self, tokens, mention_candidates):
+    def _get_mention_candidates(self, title):
+        self.mention_cache_lookups += 1
+        if title in self._mention_cache:
+            self.mention_cache_hits += 1
+            self._mention_cache.move_to_end(title)
+            return self._mention_cache[title]
+
+        try:
+            link_title = self._link_redirect_mappings.get(title, title)
+            mention_candidates = {}
+            ambiguous_mentions = set()
+            for link in self._wiki_link_db.get(link_title):
+                if link.link_prob < self._min_mention_link_prob:
+                    continue
+
+                link_text = self._normalize_mention(link.text)
+                if link_text in mention_candidates and mention_candidates[link_text] != link.title:
+                    ambiguous_mentions.add(link_text)
+                    continue
+
+                mention_candidates[link_text] = link.title
+
+            for link_text in ambiguous_mentions:
+                del mention_candidates[link_text]
+
+        except KeyError:
+            mention_candidates = {}
+            logger.warning("Not found in the Dump DB: %s", link_title)
+
+        ret = (mention_candidates, self._build_mention_trie(mention_candidates))
+        self._mention_cache[title] = ret
+        if len(self._mention_cache) > self._mention_cache_size:
+            self._mention_cache.popitem(last=False)
+
+        return ret
+
+    @staticmethod
+    def _build_mention_trie(mention_candidates):
+        """Builds a character-level trie of the mention texts. The text is stored in the terminal node at key None."""
+        trie = {}
+        for mention_text in mention_candidates.keys():
+            node = trie
+            for c in mention_text:
+                node = node.setdefault(c, {})
+            node[None] = mention_text
+        return trie
+
+    def _detect_mentions(self, tokens, mention_candidates, mention_trie):
+        """
+        Detects the longest mentions from left to right. Each word is decoded once, and the span starting at each word
+        is extended word by word while walking the trie from the node reached by the previous extension. The extension
+        stops as soon as no mention in the trie starts with the normalized text of the span.
+        """
+        word_starts = [i for i, token in enumerate(tokens) if not self._is_subword(token)]
+        word_ends = word_starts[1:] + [len(tokens)]
+        word_texts = [self._tokenizer.convert_tokens_to_string(tokens[s:e]) for s, e in zip(word_starts, word_ends)]
+        word_separators = [None] + [
+            self._get_word_separator(tokens[word_starts[i - 1] : word_ends[i]], word_texts[i - 1], word_texts[i])
+            for i in range(1, len(word_starts))
+        ]
+
         mentions = []
         cur = 0
-        for start, token in enumerate(tokens):
+        for i, start in enumerate(word_starts):
             if start < cur:
                 continue
-            if self._is_subword(token):
-                continue
 
-            for end in range(min(start + self._max_mention_length, len(tokens)), start, -1):
-                if end < len(tokens) and self._is_subword(tokens[end]):
-                    continue
-                mention_text = self._tokenizer.convert_tokens_to_string(tokens[start:end])
-                mention_text = self._normalize_mention(mention_text)
-                if mention_text in mention_candidates:
-                    cur = end
-                    title = mention_candidates[mention_text]
-                    title = self._model_redirect_mappings.get(title, title)  # resolve mismatch between two dumps
-                    if title in self._entity_vocab:
-                        mentions.append((self._entity_vocab[title], start, end))
+            mention_text = None
+            node = mention_trie
+            # the whitespace at the end of the span is walked only when the span is extended, as it is removed by
+            # the normalization
+            pending_text = ""
+            is_started = False
+            is_exact = False
+            for j in range(i, len(word_starts)):
+                end = word_ends[j]
+                if end - start > self._max_mention_length:
+                    break
+
+                text = word_texts[j] if j == i else word_separators[j]
+                if text is None or "\u03a3" in word_texts[j]:
+                    # the span is decoded at once if the decoded words cannot be simply concatenated or the word
+                    # contains the capital sigma whose lowercase form depends on the surrounding characters
+                    is_exact = True
+                elif j != i:
+                    text += word_texts[j]
+
+                if is_exact:
+                    text = self._normalize_mention(self._tokenizer.convert_tokens_to_string(tokens[start:end]))
+                    node = self._walk_mention_trie(mention_trie, text)
+                else:
+                    text = text.lower()
+                    if not is_started:
+                        text = text.lstrip()
+                    stripped_text = text.rstrip()
+                    if stripped_text:
+                        node = self._walk_mention_trie(node, pending_text + stripped_text)
+                        pending_text = text[len(stripped_text) :]
+                        is_started = True
+                    else:
+                        pending_text += text
+
+                if node is None:
                     break
+                if None in node:
+                    mention_text = node[None]
+                    cur = end
+
+            if mention_text is not None:
+                title = mention_candidates[mention_text]
+                title = self._model_redirect_mappings.get(title, title)  # resolve mismatch between two dumps
+                if title in self._entity_vocab:
+                    mentions.append((self._entity_vocab[title], start, cur))
 
         return mentions
 
+    def _get_word_separator(self, tokens, text_a, text_b):
+        """
+        Returns the text inserted between two adjacent words when they are decoded together, or None if the decoded
+        text is not the concatenation of the decoded words, e.g., if the tokenizer cleans up the surrounding spaces.
+        """
+        text = self._tokenizer.convert_tokens_to_string(tokens)
+        if text.startswith(text_a) and text.endswith(text_b) and len(text) >= len(text_a) + len(text_b):
+            separator = text[len(text_a) : len(text) - len(text_b)]
+            if not separator.strip():
+                return separator
+        return None
+
+    @staticmethod
+    def _walk_mention_trie(node, text):
+        for c in text:
+            node = node.get(c)
+            if node is None:
+                return None
+        return node
+
     def _is_subword(self, token):
         if isinstance(self._tokenizer, RobertaTokenizer):
             token = self._tokenizer.convert_tokens_to_string(token)
@@ -309,7 +422,12 @@ def _process_example(args):
             break
         start_offset += min(length, params.doc_stride)
 
+    max_context_span_indices = _compute_max_context_span_indices(doc_spans, len(all_doc_tokens))
+
     features = []
+    passage_encoder = params.passage_encoder
+    cache_hits = passage_encoder.mention_cache_hits
+    cache_lookups = passage_encoder.mention_cache_lookups
 
     for doc_span_index, doc_span in enumerate(doc_spans):
         token_to_orig_map = {}
@@ -324,7 +442,7 @@ def _process_example(args):
             split_token_index = doc_span["start"] + i
             token_to_orig_map[answer_offset + i] = tok_to_orig_index[split_token_index]
 
-            is_max_context = _check_is_max_context(doc_spans, doc_span_index, split_token_index)
+            is_max_context = max_context_span_indices[split_token_index] == doc_span_index
             token_is_max_context[answer_offset + i] = is_max_context
             answer_tokens.append(all_doc_tokens[split_token_index])
 
@@ -360,11 +478,14 @@ def _process_example(args):
                 token_is_max_context=token_is_max_context,
                 start_positions=start_positions,
                 end_positions=end_positions,
-                **params.passage_encoder.encode(example.title, query_tokens, answer_tokens)
+                **passage_encoder.encode(example.title, query_tokens, answer_tokens)
             )
         )
 
-    return features
+    return (
+        features,
+        (passage_encoder.mention_cache_hits - cache_hits, passage_encoder.mention_cache_lookups - cache_lookups),
+    )
 
 
 def _tokenize(text):
@@ -378,36 +499,68 @@ def _improve_answer_span(doc_tokens, input_start, input_end, tokenizer, orig_ans
     """Returns tokenized answer spans that better match the annotated answer.
        Original version was obtained from here:
        https://github.com/huggingface/transformers/blob/23c6998bf46e43092fc59543ea7795074a720f08/src/transformers/data/processors/squad.py#L25
+       The text of each span is sliced from the text of the whole input span using the character offsets of the token
+       boundaries instead of converting the tokens of every span into a string.
     """
     tok_answer_text = tokenizer.convert_tokens_to_string(_tokenize(orig_answer_text)).strip()
 
+    tokens = doc_tokens[input_start : (input_end + 1)]
+    text = tokenizer.convert_tokens_to_string(tokens)
+    token_offsets = _compute_token_offsets(tokens, tokenizer, text)
+
     for new_start in range(input_start, input_end + 1):
         for new_end in range(input_end, new_start - 1, -1):
-            text_span = tokenizer.convert_tokens_to_string(doc_tokens[new_start : (new_end + 1)]).strip()
+            if token_offsets is None:
+                text_span = tokenizer.convert_tokens_to_string(doc_tokens[new_start : (new_end + 1)]).strip()
+            else:
+                first_token_texts, end_offsets = token_offsets
+                # the first token of a span is decoded without the separator preceding it in the whole text
+                start_offset = end_offsets[new_start - input_start]
+                end_offset = end_offsets[new_end - input_start]
+                text_span = (first_token_texts[new_start - input_start] + text[start_offset:end_offset]).strip()
             if text_span == tok_answer_text:
                 return new_start, new_end
 
     return input_start, input_end
 
 
-def _check_is_max_context(doc_spans, cur_span_index, position):
-    """Check if this is the 'max context' doc span for the token.
-       Original version was obtained from here:
+def _compute_token_offsets(tokens, tokenizer, text):
+    """Returns the text of each token decoded as the first token of a span, and the offset in ``text`` of the end of
+       each token. The text appended by a token is obtained by decoding the token together with the preceding token.
+       None is returned if ``text`` is not the concatenation of these texts, e.g., if a character is split into
+       multiple byte-level tokens.
+    """
+    first_token_texts = [tokenizer.convert_tokens_to_string([token]) for token in tokens]
+    token_texts = [first_token_texts[0]]
+    for i in range(1, len(tokens)):
+        pair_text = tokenizer.convert_tokens_to_string(tokens[i - 1 : i + 1])
+        if not pair_text.startswith(first_token_texts[i - 1]):
+            return None
+        token_texts.append(pair_text[len(first_token_texts[i - 1]) :])
+
+    if "".join(token_texts) != text:
+        return None
+    end_offsets = list(accumulate(len(token_text) for token_text in token_texts))
+
+    return first_token_texts, end_offsets
+
+
+def _compute_max_context_span_indices(doc_spans, num_tokens):
+    """Returns the index of the 'max context' doc span of each token.
+       This is equivalent to the following function, but the scores are computed in a single pass over the doc spans:
        https://github.com/huggingface/transformers/blob/23c6998bf46e43092fc59543ea7795074a720f08/src/transformers/data/processors/squad.py#L38
     """
-    best_score = None
-    best_span_index = None
+    best_scores = [None] * num_tokens
+    best_span_indices = [None] * num_tokens
     for span_index, doc_span in enumerate(doc_spans):
+        start = doc_span["start"]
         end = doc_span["start"] + doc_span["length"] - 1
-        if position < doc_span["start"]:
-            continue
-        if position > end:
-            continue
-        num_left_context = position - doc_span["start"]
-        num_right_context = end - position
-        score = min(num_left_context, num_right_context) + 0.01 * doc_span["length"]
-        if best_score is None or score > best_score:
-            best_score = score
-            best_span_index = span_index
-
-    return cur_span_index == best_span_index
+        for position in range(start, end + 1):
+            num_left_context = position - start
+            num_right_context = end - position
+            score = min(num_left_context, num_right_context) + 0.01 * doc_span["length"]
+            if best_scores[position] is None or score > best_scores[position]:
+                best_scores[position] = score
+                best_span_indices[position] = span_index
+
+    return best_span_indices
@@ -3,6 +3,7 @@ import logging
 import math
 import collections
 
+import numpy as np
 from transformers.tokenization_bert import BasicTokenizer
 from transformers.tokenization_roberta import RobertaTokenizer
 
@@ -53,7 +54,11 @@ def write_predictions(
     for example_index, example in enumerate(all_examples):
         features = example_index_to_features[example_index]
 
-        prelim_predictions = []
+        prelim_feature_indices = []
+        prelim_start_indices = []
+        prelim_end_indices = []
+        prelim_start_logits = []
+        prelim_end_logits = []
         # keep track of the minimum score of null start+end of position 0
         score_null = 1000000  # large and positive
         min_null_feature_index = 0  # the paragraph slice with min null score
@@ -61,56 +66,67 @@ def write_predictions(
         null_end_logit = 0  # the end logit at the slice with min null score
         for (feature_index, feature) in enumerate(features):
             result = unique_id_to_result[feature.unique_id]
-            start_indexes = _get_best_indexes(result.start_logits, n_best_size)
-            end_indexes = _get_best_indexes(result.end_logits, n_best_size)
+            # the logits are converted to float64 so that the scores are identical to the ones computed using Python
+            # floats
+            start_logits = np.asarray(result.start_logits, dtype=np.float64)
+            end_logits = np.asarray(result.end_logits, dtype=np.float64)
+            start_indexes = _get_best_indexes(start_logits, n_best_size)
+            end_indexes = _get_best_indexes(end_logits, n_best_size)
             # if we could have irrelevant answers, get the min score of irrelevant
             if version_2_with_negative:
-                feature_null_score = result.start_logits[0] + result.end_logits[0]
+                feature_null_score = float(start_logits[0] + end_logits[0])
                 if feature_null_score < score_null:
                     score_null = feature_null_score
                     min_null_feature_index = feature_index
-                    null_start_logit = result.start_logits[0]
-                    null_end_logit = result.end_logits[0]
-            for start_index in start_indexes:
-                for end_index in end_indexes:
-                    # We could hypothetically create invalid predictions, e.g., predict
-                    # that the start of the span is in the question. We throw out all
-                    # invalid predictions.
-                    if start_index >= len(feature.tokens):
-                        continue
-                    if end_index >= len(feature.tokens):
-                        continue
-                    if start_index not in feature.token_to_orig_map:
-                        continue
-                    if end_index not in feature.token_to_orig_map:
-                        continue
-                    if not feature.token_is_max_context.get(start_index, False):
-                        continue
-                    if end_index < start_index:
-                        continue
-                    length = end_index - start_index + 1
-                    if length > max_answer_length:
-                        continue
-                    prelim_predictions.append(
-                        _PrelimPrediction(
-                            feature_index=feature_index,
-                            start_index=start_index,
-                            end_index=end_index,
-                            start_logit=result.start_logits[start_index],
-                            end_logit=result.end_logits[end_index],
-                        )
-                    )
+                    null_start_logit = float(start_logits[0])
+                    null_end_logit = float(end_logits[0])
+
+            # We could hypothetically create invalid predictions, e.g., predict
+            # that the start of the span is in the question. We throw out all
+            # invalid predictions.
+            num_positions = max(start_logits.size, end_logits.size)
+            num_tokens = len(feature.tokens)
+            is_valid_end = np.zeros(num_positions, dtype=np.bool_)
+            is_valid_end[[i for i in feature.token_to_orig_map if i < min(num_tokens, num_positions)]] = True
+            is_valid_start = np.zeros(num_positions, dtype=np.bool_)
+            is_valid_start[[i for i, v in feature.token_is_max_context.items() if v and i < num_positions]] = True
+            is_valid_start &= is_valid_end
+
+            lengths = end_indexes[np.newaxis, :] - start_indexes[:, np.newaxis] + 1
+            valid_mask = (lengths >= 1) & (lengths <= max_answer_length)
+            valid_mask &= is_valid_start[start_indexes][:, np.newaxis] & is_valid_end[end_indexes][np.newaxis, :]
+            # the pairs are listed in the same order as the nested loop over the start and end indexes
+            start_ranks, end_ranks = np.nonzero(valid_mask)
+
+            prelim_feature_indices.append(np.full(start_ranks.size, feature_index, dtype=np.int64))
+            prelim_start_indices.append(start_indexes[start_ranks])
+            prelim_end_indices.append(end_indexes[end_ranks])
+            prelim_start_logits.append(start_logits[start_indexes[start_ranks]])
+            prelim_end_logits.append(end_logits[end_indexes[end_ranks]])
+
         if version_2_with_negative:
-            prelim_predictions.append(
-                _PrelimPrediction(
-                    feature_index=min_null_feature_index,
-                    start_index=0,
-                    end_index=0,
-                    start_logit=null_start_logit,
-                    end_logit=null_end_logit,
+            prelim_feature_indices.append(np.array([min_null_feature_index], dtype=np.int64))
+            prelim_start_indices.append(np.zeros(1, dtype=np.int64))
+            prelim_end_indices.append(np.zeros(1, dtype=np.int64))
+            prelim_start_logits.append(np.array([null_start_logit], dtype=np.float64))
+            prelim_end_logits.append(np.array([null_end_logit], dtype=np.float64))
+
+        prelim_predictions = []
+        if prelim_feature_indices:
+            prelim_start_logits = np.concatenate(prelim_start_logits)
+            prelim_end_logits = np.concatenate(prelim_end_logits)
+            # stable sort is used to keep the order of the predictions with the same score
+            order = np.argsort(-(prelim_start_logits + prelim_end_logits), kind="stable")
+            prelim_predictions = [
+                _PrelimPrediction(*args)
+                for args in zip(
+                    np.concatenate(prelim_feature_indices)[order].tolist(),
+                    np.concatenate(prelim_start_indices)[order].tolist(),
+                    np.concatenate(prelim_end_indices)[order].tolist(),
+                    prelim_start_logits[order].tolist(),
+                    prelim_end_logits[order].tolist(),
                 )
-            )
-        prelim_predictions = sorted(prelim_predictions, key=lambda x: (x.start_logit + x.end_logit), reverse=True)
+            ]
 
         _NbestPrediction = collections.namedtuple("NbestPrediction", ["text", "start_logit", "end_logit"])
 
@@ -276,14 +292,8 @@ def get_final_text(pred_text, orig_text, do_lower_case, verbose_logging=False):
 
 
 def _get_best_indexes(logits, n_best_size):
-    index_and_score = sorted(enumerate(logits), key=lambda x: x[1], reverse=True)
-
-    best_indexes = []
-    for i in range(len(index_and_score)):
-        if i >= n_best_size:
-            break
-        best_indexes.append(index_and_score[i][0])
-    return best_indexes
+    # stable sort is used to prefer the smaller index among the logits with the same value
+    return np.argsort(-np.asarray(logits), kind="stable")[:n_best_size]
 
 
 def _compute_softmax(scores):
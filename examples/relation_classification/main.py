@@ -13,6 +13,7 @@ from transformers import WEIGHTS_NAME
 from luke.utils.entity_vocab import MASK_TOKEN
 
 from ..utils import set_seed
+from ..utils.quantization import evaluate_quantized_model
 from ..utils.trainer import Trainer, trainer_args
 from .model import LukeForRelationClassification
 from .utils import HEAD_TOKEN, TAIL_TOKEN, convert_examples_to_features, DatasetProcessor
@@ -32,6 +33,7 @@ def cli():
 @click.option("--num-train-epochs", default=5.0)
 @click.option("--do-eval/--no-eval", default=True)
 @click.option("--eval-batch-size", default=128)
+@click.option("--quantize", is_flag=True)
 @click.option("--seed", default=42)
 @trainer_args
 @click.pass_obj
@@ -112,6 +114,9 @@ def run(common_args, **task_args):
             output_file = os.path.join(args.output_dir, f"{eval_set}_predictions.txt")
             results.update({f"{eval_set}_{k}": v for k, v in evaluate(args, model, eval_set, output_file).items()})
 
+        if args.quantize:
+            results.update(evaluate_quantized_model(args, model, evaluate))
+
     logger.info("Results: %s", json.dumps(results, indent=2, sort_keys=True))
     args.experiment.log_metrics(results)
     with open(os.path.join(args.output_dir, "results.json"), "w") as f:
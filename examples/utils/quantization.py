@@ -0,0 +1,31 @@
+import os
+from typing import Callable, Iterable
+
+import torch
+from torch import nn
+
+from luke.utils.quantization import quantize_model
+
+
+def evaluate_quantized_model(
+    args,
+    model: nn.Module,
+    evaluate: Callable,
+    eval_sets: Iterable[str] = ("dev", "test"),
+    output_file_ext: str = ".txt",
+) -> dict:
+    """
+    Quantizes the model into int8 in place and evaluates it on CPU using ``evaluate(args, model, eval_set,
+    output_file)`` to compare its performance with that of the fp32 model. The metrics are prefixed with
+    ``quantized_{eval_set}_``.
+    """
+    model = quantize_model(model, inplace=True)
+    args.device = torch.device("cpu")
+
+    results = {}
+    for eval_set in eval_sets:
+        output_file = os.path.join(args.output_dir, f"quantized_{eval_set}_predictions{output_file_ext}")
+        results.update(
+            {f"quantized_{eval_set}_{k}": v for k, v in evaluate(args, model, eval_set, output_file).items()}
+        )
+    return results
@@ -8,6 +8,9 @@ import torch
 from tqdm import tqdm
 from transformers import WEIGHTS_NAME, AdamW, get_constant_schedule_with_warmup, get_linear_schedule_with_warmup
 
+from luke.model import GRADIENT_CHECKPOINTING_POLICIES
+from luke.utils.mixed_precision import autocast, create_grad_scaler
+
 logger = logging.getLogger(__name__)
 
 
@@ -23,10 +26,10 @@ def trainer_args(func):
     @click.option("--warmup-proportion", default=0.06)
     @click.option("--gradient-accumulation-steps", default=1)
     @click.option("--fp16", is_flag=True)
-    @click.option("--fp16-opt-level", default="O2")
-    @click.option("--fp16-min-loss-scale", default=1)
-    @click.option("--fp16-max-loss-scale", default=4)
+    @click.option("--bf16", is_flag=True)
     @click.option("--save-steps", default=0)
+    @click.option("--gradient-checkpointing", default="none", type=click.Choice(GRADIENT_CHECKPOINTING_POLICIES))
+    @click.option("--gradient-checkpointing-interval", default=1)
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
         return func(*args, **kwargs)
@@ -42,6 +45,11 @@ class Trainer(object):
         self.num_train_steps = num_train_steps
         self.step_callback = step_callback
 
+        if self.args.gradient_checkpointing != "none":
+            model.set_gradient_checkpointing(
+                self.args.gradient_checkpointing, self.args.gradient_checkpointing_interval
+            )
+
         self.optimizer = self._create_optimizer(model)
         self.scheduler = self._create_scheduler(self.optimizer)
 
@@ -49,16 +57,10 @@ class Trainer(object):
         model = self.model
         optimizer = self.optimizer
 
-        if self.args.fp16:
-            from apex import amp
-
-            model, optimizer = amp.initialize(
-                model,
-                optimizer,
-                opt_level=self.args.fp16_opt_level,
-                min_loss_scale=self.args.fp16_min_loss_scale,
-                max_loss_scale=self.args.fp16_max_loss_scale,
-            )
+        if self.args.fp16 and self.args.bf16:
+            raise ValueError("--fp16 and --bf16 cannot be used together")
+        autocast_dtype = torch.float16 if self.args.fp16 else torch.bfloat16 if self.args.bf16 else None
+        grad_scaler = create_grad_scaler(self.args.device, self.args.fp16)
 
         if self.args.local_rank != -1:
             model = torch.nn.parallel.DistributedDataParallel(
@@ -90,27 +92,30 @@ class Trainer(object):
             while True:
                 for step, batch in enumerate(self.dataloader):
                     inputs = {k: v.to(self.args.device) for k, v in self._create_model_arguments(batch).items()}
-                    outputs = model(**inputs)
+                    with autocast(self.args.device, autocast_dtype):
+                        outputs = model(**inputs)
                     loss = outputs[0]
                     if self.args.gradient_accumulation_steps > 1:
                         loss = loss / self.args.gradient_accumulation_steps
 
                     with maybe_no_sync(step):
-                        if self.args.fp16:
-                            with amp.scale_loss(loss, optimizer) as scaled_loss:
-                                scaled_loss.backward()
+                        if grad_scaler is not None:
+                            grad_scaler.scale(loss).backward()
                         else:
                             loss.backward()
 
                     tr_loss += loss.item()
                     if (step + 1) % self.args.gradient_accumulation_steps == 0:
                         if self.args.max_grad_norm != 0.0:
-                            if self.args.fp16:
-                                torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), self.args.max_grad_norm)
-                            else:
-                                torch.nn.utils.clip_grad_norm_(model.parameters(), self.args.max_grad_norm)
+                            if grad_scaler is not None:
+                                grad_scaler.unscale_(optimizer)
+                            torch.nn.utils.clip_grad_norm_(model.parameters(), self.args.max_grad_norm)
 
-                        self.optimizer.step()
+                        if grad_scaler is not None:
+                            grad_scaler.step(optimizer)
+                            grad_scaler.update()
+                        else:
+                            optimizer.step()
                         self.scheduler.step()
                         model.zero_grad()
 
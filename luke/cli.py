@@ -22,6 +22,7 @@ import luke.pretraining.train
 import luke.utils.entity_vocab
 import luke.utils.interwiki_db
 import luke.utils.model_utils
+import luke.utils.quantization
 
 
 @click.group()
@@ -61,6 +62,9 @@ cli.add_command(luke.pretraining.train.start_pretraining_worker)
 cli.add_command(luke.utils.interwiki_db.build_interwiki_db)
 cli.add_command(luke.utils.entity_vocab.build_multilingual_entity_vocab)
 cli.add_command(luke.utils.model_utils.create_model_archive)
+cli.add_command(luke.utils.model_utils.export_model_file)
+cli.add_command(luke.utils.model_utils.clear_model_cache)
+cli.add_command(luke.utils.quantization.quantize_model_file)
 
 
 if __name__ == "__main__":
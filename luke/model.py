@@ -5,6 +5,7 @@ from typing import Dict
 import torch
 import torch.nn.functional as F
 from torch import nn
+from torch.utils.checkpoint import checkpoint
 from transformers.modeling_bert import (
     BertConfig,
     BertEmbeddings,
@@ -13,6 +14,7 @@ from transformers.modeling_bert import (
     BertLayerNorm,
     BertOutput,
     BertPooler,
+    BertSelfAttention,
     BertSelfOutput,
 )
 from transformers.modeling_roberta import RobertaEmbeddings
@@ -20,9 +22,19 @@ from transformers.modeling_roberta import RobertaEmbeddings
 logger = logging.getLogger(__name__)
 
 
+ATTENTION_BACKENDS = ("eager", "sdpa")
+GRADIENT_CHECKPOINTING_POLICIES = ("none", "full", "attention")
+
+
 class LukeConfig(BertConfig):
     def __init__(
-        self, vocab_size: int, entity_vocab_size: int, bert_model_name: str, entity_emb_size: int = None, **kwargs
+        self,
+        vocab_size: int,
+        entity_vocab_size: int,
+        bert_model_name: str,
+        entity_emb_size: int = None,
+        attention_backend: str = "eager",
+        **kwargs
     ):
         super(LukeConfig, self).__init__(vocab_size, **kwargs)
 
@@ -32,6 +44,16 @@ class LukeConfig(BertConfig):
             self.entity_emb_size = self.hidden_size
         else:
             self.entity_emb_size = entity_emb_size
+        self.attention_backend = attention_backend
+
+
+def get_attention_backend(config: BertConfig) -> str:
+    attention_backend = getattr(config, "attention_backend", "eager")
+    if attention_backend not in ATTENTION_BACKENDS:
+        raise ValueError(f"Invalid attention backend: {attention_backend}")
+    if attention_backend == "sdpa" and not hasattr(F, "scaled_dot_product_attention"):
+        raise RuntimeError("The sdpa attention backend requires PyTorch 2.0 or later")
+    return attention_backend
 
 
 class EntityEmbeddings(nn.Module):
@@ -50,20 +72,36 @@ class EntityEmbeddings(nn.Module):
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
 
     def forward(
-        self, entity_ids: torch.LongTensor, position_ids: torch.LongTensor, token_type_ids: torch.LongTensor = None
+        self,
+        entity_ids: torch.LongTensor,
+        position_ids: torch.LongTensor = None,
+        token_type_ids: torch.LongTensor = None,
+        position_spans: torch.LongTensor = None,
     ):
+        """
+        The positions of entities are given either as ``position_ids`` padded with -1 or as ``position_spans``
+        consisting of the start and (exclusive) end positions of contiguous mentions.
+        """
+        # the inputs may be given as narrower integer types to reduce the size of batches
+        entity_ids = entity_ids.long()
         if token_type_ids is None:
             token_type_ids = torch.zeros_like(entity_ids)
+        else:
+            token_type_ids = token_type_ids.long()
 
         entity_embeddings = self.entity_embeddings(entity_ids)
         if self.config.entity_emb_size != self.config.hidden_size:
             entity_embeddings = self.entity_embedding_dense(entity_embeddings)
 
-        position_embeddings = self.position_embeddings(position_ids.clamp(min=0))
-        position_embedding_mask = (position_ids != -1).type_as(position_embeddings).unsqueeze(-1)
-        position_embeddings = position_embeddings * position_embedding_mask
-        position_embeddings = torch.sum(position_embeddings, dim=-2)
-        position_embeddings = position_embeddings / position_embedding_mask.sum(dim=-2).clamp(min=1e-7)
+        if position_spans is not None:
+            position_embeddings = self._compute_span_position_embeddings(position_spans.long())
+        else:
+            position_ids = position_ids.long()
+            position_embeddings = self.position_embeddings(position_ids.clamp(min=0))
+            position_embedding_mask = (position_ids != -1).type_as(position_embeddings).unsqueeze(-1)
+            position_embeddings = position_embeddings * position_embedding_mask
+            position_embeddings = torch.sum(position_embeddings, dim=-2)
+            position_embeddings = position_embeddings / position_embedding_mask.sum(dim=-2).clamp(min=1e-7)
 
         token_type_embeddings = self.token_type_embeddings(token_type_ids)
 
@@ -73,6 +111,45 @@ class EntityEmbeddings(nn.Module):
 
         return embeddings
 
+    def _compute_span_position_embeddings(self, position_spans: torch.LongTensor):
+        # the mean of the position embeddings in each span is computed using the cumulative sum of the embeddings
+        weight = self.position_embeddings.weight
+        cumsum_weight = F.pad(weight.float().cumsum(dim=0), (0, 0, 1, 0))
+        starts = position_spans[..., 0].clamp(min=0, max=weight.size(0))
+        ends = torch.max(position_spans[..., 1].clamp(max=weight.size(0)), starts)
+        position_embeddings = (cumsum_weight[ends] - cumsum_weight[starts]) / (ends - starts).clamp(min=1).unsqueeze(-1)
+        return position_embeddings.type_as(weight)
+
+
+class SdpaBertSelfAttention(BertSelfAttention):
+    """
+    BertSelfAttention computing the attention using the fused ``scaled_dot_product_attention`` function. It falls back
+    to the original implementation if the head mask, cross-attention, or attention probabilities are requested.
+    """
+
+    def forward(self, hidden_states, attention_mask=None, head_mask=None, *args, **kwargs):
+        if head_mask is not None or any(args) or any(kwargs.values()) or getattr(self, "output_attentions", False):
+            return super(SdpaBertSelfAttention, self).forward(hidden_states, attention_mask, head_mask, *args, **kwargs)
+
+        new_x_shape = hidden_states.size()[:-1] + (self.num_attention_heads, self.attention_head_size)
+        query_layer = self.query(hidden_states).view(*new_x_shape).permute(0, 2, 1, 3)
+        key_layer = self.key(hidden_states).view(*new_x_shape).permute(0, 2, 1, 3)
+        value_layer = self.value(hidden_states).view(*new_x_shape).permute(0, 2, 1, 3)
+
+        context_layer = F.scaled_dot_product_attention(
+            query_layer,
+            key_layer,
+            value_layer,
+            attn_mask=attention_mask,
+            dropout_p=self.dropout.p if self.training else 0.0,
+        )
+
+        context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
+        new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
+        context_layer = context_layer.view(*new_context_layer_shape)
+
+        return (context_layer,)
+
 
 class LukeModel(nn.Module):
     def __init__(self, config: LukeConfig):
@@ -81,6 +158,9 @@ class LukeModel(nn.Module):
         self.config = config
 
         self.encoder = BertEncoder(config)
+        if get_attention_backend(config) == "sdpa":
+            for layer in self.encoder.layer:
+                layer.attention.self = SdpaBertSelfAttention(config)
         self.pooler = BertPooler(config)
 
         if self.config.bert_model_name and "roberta" in self.config.bert_model_name:
@@ -90,6 +170,9 @@ class LukeModel(nn.Module):
             self.embeddings = BertEmbeddings(config)
         self.entity_embeddings = EntityEmbeddings(config)
 
+        self.gradient_checkpointing = "none"
+        self.gradient_checkpointing_interval = 1
+
     def forward(
         self,
         word_ids: torch.LongTensor,
@@ -99,17 +182,23 @@ class LukeModel(nn.Module):
         entity_position_ids: torch.LongTensor = None,
         entity_segment_ids: torch.LongTensor = None,
         entity_attention_mask: torch.LongTensor = None,
+        entity_position_spans: torch.LongTensor = None,
     ):
         word_seq_size = word_ids.size(1)
 
-        embedding_output = self.embeddings(word_ids, word_segment_ids)
+        embedding_output = self.embeddings(word_ids.long(), word_segment_ids.long())
 
         attention_mask = self._compute_extended_attention_mask(word_attention_mask, entity_attention_mask)
         if entity_ids is not None:
-            entity_embedding_output = self.entity_embeddings(entity_ids, entity_position_ids, entity_segment_ids)
+            entity_embedding_output = self._compute_entity_embeddings(
+                entity_ids, entity_position_ids, entity_segment_ids, entity_position_spans
+            )
             embedding_output = torch.cat([embedding_output, entity_embedding_output], dim=1)
 
-        encoder_outputs = self.encoder(embedding_output, attention_mask, [None] * self.config.num_hidden_layers)
+        if self.training and self.gradient_checkpointing != "none":
+            encoder_outputs = (self._run_encoder_with_checkpointing(embedding_output, attention_mask),)
+        else:
+            encoder_outputs = self.encoder(embedding_output, attention_mask, [None] * self.config.num_hidden_layers)
         sequence_output = encoder_outputs[0]
         word_sequence_output = sequence_output[:, :word_seq_size, :]
         pooled_output = self.pooler(sequence_output)
@@ -120,6 +209,30 @@ class LukeModel(nn.Module):
         else:
             return (word_sequence_output, pooled_output,) + encoder_outputs[1:]
 
+    def set_gradient_checkpointing(self, policy: str = "full", interval: int = 1):
+        """
+        Enables activation checkpointing during training. The activations of every ``interval``-th encoder layer
+        (``full``) or of its attention sublayer (``attention``) are recomputed in the backward pass.
+        """
+        if policy not in GRADIENT_CHECKPOINTING_POLICIES:
+            raise ValueError(f"Invalid gradient checkpointing policy: {policy}")
+        self.gradient_checkpointing = policy
+        self.gradient_checkpointing_interval = interval
+
+    def _run_encoder_with_checkpointing(self, hidden_states: torch.Tensor, attention_mask: torch.Tensor):
+        for i, layer_module in enumerate(self.encoder.layer):
+            if i % self.gradient_checkpointing_interval != 0:
+                hidden_states = layer_module(hidden_states, attention_mask)[0]
+            elif self.gradient_checkpointing == "full":
+                hidden_states = checkpoint(layer_module, hidden_states, attention_mask, use_reentrant=False)[0]
+            else:
+                attention_output = checkpoint(
+                    layer_module.attention, hidden_states, attention_mask, use_reentrant=False
+                )[0]
+                intermediate_output = layer_module.intermediate(attention_output)
+                hidden_states = layer_module.output(intermediate_output, attention_output)
+        return hidden_states
+
     def init_weights(self, module: nn.Module):
         if isinstance(module, nn.Linear):
             module.weight.data.normal_(mean=0.0, std=self.config.initializer_range)
@@ -177,6 +290,20 @@ class LukeModel(nn.Module):
                 "Error(s) in loading state_dict for {}:\n\t{}".format(self.__class__.__name__, "\n\t".join(error_msgs))
             )
 
+    def _compute_entity_embeddings(
+        self,
+        entity_ids: torch.LongTensor,
+        entity_position_ids: torch.LongTensor,
+        entity_segment_ids: torch.LongTensor,
+        entity_position_spans: torch.LongTensor = None,
+    ):
+        if entity_position_spans is None:
+            # the task models may replace the entity embeddings with those not supporting position spans
+            return self.entity_embeddings(entity_ids, entity_position_ids, entity_segment_ids)
+        return self.entity_embeddings(
+            entity_ids, token_type_ids=entity_segment_ids, position_spans=entity_position_spans
+        )
+
     def _compute_extended_attention_mask(
         self, word_attention_mask: torch.LongTensor, entity_attention_mask: torch.LongTensor
     ):
@@ -205,33 +332,20 @@ class LukeEntityAwareAttentionModel(LukeModel):
         entity_position_ids,
         entity_segment_ids,
         entity_attention_mask,
+        entity_position_spans=None,
     ):
-        word_embeddings = self.embeddings(word_ids, word_segment_ids)
-        entity_embeddings = self.entity_embeddings(entity_ids, entity_position_ids, entity_segment_ids)
+        word_embeddings = self.embeddings(word_ids.long(), word_segment_ids.long())
+        entity_embeddings = self._compute_entity_embeddings(
+            entity_ids, entity_position_ids, entity_segment_ids, entity_position_spans
+        )
         attention_mask = self._compute_extended_attention_mask(word_attention_mask, entity_attention_mask)
 
         return self.encoder(word_embeddings, entity_embeddings, attention_mask)
 
-    def load_state_dict(self, state_dict, *args, **kwargs):
-        new_state_dict = state_dict.copy()
-
-        for num in range(self.config.num_hidden_layers):
-            for attr_name in ("weight", "bias"):
-                if f"encoder.layer.{num}.attention.self.w2e_query.{attr_name}" not in state_dict:
-                    new_state_dict[f"encoder.layer.{num}.attention.self.w2e_query.{attr_name}"] = state_dict[
-                        f"encoder.layer.{num}.attention.self.query.{attr_name}"
-                    ]
-                if f"encoder.layer.{num}.attention.self.e2w_query.{attr_name}" not in state_dict:
-                    new_state_dict[f"encoder.layer.{num}.attention.self.e2w_query.{attr_name}"] = state_dict[
-                        f"encoder.layer.{num}.attention.self.query.{attr_name}"
-                    ]
-                if f"encoder.layer.{num}.attention.self.e2e_query.{attr_name}" not in state_dict:
-                    new_state_dict[f"encoder.layer.{num}.attention.self.e2e_query.{attr_name}"] = state_dict[
-                        f"encoder.layer.{num}.attention.self.query.{attr_name}"
-                    ]
-
-        kwargs["strict"] = False
-        super(LukeEntityAwareAttentionModel, self).load_state_dict(new_state_dict, *args, **kwargs)
+    def set_gradient_checkpointing(self, policy: str = "full", interval: int = 1):
+        super(LukeEntityAwareAttentionModel, self).set_gradient_checkpointing(policy, interval)
+        self.encoder.gradient_checkpointing = policy
+        self.encoder.gradient_checkpointing_interval = interval
 
 
 class EntityAwareSelfAttention(nn.Module):
@@ -242,60 +356,122 @@ class EntityAwareSelfAttention(nn.Module):
         self.attention_head_size = int(config.hidden_size / config.num_attention_heads)
         self.all_head_size = self.num_attention_heads * self.attention_head_size
 
-        self.query = nn.Linear(config.hidden_size, self.all_head_size)
+        # the word-to-word and word-to-entity query projections and the entity-to-word and entity-to-entity query
+        # projections are packed into single projections, respectively
+        self.word_query = nn.Linear(config.hidden_size, 2 * self.all_head_size)
+        self.entity_query = nn.Linear(config.hidden_size, 2 * self.all_head_size)
         self.key = nn.Linear(config.hidden_size, self.all_head_size)
         self.value = nn.Linear(config.hidden_size, self.all_head_size)
 
-        self.w2e_query = nn.Linear(config.hidden_size, self.all_head_size)
-        self.e2w_query = nn.Linear(config.hidden_size, self.all_head_size)
-        self.e2e_query = nn.Linear(config.hidden_size, self.all_head_size)
-
         self.dropout = nn.Dropout(config.attention_probs_dropout_prob)
+        self.attention_backend = get_attention_backend(config)
 
     def transpose_for_scores(self, x):
         new_x_shape = x.size()[:-1] + (self.num_attention_heads, self.attention_head_size)
         return x.view(*new_x_shape).permute(0, 2, 1, 3)
 
-    def forward(self, word_hidden_states, entity_hidden_states, attention_mask):
-        word_size = word_hidden_states.size(1)
-
-        w2w_query_layer = self.transpose_for_scores(self.query(word_hidden_states))
-        w2e_query_layer = self.transpose_for_scores(self.w2e_query(word_hidden_states))
-        e2w_query_layer = self.transpose_for_scores(self.e2w_query(entity_hidden_states))
-        e2e_query_layer = self.transpose_for_scores(self.e2e_query(entity_hidden_states))
-
-        key_layer = self.transpose_for_scores(self.key(torch.cat([word_hidden_states, entity_hidden_states], dim=1)))
-
-        w2w_key_layer = key_layer[:, :, :word_size, :]
-        e2w_key_layer = key_layer[:, :, :word_size, :]
-        w2e_key_layer = key_layer[:, :, word_size:, :]
-        e2e_key_layer = key_layer[:, :, word_size:, :]
-
-        w2w_attention_scores = torch.matmul(w2w_query_layer, w2w_key_layer.transpose(-1, -2))
-        w2e_attention_scores = torch.matmul(w2e_query_layer, w2e_key_layer.transpose(-1, -2))
-        e2w_attention_scores = torch.matmul(e2w_query_layer, e2w_key_layer.transpose(-1, -2))
-        e2e_attention_scores = torch.matmul(e2e_query_layer, e2e_key_layer.transpose(-1, -2))
+    def transpose_packed_query_for_scores(self, x):
+        # [batch, length, 2 * all_head_size] -> two tensors of [batch, heads, length, head_size]
+        new_x_shape = x.size()[:-1] + (2, self.num_attention_heads, self.attention_head_size)
+        return x.view(*new_x_shape).permute(2, 0, 3, 1, 4).unbind(0)
+
+    def forward(self, hidden_states, word_size, attention_mask):
+        word_hidden_states = hidden_states[:, :word_size]
+        entity_hidden_states = hidden_states[:, word_size:]
+
+        # The first half of the query of a word (entity) is used to attend to words and the second half is used to
+        # attend to entities
+        word_query_layer = self.word_query(word_hidden_states)
+        entity_query_layer = self.entity_query(entity_hidden_states)
+        key_layer = self.transpose_for_scores(self.key(hidden_states))
+        value_layer = self.transpose_for_scores(self.value(hidden_states))
+
+        if self.attention_backend == "sdpa":
+            context_layer = self._compute_sdpa_context(
+                word_query_layer, entity_query_layer, key_layer, value_layer, attention_mask
+            )
+        else:
+            context_layer = self._compute_context(
+                word_query_layer, entity_query_layer, key_layer, value_layer, attention_mask
+            )
 
-        word_attention_scores = torch.cat([w2w_attention_scores, w2e_attention_scores], dim=3)
-        entity_attention_scores = torch.cat([e2w_attention_scores, e2e_attention_scores], dim=3)
-        attention_scores = torch.cat([word_attention_scores, entity_attention_scores], dim=2)
+        context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
+        new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
+        context_layer = context_layer.view(*new_context_layer_shape)
 
-        attention_scores = attention_scores / math.sqrt(self.attention_head_size)
-        attention_scores = attention_scores + attention_mask
+        return context_layer
+
+    def _compute_context(self, word_query_layer, entity_query_layer, key_layer, value_layer, attention_mask):
+        # the queries are scaled before computing the scores, and the four blocks of the scores are written directly
+        # into a single preallocated tensor
+        word_size = word_query_layer.size(1)
+        scale = 1.0 / math.sqrt(self.attention_head_size)
+        w2w_query_layer, w2e_query_layer = self.transpose_packed_query_for_scores(word_query_layer * scale)
+        e2w_query_layer, e2e_query_layer = self.transpose_packed_query_for_scores(entity_query_layer * scale)
+
+        word_key_layer = key_layer[:, :, :word_size].transpose(-1, -2)
+        entity_key_layer = key_layer[:, :, word_size:].transpose(-1, -2)
+        attention_scores = w2w_query_layer.new_empty(key_layer.size()[:-1] + (key_layer.size(2),))
+        attention_scores[:, :, :word_size, :word_size] = torch.matmul(w2w_query_layer, word_key_layer)
+        attention_scores[:, :, :word_size, word_size:] = torch.matmul(w2e_query_layer, entity_key_layer)
+        attention_scores[:, :, word_size:, :word_size] = torch.matmul(e2w_query_layer, word_key_layer)
+        attention_scores[:, :, word_size:, word_size:] = torch.matmul(e2e_query_layer, entity_key_layer)
+        attention_scores += attention_mask
 
         attention_probs = F.softmax(attention_scores, dim=-1)
         attention_probs = self.dropout(attention_probs)
 
-        value_layer = self.transpose_for_scores(
-            self.value(torch.cat([word_hidden_states, entity_hidden_states], dim=1))
-        )
-        context_layer = torch.matmul(attention_probs, value_layer)
+        return torch.matmul(attention_probs, value_layer)
+
+    def _compute_sdpa_context(self, word_query_layer, entity_query_layer, key_layer, value_layer, attention_mask):
+        # Each query is the concatenation of its query attending to words and that attending to entities, and each
+        # key is placed in the half of a zero vector of the same size corresponding to its type. The dot products
+        # then contain only the blocks of the entity-aware attention, and are computed by the fused function for the
+        # word queries and the entity queries. The queries are rescaled because the function divides the scores by
+        # the square root of the doubled size.
+        word_size = word_query_layer.size(1)
+        head_size = self.attention_head_size
+        block_key_layer = key_layer.new_zeros(key_layer.size()[:-1] + (2 * head_size,))
+        block_key_layer[:, :, :word_size, :head_size] = key_layer[:, :, :word_size]
+        block_key_layer[:, :, word_size:, head_size:] = key_layer[:, :, word_size:]
+        attention_mask = attention_mask.to(dtype=block_key_layer.dtype)
+
+        context_layer = value_layer.new_empty(value_layer.size())
+        for query_layer, rows in (
+            (word_query_layer, slice(None, word_size)),
+            (entity_query_layer, slice(word_size, None)),
+        ):
+            new_x_shape = query_layer.size()[:-1] + (2, self.num_attention_heads, head_size)
+            query_layer = query_layer.view(*new_x_shape).permute(0, 3, 1, 2, 4).flatten(3) * math.sqrt(2)
+            context_layer[:, :, rows] = F.scaled_dot_product_attention(
+                query_layer,
+                block_key_layer,
+                value_layer,
+                attn_mask=attention_mask,
+                dropout_p=self.dropout.p if self.training else 0.0,
+            )
 
-        context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
-        new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
-        context_layer = context_layer.view(*new_context_layer_shape)
+        return context_layer
 
-        return context_layer[:, :word_size, :], context_layer[:, word_size:, :]
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # pack the query projections stored separately in checkpoints and BERT weights
+        packed_names = (("word_query", ("query", "w2e_query")), ("entity_query", ("e2w_query", "e2e_query")))
+        for name, legacy_names in packed_names:
+            for attr_name in ("weight", "bias"):
+                if prefix + f"{name}.{attr_name}" in state_dict:
+                    continue
+                tensors = [
+                    state_dict.get(prefix + f"{legacy_name}.{attr_name}", state_dict.get(prefix + f"query.{attr_name}"))
+                    for legacy_name in legacy_names
+                ]
+                if all(tensor is not None for tensor in tensors):
+                    state_dict[prefix + f"{name}.{attr_name}"] = torch.cat(tensors)
+
+        for legacy_name in ("query", "w2e_query", "e2w_query", "e2e_query"):
+            for attr_name in ("weight", "bias"):
+                state_dict.pop(prefix + f"{legacy_name}.{attr_name}", None)
+
+        super(EntityAwareSelfAttention, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
 
 class EntityAwareAttention(nn.Module):
@@ -304,12 +480,9 @@ class EntityAwareAttention(nn.Module):
         self.self = EntityAwareSelfAttention(config)
         self.output = BertSelfOutput(config)
 
-    def forward(self, word_hidden_states, entity_hidden_states, attention_mask):
-        word_self_output, entity_self_output = self.self(word_hidden_states, entity_hidden_states, attention_mask)
-        hidden_states = torch.cat([word_hidden_states, entity_hidden_states], dim=1)
-        self_output = torch.cat([word_self_output, entity_self_output], dim=1)
-        output = self.output(self_output, hidden_states)
-        return output[:, : word_hidden_states.size(1), :], output[:, word_hidden_states.size(1) :, :]
+    def forward(self, hidden_states, word_size, attention_mask):
+        self_output = self.self(hidden_states, word_size, attention_mask)
+        return self.output(self_output, hidden_states)
 
 
 class EntityAwareLayer(nn.Module):
@@ -320,15 +493,10 @@ class EntityAwareLayer(nn.Module):
         self.intermediate = BertIntermediate(config)
         self.output = BertOutput(config)
 
-    def forward(self, word_hidden_states, entity_hidden_states, attention_mask):
-        word_attention_output, entity_attention_output = self.attention(
-            word_hidden_states, entity_hidden_states, attention_mask
-        )
-        attention_output = torch.cat([word_attention_output, entity_attention_output], dim=1)
+    def forward(self, hidden_states, word_size, attention_mask):
+        attention_output = self.attention(hidden_states, word_size, attention_mask)
         intermediate_output = self.intermediate(attention_output)
-        layer_output = self.output(intermediate_output, attention_output)
-
-        return layer_output[:, : word_hidden_states.size(1), :], layer_output[:, word_hidden_states.size(1) :, :]
+        return self.output(intermediate_output, attention_output)
 
 
 class EntityAwareEncoder(nn.Module):
@@ -336,9 +504,22 @@ class EntityAwareEncoder(nn.Module):
         super(EntityAwareEncoder, self).__init__()
         self.layer = nn.ModuleList([EntityAwareLayer(config) for _ in range(config.num_hidden_layers)])
 
+        self.gradient_checkpointing = "none"
+        self.gradient_checkpointing_interval = 1
+
     def forward(self, word_hidden_states, entity_hidden_states, attention_mask):
-        for layer_module in self.layer:
-            word_hidden_states, entity_hidden_states = layer_module(
-                word_hidden_states, entity_hidden_states, attention_mask
-            )
-        return word_hidden_states, entity_hidden_states
+        # the hidden states of words and entities are kept in a single tensor and split only at the output
+        word_size = word_hidden_states.size(1)
+        hidden_states = torch.cat([word_hidden_states, entity_hidden_states], dim=1)
+        for i, layer_module in enumerate(self.layer):
+            if not self.training or self.gradient_checkpointing == "none" or i % self.gradient_checkpointing_interval:
+                hidden_states = layer_module(hidden_states, word_size, attention_mask)
+            elif self.gradient_checkpointing == "full":
+                hidden_states = checkpoint(layer_module, hidden_states, word_size, attention_mask, use_reentrant=False)
+            else:
+                attention_output = checkpoint(
+                    layer_module.attention, hidden_states, word_size, attention_mask, use_reentrant=False
+                )
+                intermediate_output = layer_module.intermediate(attention_output)
+                hidden_states = layer_module.output(intermediate_output, attention_output)
+        return hidden_states[:, :word_size, :], hidden_states[:, word_size:, :]
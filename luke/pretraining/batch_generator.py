@@ -1,4 +1,4 @@
-from typing import List, Iterator
+from typing import Dict, List, Iterator, Optional, Tuple
 import functools
 import logging
 import multiprocessing
@@ -9,7 +9,11 @@ import unicodedata
 import numpy as np
 from transformers.tokenization_roberta import RobertaTokenizer
 
-from luke.pretraining.dataset import WikipediaPretrainingDataset
+from luke.pretraining.dataset import (
+    WikipediaPretrainingDataset,
+    convert_entity_position_ids_to_spans,
+    convert_entity_position_spans_to_ids,
+)
 from luke.utils.entity_vocab import MASK_TOKEN
 
 logger = logging.getLogger(__name__)
@@ -17,7 +21,21 @@ logger = logging.getLogger(__name__)
 
 class LukePretrainingBatchGenerator(object):
     """
-    Launch a new process in order to avoid data processing being a bottleneck during training.
+    Launch new processes in order to avoid data processing being a bottleneck during training.
+
+    When ``num_data_workers`` is larger than one, the batches are assigned to the worker processes in a round-robin
+    manner, and each worker has its own output queue. The queues are consumed in the same round-robin order, so the
+    batches are yielded in the same order regardless of the number of workers.
+
+    The batches are transferred through :class:`SharedMemoryBatchQueue`. The arrays of a yielded batch are views of
+    shared memory and are only valid until the next batch is requested.
+
+    If ``max_tokens_per_batch`` is specified, the examples used in each optimization step (i.e.,
+    ``batch_size * gradient_accumulation_steps`` examples) are sorted by their lengths and split into a variable number
+    of batches so that each batch contains at most ``max_tokens_per_batch`` tokens including padding. Each of these
+    batches additionally contains ``batch_weight``, the fraction of the examples of the step in the batch, and
+    ``is_window_end``, which is true for the last batch of the step. The number of examples consumed in each step does
+    not change, so the ``skip`` argument remains consistent with the number of steps.
     """
 
     def __init__(
@@ -32,8 +50,27 @@ class LukePretrainingBatchGenerator(object):
         unmasked_entity_prob: float,
         random_entity_prob: float,
         mask_words_in_entity_span: bool,
+        num_data_workers: int = 1,
+        entity_position_format: str = "dense",
+        max_tokens_per_batch: Optional[int] = None,
+        gradient_accumulation_steps: int = 1,
         **dataset_kwargs
     ):
+        self._num_data_workers = num_data_workers
+
+        dataset = WikipediaPretrainingDataset(dataset_dir)
+        max_num_words = batch_size * dataset.max_seq_length
+        max_num_entities = batch_size * dataset.max_entity_length
+        if max_tokens_per_batch is not None:
+            max_num_words = max(max_num_words, max_tokens_per_batch)
+            max_num_entities = max(max_num_entities, max_tokens_per_batch)
+        # the upper bound of the size of a batch consisting of four word arrays, five entity arrays, and two scalars
+        # of at most 32-bit values, and the padding inserted to align each array
+        self._max_batch_nbytes = (
+            np.dtype(np.int32).itemsize * (4 * max_num_words + max_num_entities * (4 + dataset.max_mention_length))
+            + 8 * 11
+        )
+
         self._worker_func = functools.partial(
             LukePretrainingBatchWorker,
             dataset_dir=dataset_dir,
@@ -46,32 +83,106 @@ class LukePretrainingBatchGenerator(object):
             unmasked_entity_prob=unmasked_entity_prob,
             random_entity_prob=random_entity_prob,
             mask_words_in_entity_span=mask_words_in_entity_span,
+            entity_position_format=entity_position_format,
+            max_tokens_per_batch=max_tokens_per_batch,
+            gradient_accumulation_steps=gradient_accumulation_steps,
             **dataset_kwargs
         )
 
-    def generate_batches(self, queue_size: int = 10000):
-        output_queue = multiprocessing.Queue(queue_size)
-        worker = self._worker_func(output_queue)
-        worker.daemon = True
-        worker.start()
+    def generate_batches(self, queue_size: int = 50):
+        output_queues = []
+        workers = []
+        for data_worker_index in range(self._num_data_workers):
+            # at least two slots are required because the last yielded batch is held by the consumer
+            output_queue = SharedMemoryBatchQueue(max(2, queue_size // self._num_data_workers), self._max_batch_nbytes)
+            worker = self._worker_func(
+                output_queue, num_data_workers=self._num_data_workers, data_worker_index=data_worker_index
+            )
+            worker.daemon = True
+            worker.start()
+            output_queues.append(output_queue)
+            workers.append(worker)
 
         try:
+            data_worker_index = 0
             while True:
                 try:
-                    yield output_queue.get(True, 1)
+                    batch = output_queues[data_worker_index].get(True, 1)
                 except queue.Empty:
                     logger.debug("Queue is empty")
-                    if not worker.is_alive():
+                    if not workers[data_worker_index].is_alive():
                         raise RuntimeError("Worker exited unexpectedly")
+                    continue
+
+                # move on to the next worker when all batches of the current optimization step are consumed
+                if is_window_end(batch):
+                    data_worker_index = (data_worker_index + 1) % self._num_data_workers
+                yield batch
         finally:
-            worker.terminate()
-            output_queue.close()
+            for worker in workers:
+                worker.terminate()
+            for output_queue in output_queues:
+                output_queue.close()
+
+
+class SharedMemoryBatchQueue(object):
+    """
+    A queue that transfers batches of NumPy arrays between processes through a fixed number of preallocated shared
+    memory slots. The producer blocks when all slots are in use. The arrays returned by :meth:`get` are views of a slot,
+    and the slot is returned to the producer when :meth:`get` is called again. Batches that do not fit into a slot
+    are pickled and sent through the underlying queue.
+    """
+
+    def __init__(self, num_slots: int, slot_nbytes: int):
+        self._slot_nbytes = slot_nbytes
+        self._slots = [multiprocessing.RawArray("b", slot_nbytes) for _ in range(num_slots)]
+        self._free_slot_queue = multiprocessing.Queue()
+        for slot_index in range(num_slots):
+            self._free_slot_queue.put(slot_index)
+        self._ready_queue = multiprocessing.Queue()
+        self._current_slot_index = None
+
+    def put(self, batch: Dict[str, np.ndarray], block: bool = True):
+        layout = []
+        offset = 0
+        for key, arr in batch.items():
+            layout.append((key, arr.dtype.str, arr.shape, offset))
+            offset += -(-arr.nbytes // 8) * 8  # align to eight bytes
+
+        if offset > self._slot_nbytes:
+            self._ready_queue.put((None, batch))
+            return
+
+        slot_index = self._free_slot_queue.get(block)
+        for (key, dtype, shape, offset), arr in zip(layout, batch.values()):
+            self._get_view(slot_index, dtype, shape, offset)[...] = arr
+        self._ready_queue.put((slot_index, layout))
+
+    def get(self, block: bool = True, timeout: float = None) -> Dict[str, np.ndarray]:
+        if self._current_slot_index is not None:
+            self._free_slot_queue.put(self._current_slot_index)
+            self._current_slot_index = None
+
+        slot_index, data = self._ready_queue.get(block, timeout)
+        if slot_index is None:
+            return data
+
+        self._current_slot_index = slot_index
+        return {key: self._get_view(slot_index, dtype, shape, offset) for key, dtype, shape, offset in data}
+
+    def close(self):
+        self._free_slot_queue.close()
+        self._ready_queue.close()
+
+    def _get_view(self, slot_index: int, dtype: str, shape: Tuple[int, ...], offset: int) -> np.ndarray:
+        count = int(np.prod(shape, dtype=np.int64))
+        return np.frombuffer(self._slots[slot_index], dtype=dtype, count=count, offset=offset).reshape(shape)
 
 
 class LukePretrainingBatchWorker(multiprocessing.Process):
     def __init__(
         self,
-        output_queue: multiprocessing.Queue,
+        output_queue: SharedMemoryBatchQueue,
         dataset_dir: str,
         batch_size: int,
         masked_lm_prob: float,
@@ -82,6 +193,11 @@ class LukePretrainingBatchWorker(multiprocessing.Process):
         unmasked_entity_prob: float,
         random_entity_prob: float,
         mask_words_in_entity_span: bool,
+        num_data_workers: int = 1,
+        data_worker_index: int = 0,
+        entity_position_format: str = "dense",
+        max_tokens_per_batch: Optional[int] = None,
+        gradient_accumulation_steps: int = 1,
         **dataset_kwargs
     ):
         super(LukePretrainingBatchWorker, self).__init__()
@@ -97,12 +213,34 @@ class LukePretrainingBatchWorker(multiprocessing.Process):
         self._unmasked_entity_prob = unmasked_entity_prob
         self._random_entity_prob = random_entity_prob
         self._mask_words_in_entity_span = mask_words_in_entity_span
+        self._num_data_workers = num_data_workers
+        self._data_worker_index = data_worker_index
+        self._entity_position_format = entity_position_format
+        self._max_tokens_per_batch = max_tokens_per_batch
         self._dataset_kwargs = dataset_kwargs
 
+        if max_tokens_per_batch is None:
+            self._window_size = batch_size
+        else:
+            self._window_size = batch_size * gradient_accumulation_steps
+
         if "shuffle_buffer_size" not in self._dataset_kwargs:
             self._dataset_kwargs["shuffle_buffer_size"] = batch_size * 1000
 
     def run(self):
+        # the random state depends on the position in the data stream so that resumed training is reproducible
+        skip = self._dataset_kwargs.get("skip", 0)
+        np.random.seed(
+            [
+                self._dataset_kwargs.get("shuffle_seed", 0),
+                self._dataset_kwargs.get("worker_index", 0),
+                self._data_worker_index,
+                skip % 2 ** 32,
+                skip // 2 ** 32,
+            ]
+        )
+        random.seed(np.random.randint(2 ** 31))
+
         self._pretraining_dataset = WikipediaPretrainingDataset(self._dataset_dir)
         self._tokenizer = self._pretraining_dataset.tokenizer
         self._entity_vocab = self._pretraining_dataset.entity_vocab
@@ -118,120 +256,130 @@ class LukePretrainingBatchWorker(multiprocessing.Process):
             MASK_TOKEN, self._pretraining_dataset.language
         )
 
+        # whether each token in the vocabulary continues the preceding word
+        self._is_subword_table = np.array(
+            [
+                self._is_subword(token)
+                for token in self._tokenizer.convert_ids_to_tokens(list(range(len(self._tokenizer))))
+            ],
+            dtype=np.bool_,
+        )
+
         buf = []
-        max_word_len = 1
-        max_entity_len = 1
-        for item in self._pretraining_dataset.create_iterator(**self._dataset_kwargs):
+        for item in self._pretraining_dataset.create_iterator(
+            num_data_workers=self._num_data_workers,
+            data_worker_index=self._data_worker_index,
+            window_size=self._window_size,
+            **self._dataset_kwargs
+        ):
+            if "entity_position_spans" in item:
+                entity_position_spans = item["entity_position_spans"]
+            else:
+                entity_position_spans = convert_entity_position_ids_to_spans(item["entity_position_ids"])
             entity_feat, masked_entity_positions = self._create_entity_features(
-                item["entity_ids"], item["entity_position_ids"]
+                item["entity_ids"], entity_position_spans
             )
-            word_feat = self._create_word_features(item["word_ids"], masked_entity_positions)
-
-            max_word_len = max(max_word_len, item["word_ids"].size + 2)  # 2 for [CLS] and [SEP]
-            max_entity_len = max(max_entity_len, item["entity_ids"].size)
-            buf.append((word_feat, entity_feat, item["page_id"]))
+            buf.append((item["word_ids"], item["entity_ids"].size, masked_entity_positions, entity_feat))
 
-            if len(buf) == self._batch_size:
-                batch = {}
-                batch.update({k: np.stack([o[0][k][:max_word_len] for o in buf]) for k in buf[0][0].keys()})
-                batch.update({k: np.stack([o[1][k][:max_entity_len] for o in buf]) for k in buf[0][1].keys()})
-                self._output_queue.put(batch, True)
+            if len(buf) == self._window_size:
+                if self._max_tokens_per_batch is None:
+                    self._output_queue.put(self._create_batch(buf), True)
+                else:
+                    batch_indices_list = split_into_token_budget_batches(
+                        np.array([o[0].size + 2 for o in buf]),  # 2 for [CLS] and [SEP]
+                        np.array([o[1] for o in buf]),
+                        self._max_tokens_per_batch,
+                    )
+                    for i, batch_indices in enumerate(batch_indices_list):
+                        batch = self._create_batch([buf[index] for index in batch_indices])
+                        batch["batch_weight"] = np.array(len(batch_indices) / len(buf), dtype=np.float32)
+                        batch["is_window_end"] = np.array(i == len(batch_indices_list) - 1)
+                        self._output_queue.put(batch, True)
 
                 buf = []
-                max_word_len = 1
-                max_entity_len = 1
 
-    def _create_word_features(self, word_ids: np.ndarray, masked_entity_positions: List[List[int]]):
-        output_word_ids = np.full(self._max_seq_length, self._pad_id, dtype=np.int)
-        output_word_ids[: word_ids.size + 2] = np.concatenate([[self._cls_id], word_ids, [self._sep_id]])
-        word_attention_mask = np.zeros(self._max_seq_length, dtype=np.int)
-        word_attention_mask[: word_ids.size + 2] = 1
+    def _create_batch(self, buf: list):
+        max_word_len = max(1, max(o[0].size + 2 for o in buf))  # 2 for [CLS] and [SEP]
+        max_entity_len = max(1, max(o[1] for o in buf))
+
+        word_feat = self._create_word_features([o[0] for o in buf], [o[2] for o in buf])
+        batch = {}
+        batch.update({k: v[:, :max_word_len] for k, v in word_feat.items()})
+        batch.update({k: np.stack([o[3][k][:max_entity_len] for o in buf]) for k in buf[0][3].keys()})
+        return batch
+
+    def _create_word_features(
+        self, word_ids_list: List[np.ndarray], masked_entity_positions_list: List[List[List[int]]]
+    ):
+        batch_size = len(word_ids_list)
+        word_lengths = np.array([word_ids.size for word_ids in word_ids_list])
+
+        output_word_ids = np.full((batch_size, self._max_seq_length), self._pad_id, dtype=np.int32)
+        word_attention_mask = np.zeros((batch_size, self._max_seq_length), dtype=np.uint8)
+        for i, word_ids in enumerate(word_ids_list):
+            output_word_ids[i, : word_ids.size + 2] = np.concatenate([[self._cls_id], word_ids, [self._sep_id]])
+            word_attention_mask[i, : word_ids.size + 2] = 1
 
         ret = dict(
             word_ids=output_word_ids,
             word_attention_mask=word_attention_mask,
-            word_segment_ids=np.zeros(self._max_seq_length, dtype=np.int),
+            word_segment_ids=np.zeros((batch_size, self._max_seq_length), dtype=np.uint8),
         )
 
         if self._masked_lm_prob != 0.0:
-            num_masked_words = 0
-            masked_lm_labels = np.full(self._max_seq_length, -1, dtype=np.int)
-
-            def perform_masking(indices: List[int]):
-                p = random.random()
-                for index in indices:
-                    masked_lm_labels[index] = output_word_ids[index]
-                    if p < (1.0 - self._random_word_prob - self._unmasked_word_prob):
-                        output_word_ids[index] = self._mask_id
-                    elif p < (1.0 - self._unmasked_word_prob):
-                        output_word_ids[index] = random.randint(self._pad_id + 1, self._tokenizer.vocab_size - 1)
-
-            masked_entity_positions_set = frozenset()
+            entity_span_ids = None
             if self._mask_words_in_entity_span:
-                for indices in masked_entity_positions:
-                    perform_masking(indices)
-                    num_masked_words += len(indices)
-                masked_entity_positions_set = frozenset([p for li in masked_entity_positions for p in li])
-
-            num_to_predict = max(1, int(round(word_ids.size * self._masked_lm_prob)))
-            candidate_word_indices = []
-
-            for i, word in enumerate(self._tokenizer.convert_ids_to_tokens(word_ids), 1):  # 1 for [CLS]
-                if self._whole_word_masking and self._is_subword(word) and candidate_word_indices:
-                    candidate_word_indices[-1].append(i)
-                else:
-                    candidate_word_indices.append([i])
-
-            candidate_word_indices = [
-                indices
-                for indices in candidate_word_indices
-                if all(ind not in masked_entity_positions_set for ind in indices)
-            ]
-
-            for i in np.random.permutation(len(candidate_word_indices)):
-                indices_to_mask = candidate_word_indices[i]
-                if len(indices_to_mask) > num_to_predict - num_masked_words:
-                    continue
-
-                perform_masking(indices_to_mask)
-                num_masked_words += len(indices_to_mask)
-
-                if num_masked_words == num_to_predict:
-                    break
-
-            # If whole-word-masking is enabled, it is possible that no word cannot be selected for masking.
-            # To deal with this, we randomly select one (sub-)word for masking if num_masked_words is zero.
-            if num_masked_words == 0:
-                random_index = random.randint(1, word_ids.size - 2)
-                masked_lm_labels[random_index] = output_word_ids[random_index]
-                output_word_ids[random_index] = self._mask_id
-
-            ret["masked_lm_labels"] = masked_lm_labels
+                entity_span_ids = np.full((batch_size, self._max_seq_length), -1, dtype=np.int32)
+                for i, masked_entity_positions in enumerate(masked_entity_positions_list):
+                    for span_index, indices in enumerate(masked_entity_positions):
+                        entity_span_ids[i, indices] = span_index
+
+            ret["masked_lm_labels"] = mask_word_ids(
+                output_word_ids,
+                word_lengths,
+                self._is_subword_table,
+                masked_lm_prob=self._masked_lm_prob,
+                whole_word_masking=self._whole_word_masking,
+                mask_id=self._mask_id,
+                random_word_prob=self._random_word_prob,
+                unmasked_word_prob=self._unmasked_word_prob,
+                random_word_id_range=(self._pad_id + 1, self._tokenizer.vocab_size),
+                entity_span_ids=entity_span_ids,
+            )
 
         return ret
 
-    def _create_entity_features(self, entity_ids: np.ndarray, entity_position_ids: np.ndarray):
-        output_entity_ids = np.zeros(self._max_entity_length, dtype=np.int)
+    def _create_entity_features(self, entity_ids: np.ndarray, entity_position_spans: np.ndarray):
+        output_entity_ids = np.zeros(self._max_entity_length, dtype=np.int32)
         output_entity_ids[: entity_ids.size] = entity_ids
 
-        entity_attention_mask = np.zeros(self._max_entity_length, dtype=np.int)
+        entity_attention_mask = np.zeros(self._max_entity_length, dtype=np.uint8)
         entity_attention_mask[: entity_ids.size] = 1
 
-        entity_position_ids += entity_position_ids != -1  # +1 for [CLS]
-        output_entity_position_ids = np.full((self._max_entity_length, self._max_mention_length), -1, dtype=np.int)
-        output_entity_position_ids[: entity_position_ids.shape[0]] = entity_position_ids
+        entity_position_spans = entity_position_spans + 1  # +1 for [CLS]
 
         ret = dict(
             entity_ids=output_entity_ids,
-            entity_position_ids=output_entity_position_ids,
             entity_attention_mask=entity_attention_mask,
-            entity_segment_ids=np.zeros(self._max_entity_length, dtype=np.int),
+            entity_segment_ids=np.zeros(self._max_entity_length, dtype=np.uint8),
         )
+        if self._entity_position_format == "span":
+            output_entity_position_spans = np.zeros((self._max_entity_length, 2), dtype=np.int32)
+            output_entity_position_spans[: entity_ids.size] = entity_position_spans
+            ret["entity_position_spans"] = output_entity_position_spans
+        else:
+            output_entity_position_ids = np.full(
+                (self._max_entity_length, self._max_mention_length), -1, dtype=np.int32
+            )
+            output_entity_position_ids[: entity_ids.size] = convert_entity_position_spans_to_ids(
+                entity_position_spans, self._max_mention_length
+            )
+            ret["entity_position_ids"] = output_entity_position_ids
 
         masked_positions = []
         if self._masked_entity_prob != 0.0:
             num_to_predict = max(1, int(round(entity_ids.size * self._masked_entity_prob)))
-            masked_entity_labels = np.full(self._max_entity_length, -1, dtype=np.int)
+            masked_entity_labels = np.full(self._max_entity_length, -1, dtype=np.int32)
             for index in np.random.permutation(range(entity_ids.size))[:num_to_predict]:
                 p = random.random()
                 masked_entity_labels[index] = entity_ids[index]
@@ -240,7 +388,7 @@ class LukePretrainingBatchWorker(multiprocessing.Process):
                 elif p < (1.0 - self._unmasked_entity_prob):
                     output_entity_ids[index] = random.randint(self._entity_mask_id + 1, self._entity_vocab.size - 1)
 
-                masked_positions.append([int(p) for p in entity_position_ids[index] if p != -1])
+                masked_positions.append(list(range(*entity_position_spans[index])))
 
             ret["masked_entity_labels"] = masked_entity_labels
 
@@ -271,6 +419,132 @@ class LukePretrainingBatchWorker(multiprocessing.Process):
         return False
 
 
+def is_window_end(batch: Dict[str, np.ndarray]) -> bool:
+    """
+    Returns whether the batch is the last batch of an optimization step. Batches that are not created based on the
+    number of tokens always correspond to a single step of gradient accumulation.
+    """
+    return bool(batch.get("is_window_end", True))
+
+
+def split_into_token_budget_batches(
+    word_lengths: np.ndarray, entity_lengths: np.ndarray, max_tokens_per_batch: int
+) -> List[np.ndarray]:
+    """
+    Groups examples of similar lengths into batches so that the number of tokens of each batch including padding (i.e.,
+    the batch size multiplied by the sum of the maximum word and entity lengths) does not exceed
+    ``max_tokens_per_batch``. An example longer than ``max_tokens_per_batch`` forms a batch by itself.
+    """
+    order = np.lexsort((entity_lengths, word_lengths + entity_lengths))
+    batches = []
+    batch_start = 0
+    max_word_len = max_entity_len = 0
+    for i, index in enumerate(order):
+        new_max_word_len = max(max_word_len, word_lengths[index])
+        new_max_entity_len = max(max_entity_len, entity_lengths[index])
+        if i > batch_start and (i - batch_start + 1) * (new_max_word_len + new_max_entity_len) > max_tokens_per_batch:
+            batches.append(order[batch_start:i])
+            batch_start = i
+            new_max_word_len = word_lengths[index]
+            new_max_entity_len = entity_lengths[index]
+        max_word_len = new_max_word_len
+        max_entity_len = new_max_entity_len
+
+    batches.append(order[batch_start:])
+    return batches
+
+
+def mask_word_ids(
+    word_ids: np.ndarray,
+    word_lengths: np.ndarray,
+    is_subword_table: np.ndarray,
+    masked_lm_prob: float,
+    whole_word_masking: bool,
+    mask_id: int,
+    random_word_prob: float,
+    unmasked_word_prob: float,
+    random_word_id_range: Tuple[int, int],
+    entity_span_ids: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Performs masked language modeling masking on a batch of word IDs in place and returns the labels.
+
+    ``word_ids`` is a ``[batch, seq]`` array in which each row starts with [CLS] followed by ``word_lengths[i]`` words.
+    Words are grouped into whole words using ``is_subword_table``, which maps each token ID to whether the token
+    continues the preceding word. Whole words are visited in a random order and masked if they fit into the remaining
+    budget of ``round(word_length * masked_lm_prob)`` tokens. A masked whole word is replaced by the mask token, a
+    random token, or kept unchanged according to a single random draw per word.
+
+    If ``entity_span_ids`` is given, each position covered by a masked entity holds the index of the entity
+    (otherwise -1). These positions are always masked, count towards the budget, and are excluded from the candidates.
+    """
+    batch_size, seq_length = word_ids.shape
+    rows = np.arange(batch_size)[:, None]
+    positions = np.arange(seq_length)[None, :]
+
+    is_word = (positions >= 1) & (positions <= word_lengths[:, None])
+    is_word_start = is_word
+    if whole_word_masking:
+        # the first word always starts a new whole word even if it is a subword
+        is_word_start = is_word & ~(is_subword_table[word_ids] & (positions >= 2))
+    group_ids = np.maximum(np.cumsum(is_word_start, axis=1) - 1, 0)
+    num_groups = max(int(is_word_start.sum(axis=1).max()), 1)
+
+    flat_group_ids = (rows * num_groups + group_ids)[is_word]
+    group_lengths = np.bincount(flat_group_ids, minlength=batch_size * num_groups).reshape(batch_size, num_groups)
+    group_probs = np.random.random((batch_size, num_groups))
+    position_probs = group_probs[rows, group_ids]
+
+    masked = np.zeros(word_ids.shape, dtype=np.bool_)
+    candidate_lengths = group_lengths
+    if entity_span_ids is not None:
+        in_entity_span = is_word & (entity_span_ids != -1)
+        span_probs = np.random.random((batch_size, max(int(entity_span_ids.max()) + 1, 1)))
+        position_probs = np.where(in_entity_span, span_probs[rows, np.maximum(entity_span_ids, 0)], position_probs)
+        masked |= in_entity_span
+
+        num_excluded_words = np.bincount(
+            flat_group_ids, weights=in_entity_span[is_word], minlength=batch_size * num_groups
+        ).reshape(batch_size, num_groups)
+        candidate_lengths = np.where(num_excluded_words > 0, 0, group_lengths)
+
+    num_to_predict = np.maximum(1, np.round(word_lengths * masked_lm_prob).astype(np.int64))
+    remaining = num_to_predict - masked.sum(axis=1)
+
+    # visit the whole words in a random order and greedily select the ones that fit into the remaining budget
+    order = np.argsort(np.random.random((batch_size, num_groups)), axis=1)
+    sorted_lengths = np.take_along_axis(candidate_lengths, order, axis=1)
+    selected = np.zeros((batch_size, num_groups), dtype=np.bool_)
+    for rank in range(num_groups):
+        if not (remaining > 0).any():
+            break
+        lengths = sorted_lengths[:, rank]
+        accepted = (lengths > 0) & (lengths <= remaining)
+        selected[accepted, order[accepted, rank]] = True
+        remaining -= lengths * accepted
+
+    masked |= is_word & selected[rows, group_ids]
+
+    masked_lm_labels = np.full(word_ids.shape, -1, dtype=word_ids.dtype)
+    masked_lm_labels[masked] = word_ids[masked]
+
+    replaced_with_mask = masked & (position_probs < 1.0 - random_word_prob - unmasked_word_prob)
+    replaced_with_random = masked & ~replaced_with_mask & (position_probs < 1.0 - unmasked_word_prob)
+    word_ids[replaced_with_mask] = mask_id
+    word_ids[replaced_with_random] = np.random.randint(*random_word_id_range, size=int(replaced_with_random.sum()))
+
+    # If whole-word-masking is enabled, it is possible that no word cannot be selected for masking.
+    # To deal with this, we randomly select one (sub-)word for masking if no word is masked.
+    unmasked_rows = np.flatnonzero(~masked.any(axis=1))
+    if unmasked_rows.size:
+        random_indices = 1 + (np.random.random(unmasked_rows.size) * (word_lengths[unmasked_rows] - 2)).astype(np.int64)
+        random_indices = np.maximum(random_indices, 1)
+        masked_lm_labels[unmasked_rows, random_indices] = word_ids[unmasked_rows, random_indices]
+        word_ids[unmasked_rows, random_indices] = mask_id
+
+    return masked_lm_labels
+
+
 class MultilingualBatchGenerator(LukePretrainingBatchGenerator):
     """
     Launch a new process in order to avoid data processing being a bottleneck during training.
@@ -290,6 +564,10 @@ class MultilingualBatchGenerator(LukePretrainingBatchGenerator):
         unmasked_entity_prob: float,
         random_entity_prob: float,
         mask_words_in_entity_span: bool,
+        num_data_workers: int = 1,
+        entity_position_format: str = "dense",
+        max_tokens_per_batch: Optional[int] = None,
+        gradient_accumulation_steps: int = 1,
         **dataset_kwargs
     ):
 
@@ -305,13 +583,17 @@ class MultilingualBatchGenerator(LukePretrainingBatchGenerator):
                 unmasked_entity_prob=unmasked_entity_prob,
                 random_entity_prob=random_entity_prob,
                 mask_words_in_entity_span=mask_words_in_entity_span,
+                num_data_workers=num_data_workers,
+                entity_position_format=entity_position_format,
+                max_tokens_per_batch=max_tokens_per_batch,
+                gradient_accumulation_steps=gradient_accumulation_steps,
                 **dataset_kwargs
             )
             for dataset_dir in dataset_dir_list
         ]
         self.sampling_rate = self.get_sampling_rate(dataset_size_list, sampling_smoothing_factor)
 
-    def generate_batches(self, queue_size: int = 10000):
+    def generate_batches(self, queue_size: int = 50):
         batch_iterators = [g.generate_batches(queue_size) for g in self.batch_generator_list]
         yield from self.sampling_from_iterators(batch_iterators, sampling_rate=self.sampling_rate)
 
@@ -330,10 +612,16 @@ class MultilingualBatchGenerator(LukePretrainingBatchGenerator):
     def sampling_from_iterators(iterators: List[Iterator], sampling_rate: List[float]):
         """
         Randomly choose an iterator according to ``sampling_rate``, and yield an element from it.
+        All batches of an optimization step are taken from the same iterator.
         """
         while True:
             g = np.random.choice(iterators, p=sampling_rate)
             try:
-                yield next(g)
+                while True:
+                    batch = next(g)
+                    window_end = is_window_end(batch)
+                    yield batch
+                    if window_end:
+                        break
             except StopIteration:
                 break
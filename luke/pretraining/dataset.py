@@ -7,11 +7,10 @@ import random
 import re
 from contextlib import closing
 from multiprocessing.pool import Pool
+from typing import List
 
 import click
-import tensorflow as tf
-from tensorflow.io import TFRecordWriter
-from tensorflow.train import Int64List
+import numpy as np
 from transformers import PreTrainedTokenizer, RobertaTokenizer
 from tqdm import tqdm
 from wikipedia2vec.dump_db import DumpDB
@@ -22,10 +21,12 @@ from luke.utils.model_utils import METADATA_FILE, ENTITY_VOCAB_FILE, get_entity_
 from luke.utils.word_tokenizer import AutoTokenizer
 
 DATASET_FILE = "dataset.tf"
+NUMPY_SHARD_DIR = "shards"
 
 # global variables used in pool workers
 _dump_db = _tokenizer = _sentence_tokenizer = _entity_vocab = _max_num_tokens = _max_entity_length = None
 _max_mention_length = _min_sentence_length = _include_sentences_without_entities = _include_unk_entities = None
+_dataset_format = None
 
 
 @click.command()
@@ -43,6 +44,8 @@ _max_mention_length = _min_sentence_length = _include_sentences_without_entities
 @click.option("--pool-size", default=multiprocessing.cpu_count())
 @click.option("--chunk-size", default=100)
 @click.option("--max-num-documents", default=None, type=int)
+@click.option("--dataset-format", type=click.Choice(["numpy", "tfrecord"]), default="numpy")
+@click.option("--shard-size", default=100000)
 def build_wikipedia_pretraining_dataset(
     dump_db_file: str, tokenizer_name: str, entity_vocab_file: str, output_dir: str, sentence_tokenizer: str, **kwargs
 ):
@@ -82,6 +85,11 @@ class WikipediaPretrainingDataset(object):
     def language(self):
         return self.metadata.get("language", None)
 
+    @property
+    def dataset_format(self):
+        # datasets built before the NumPy shard format was introduced do not have this field
+        return self.metadata.get("dataset_format", "tfrecord")
+
     @property
     def tokenizer(self):
         tokenizer_class_name = self.metadata.get("tokenizer_class", "")
@@ -105,7 +113,110 @@ class WikipediaPretrainingDataset(object):
         shuffle_buffer_size: int = 1000,
         shuffle_seed: int = 0,
         num_parallel_reads: int = 10,
+        num_data_workers: int = 1,
+        data_worker_index: int = 0,
+        window_size: int = 1,
+    ):
+        """
+        The stream is first sharded across the training processes using ``num_workers`` and ``worker_index``. The
+        resulting stream is then split into windows of ``window_size`` items, and the windows are assigned to the data
+        workers of the process in a round-robin manner using ``num_data_workers`` and ``data_worker_index``. The items
+        of the windows assigned to other data workers are not decoded.
+        """
+        if self.dataset_format == "numpy":
+            return self._create_numpy_iterator(
+                skip,
+                num_workers,
+                worker_index,
+                shuffle_buffer_size,
+                shuffle_seed,
+                num_data_workers,
+                data_worker_index,
+                window_size,
+            )
+        else:
+            return self._create_tfrecord_iterator(
+                skip,
+                num_workers,
+                worker_index,
+                shuffle_buffer_size,
+                shuffle_seed,
+                num_parallel_reads,
+                num_data_workers,
+                data_worker_index,
+                window_size,
+            )
+
+    def _create_numpy_iterator(
+        self,
+        skip: int,
+        num_workers: int,
+        worker_index: int,
+        shuffle_buffer_size: int,
+        shuffle_seed: int,
+        num_data_workers: int,
+        data_worker_index: int,
+        window_size: int,
+    ):
+        """
+        Iterates over the NumPy shards in a random order. The items are split into blocks of ``shuffle_buffer_size``
+        consecutive items, and the order of the blocks and that of the items in each block are reshuffled at every
+        epoch using ``shuffle_seed`` and the epoch as the seed. The memory used for shuffling therefore does not grow
+        with the number of items, and the same ``skip`` always resumes from the same position in the stream. As in the
+        TFRecord iterator, ``skip`` is applied before the stream is sharded across workers. Unlike the TFRecord
+        iterator, the positions of entities are yielded as ``entity_position_spans``.
+        """
+        shard_dir = os.path.join(self._dataset_dir, NUMPY_SHARD_DIR)
+        shards = [NumpyShard(shard_dir, index) for index in range(len(self.metadata["shard_sizes"]))]
+        shard_offsets = np.cumsum([0] + self.metadata["shard_sizes"])
+        num_items = len(self)
+        if num_items == 0:
+            return
+
+        num_blocks = -(-num_items // shuffle_buffer_size)
+        epoch = None
+        block_order = block_sizes = block_offsets = None
+        block_rank = None
+        block_permutation = None
+        window_index = data_worker_index
+        while True:
+            for n in range(window_index * window_size, (window_index + 1) * window_size):
+                position = skip + worker_index + n * num_workers
+                if position // num_items != epoch:
+                    epoch = position // num_items
+                    block_order = np.random.RandomState(shuffle_seed + epoch).permutation(num_blocks)
+                    block_sizes = np.minimum(shuffle_buffer_size, num_items - block_order * shuffle_buffer_size)
+                    block_offsets = np.cumsum(np.concatenate([[0], block_sizes]))
+                    block_rank = None
+
+                epoch_position = position % num_items
+                rank = np.searchsorted(block_offsets, epoch_position, side="right") - 1
+                if rank != block_rank:
+                    block_rank = rank
+                    block_seed = [shuffle_seed, epoch, block_order[rank]]
+                    block_permutation = np.random.RandomState(block_seed).permutation(block_sizes[rank])
+
+                block_position = epoch_position - block_offsets[rank]
+                index = block_order[rank] * shuffle_buffer_size + block_permutation[block_position]
+                shard_index = np.searchsorted(shard_offsets, index, side="right") - 1
+                yield shards[shard_index][index - shard_offsets[shard_index]]
+
+            window_index += num_data_workers
+
+    def _create_tfrecord_iterator(
+        self,
+        skip: int,
+        num_workers: int,
+        worker_index: int,
+        shuffle_buffer_size: int,
+        shuffle_seed: int,
+        num_parallel_reads: int,
+        num_data_workers: int,
+        data_worker_index: int,
+        window_size: int,
     ):
+        import tensorflow as tf
+
         features = dict(
             word_ids=tf.io.FixedLenSequenceFeature([], tf.int64, allow_missing=True),
             entity_ids=tf.io.FixedLenSequenceFeature([], tf.int64, allow_missing=True),
@@ -121,6 +232,9 @@ class WikipediaPretrainingDataset(object):
         dataset = dataset.shuffle(shuffle_buffer_size, seed=shuffle_seed)
         dataset = dataset.skip(skip)
         dataset = dataset.shard(num_workers, worker_index)
+        if num_data_workers > 1:
+            # the serialized records are grouped into windows so that only the owned windows are parsed
+            dataset = dataset.batch(window_size).shard(num_data_workers, data_worker_index).unbatch()
         dataset = dataset.map(functools.partial(tf.io.parse_single_example, features=features))
         it = tf.compat.v1.data.make_one_shot_iterator(dataset)
         it = it.get_next()
@@ -155,6 +269,8 @@ class WikipediaPretrainingDataset(object):
         pool_size: int,
         chunk_size: int,
         max_num_documents: int,
+        dataset_format: str = "numpy",
+        shard_size: int = 100000,
     ):
 
         target_titles = [
@@ -172,10 +288,13 @@ class WikipediaPretrainingDataset(object):
         tokenizer.save_pretrained(output_dir)
 
         entity_vocab.save(os.path.join(output_dir, ENTITY_VOCAB_FILE))
+        if dataset_format == "numpy":
+            writer = NumpyShardWriter(os.path.join(output_dir, NUMPY_SHARD_DIR), shard_size)
+        else:
+            writer = TFRecordDatasetWriter(os.path.join(output_dir, DATASET_FILE))
+
         number_of_items = 0
-        tf_file = os.path.join(output_dir, DATASET_FILE)
-        options = tf.io.TFRecordOptions(tf.compat.v1.io.TFRecordCompressionType.GZIP)
-        with TFRecordWriter(tf_file, options=options) as writer:
+        with writer:
             with tqdm(total=len(target_titles)) as pbar:
                 initargs = (
                     dump_db,
@@ -188,6 +307,7 @@ class WikipediaPretrainingDataset(object):
                     min_sentence_length,
                     include_sentences_without_entities,
                     include_unk_entities,
+                    dataset_format,
                 )
                 with closing(
                     Pool(pool_size, initializer=WikipediaPretrainingDataset._initialize_worker, initargs=initargs)
@@ -200,20 +320,21 @@ class WikipediaPretrainingDataset(object):
                             number_of_items += 1
                         pbar.update()
 
+        metadata = dict(
+            number_of_items=number_of_items,
+            max_seq_length=max_seq_length,
+            max_entity_length=max_entity_length,
+            max_mention_length=max_mention_length,
+            min_sentence_length=min_sentence_length,
+            tokenizer_class=tokenizer.__class__.__name__,
+            language=dump_db.language,
+            dataset_format=dataset_format,
+        )
+        if dataset_format == "numpy":
+            metadata["shard_sizes"] = writer.shard_sizes
+
         with open(os.path.join(output_dir, METADATA_FILE), "w") as metadata_file:
-            json.dump(
-                dict(
-                    number_of_items=number_of_items,
-                    max_seq_length=max_seq_length,
-                    max_entity_length=max_entity_length,
-                    max_mention_length=max_mention_length,
-                    min_sentence_length=min_sentence_length,
-                    tokenizer_class=tokenizer.__class__.__name__,
-                    language=dump_db.language,
-                ),
-                metadata_file,
-                indent=2,
-            )
+            json.dump(metadata, metadata_file, indent=2)
 
     @staticmethod
     def _initialize_worker(
@@ -227,10 +348,11 @@ class WikipediaPretrainingDataset(object):
         min_sentence_length: int,
         include_sentences_without_entities: bool,
         include_unk_entities: bool,
+        dataset_format: str,
     ):
         global _dump_db, _tokenizer, _sentence_tokenizer, _entity_vocab, _max_num_tokens, _max_entity_length
         global _max_mention_length, _min_sentence_length, _include_sentences_without_entities, _include_unk_entities
-        global _language
+        global _language, _dataset_format
 
         _dump_db = dump_db
         _tokenizer = tokenizer
@@ -243,6 +365,7 @@ class WikipediaPretrainingDataset(object):
         _include_sentences_without_entities = include_sentences_without_entities
         _include_unk_entities = include_unk_entities
         _language = dump_db.language
+        _dataset_format = dataset_format
 
     @staticmethod
     def _process_page(page_title: str):
@@ -335,25 +458,160 @@ class WikipediaPretrainingDataset(object):
                     assert _min_sentence_length <= len(word_ids) <= _max_num_tokens
                     entity_ids = [id_ for id_, _, _, in links]
                     assert len(entity_ids) <= _max_entity_length
-                    entity_position_ids = itertools.chain(
-                        *[
-                            (list(range(start, end)) + [-1] * (_max_mention_length - end + start))[:_max_mention_length]
-                            for _, start, end in links
+                    if _dataset_format == "numpy":
+                        entity_position_spans = [
+                            (start, min(end, start + _max_mention_length)) for _, start, end in links
                         ]
-                    )
-
-                    example = tf.train.Example(
-                        features=tf.train.Features(
-                            feature=dict(
-                                page_id=tf.train.Feature(int64_list=tf.train.Int64List(value=[page_id])),
-                                word_ids=tf.train.Feature(int64_list=tf.train.Int64List(value=word_ids)),
-                                entity_ids=tf.train.Feature(int64_list=tf.train.Int64List(value=entity_ids)),
-                                entity_position_ids=tf.train.Feature(int64_list=Int64List(value=entity_position_ids)),
+                        ret.append((page_id, word_ids, entity_ids, entity_position_spans))
+                    else:
+                        entity_position_ids = list(
+                            itertools.chain(
+                                *[
+                                    (list(range(start, end)) + [-1] * (_max_mention_length - end + start))[
+                                        :_max_mention_length
+                                    ]
+                                    for _, start, end in links
+                                ]
                             )
                         )
-                    )
-                    ret.append((example.SerializeToString()))
+                        ret.append(
+                            TFRecordDatasetWriter.serialize(page_id, word_ids, entity_ids, entity_position_ids)
+                        )
 
                 words = []
                 links = []
         return ret
+
+
+def convert_entity_position_ids_to_spans(entity_position_ids: np.ndarray) -> np.ndarray:
+    """
+    Converts the padded ``[num_entities, max_mention_length]`` positions of contiguous mentions into
+    ``[num_entities, 2]`` spans consisting of the start and (exclusive) end positions.
+    """
+    lengths = (entity_position_ids != -1).sum(axis=1)
+    starts = np.where(lengths > 0, entity_position_ids[:, 0], 0)
+    return np.stack([starts, starts + lengths], axis=1).astype(entity_position_ids.dtype)
+
+
+def convert_entity_position_spans_to_ids(entity_position_spans: np.ndarray, max_mention_length: int) -> np.ndarray:
+    offsets = np.arange(max_mention_length)
+    entity_position_ids = entity_position_spans[:, :1] + offsets
+    lengths = entity_position_spans[:, 1:] - entity_position_spans[:, :1]
+    return np.where(offsets < lengths, entity_position_ids, -1).astype(entity_position_spans.dtype)
+
+
+class NumpyShard(object):
+    """
+    A shard of the NumPy dataset format. Each example is stored as slices of flat int32 arrays, and the arrays are
+    memory-mapped so that examples can be accessed randomly without loading the shard into memory. The positions of
+    entities are stored as (start, end) spans.
+    """
+
+    def __init__(self, shard_dir: str, shard_index: int):
+        def load(name: str):
+            return np.load(os.path.join(shard_dir, f"{shard_index:05d}_{name}.npy"), mmap_mode="r")
+
+        self.page_ids = load("page_ids")
+        self.word_ids = load("word_ids")
+        self.word_offsets = load("word_offsets")
+        self.entity_ids = load("entity_ids")
+        self.entity_position_spans = load("entity_position_spans")
+        self.entity_offsets = load("entity_offsets")
+
+    def __len__(self):
+        return self.page_ids.size
+
+    def __getitem__(self, index: int):
+        word_start, word_end = self.word_offsets[index : index + 2]
+        entity_start, entity_end = self.entity_offsets[index : index + 2]
+        return dict(
+            page_id=int(self.page_ids[index]),
+            word_ids=self.word_ids[word_start:word_end].astype(np.int32),
+            entity_ids=self.entity_ids[entity_start:entity_end].astype(np.int32),
+            entity_position_spans=self.entity_position_spans[entity_start:entity_end].astype(np.int32),
+        )
+
+
+class NumpyShardWriter(object):
+    def __init__(self, shard_dir: str, shard_size: int):
+        self._shard_dir = shard_dir
+        self._shard_size = shard_size
+
+        self.shard_sizes = []
+        self._reset_buffer()
+
+    def __enter__(self):
+        if not os.path.exists(self._shard_dir):
+            os.makedirs(self._shard_dir)
+        return self
+
+    def __exit__(self, *args):
+        if self._page_ids:
+            self._flush()
+
+    def write(self, data: tuple):
+        page_id, word_ids, entity_ids, entity_position_spans = data
+        self._page_ids.append(page_id)
+        self._word_ids.append(np.array(word_ids, dtype=np.int32))
+        self._entity_ids.append(np.array(entity_ids, dtype=np.int32))
+        self._entity_position_spans.append(np.array(entity_position_spans, dtype=np.int32).reshape(-1, 2))
+        if len(self._page_ids) == self._shard_size:
+            self._flush()
+
+    def _flush(self):
+        def save(name: str, arr: np.ndarray):
+            np.save(os.path.join(self._shard_dir, f"{len(self.shard_sizes):05d}_{name}.npy"), arr)
+
+        def compute_offsets(arrays):
+            return np.cumsum([0] + [arr.shape[0] for arr in arrays], dtype=np.int64)
+
+        save("page_ids", np.array(self._page_ids, dtype=np.int32))
+        save("word_ids", np.concatenate(self._word_ids))
+        save("word_offsets", compute_offsets(self._word_ids))
+        save("entity_ids", np.concatenate(self._entity_ids))
+        save("entity_position_spans", np.concatenate(self._entity_position_spans))
+        save("entity_offsets", compute_offsets(self._entity_ids))
+
+        self.shard_sizes.append(len(self._page_ids))
+        self._reset_buffer()
+
+    def _reset_buffer(self):
+        self._page_ids = []
+        self._word_ids = []
+        self._entity_ids = []
+        self._entity_position_spans = []
+
+
+class TFRecordDatasetWriter(object):
+    def __init__(self, tf_file: str):
+        self._tf_file = tf_file
+        self._writer = None
+
+    def __enter__(self):
+        import tensorflow as tf
+
+        options = tf.io.TFRecordOptions(tf.compat.v1.io.TFRecordCompressionType.GZIP)
+        self._writer = tf.io.TFRecordWriter(self._tf_file, options=options)
+        return self
+
+    def __exit__(self, *args):
+        self._writer.close()
+
+    def write(self, data: bytes):
+        self._writer.write(data)
+
+    @staticmethod
+    def serialize(page_id: int, word_ids: List[int], entity_ids: List[int], entity_position_ids: List[int]) -> bytes:
+        import tensorflow as tf
+
+        example = tf.train.Example(
+            features=tf.train.Features(
+                feature=dict(
+                    page_id=tf.train.Feature(int64_list=tf.train.Int64List(value=[page_id])),
+                    word_ids=tf.train.Feature(int64_list=tf.train.Int64List(value=word_ids)),
+                    entity_ids=tf.train.Feature(int64_list=tf.train.Int64List(value=entity_ids)),
+                    entity_position_ids=tf.train.Feature(int64_list=tf.train.Int64List(value=entity_position_ids)),
+                )
+            )
+        )
+        return example.SerializeToString()
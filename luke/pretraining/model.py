@@ -1,7 +1,9 @@
-from typing import Optional
+from typing import Callable, Optional, Tuple
 import torch
+import torch.nn.functional as F
 from torch import nn
 from torch.nn import CrossEntropyLoss
+from torch.utils.checkpoint import checkpoint
 from transformers.modeling_bert import ACT2FN, BertLayerNorm, BertPreTrainingHeads
 from transformers.modeling_roberta import RobertaLMHead
 
@@ -40,10 +42,72 @@ class EntityPredictionHead(nn.Module):
         return hidden_states
 
 
+ENTITY_LOSSES = ("full", "sampled", "in_batch")
+
+
+def chunked_cross_entropy(
+    score_fn: Callable[[torch.Tensor], torch.Tensor],
+    hidden_states: torch.Tensor,
+    labels: torch.LongTensor,
+    chunk_size: int,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Computes the mean cross-entropy loss and the number of correct top-1 predictions of the scores given by
+    ``score_fn`` over chunks of ``chunk_size`` rows. Only the scores of a single chunk are kept in memory because they
+    are recomputed in the backward pass.
+    """
+
+    def compute_chunk(chunk_hidden_states, chunk_labels):
+        scores = score_fn(chunk_hidden_states).float()
+        loss = F.cross_entropy(scores, chunk_labels, reduction="sum")
+        correct = (torch.argmax(scores, 1) == chunk_labels).sum()
+        return loss, correct
+
+    loss = hidden_states.new_zeros((), dtype=torch.float)
+    correct = labels.new_zeros(())
+    for start in range(0, labels.size(0), chunk_size):
+        end = start + chunk_size
+        chunk_loss, chunk_correct = checkpoint(
+            compute_chunk, hidden_states[start:end], labels[start:end], use_reentrant=False
+        )
+        loss = loss + chunk_loss
+        correct = correct + chunk_correct
+
+    return (loss / labels.size(0)).to(hidden_states.dtype), correct
+
+
 class LukePretrainingModel(LukeModel):
-    def __init__(self, config: LukeConfig):
+    def __init__(
+        self,
+        config: LukeConfig,
+        entity_loss: str = "full",
+        num_entity_negatives: int = 8192,
+        entity_counts: Optional[torch.Tensor] = None,
+        entity_sampling_power: float = 0.75,
+        loss_chunk_size: Optional[int] = None,
+    ):
+        """
+        If ``entity_loss`` is ``sampled`` or ``in_batch``, the masked entity loss is computed using the softmax over
+        ``num_entity_negatives`` entities sampled based on ``entity_counts`` or over the masked entities in the batch
+        instead of the full entity vocabulary. The scores are corrected by subtracting the log probabilities of the
+        entities being sampled, which are estimated from the entity frequencies.
+        """
         super(LukePretrainingModel, self).__init__(config)
 
+        if entity_loss not in ENTITY_LOSSES:
+            raise ValueError(f"Invalid entity loss: {entity_loss}")
+        self.entity_loss = entity_loss
+        self.num_entity_negatives = num_entity_negatives
+        self.loss_chunk_size = loss_chunk_size
+        if entity_loss != "full":
+            if entity_counts is None:
+                raise ValueError(f"entity_counts is required for the {entity_loss} entity loss")
+            # the negatives in the batch follow the frequency distribution of the entities
+            power = entity_sampling_power if entity_loss == "sampled" else 1.0
+            entity_sampling_probs = entity_counts.double().clamp(min=1).pow(power)
+            entity_sampling_probs = (entity_sampling_probs / entity_sampling_probs.sum()).float()
+            self.register_buffer("entity_sampling_probs", entity_sampling_probs, persistent=False)
+
         if self.config.bert_model_name and "roberta" in self.config.bert_model_name:
             self.lm_head = RobertaLMHead(config)
             self.lm_head.decoder.weight = self.embeddings.word_embeddings.weight
@@ -62,11 +126,13 @@ class LukePretrainingModel(LukeModel):
         word_segment_ids: torch.LongTensor,
         word_attention_mask: torch.LongTensor,
         entity_ids: torch.LongTensor,
-        entity_position_ids: torch.LongTensor,
-        entity_segment_ids: torch.LongTensor,
-        entity_attention_mask: torch.LongTensor,
+        entity_position_ids: Optional[torch.LongTensor] = None,
+        entity_segment_ids: Optional[torch.LongTensor] = None,
+        entity_attention_mask: Optional[torch.LongTensor] = None,
         masked_entity_labels: Optional[torch.LongTensor] = None,
         masked_lm_labels: Optional[torch.LongTensor] = None,
+        entity_position_spans: Optional[torch.LongTensor] = None,
+        compute_masked_entity_accuracy: bool = True,
         **kwargs
     ):
         model_dtype = next(self.parameters()).dtype  # for fp16 compatibility
@@ -79,10 +145,10 @@ class LukePretrainingModel(LukeModel):
             entity_position_ids,
             entity_segment_ids,
             entity_attention_mask,
+            entity_position_spans,
         )
         word_sequence_output, entity_sequence_output = output[:2]
 
-        loss_fn = CrossEntropyLoss(ignore_index=-1)
         ret = dict(loss=word_ids.new_tensor(0.0, dtype=model_dtype))
 
         if masked_entity_labels is not None:
@@ -90,14 +156,28 @@ class LukePretrainingModel(LukeModel):
             if entity_mask.sum() > 0:
                 target_entity_sequence_output = torch.masked_select(entity_sequence_output, entity_mask.unsqueeze(-1))
                 target_entity_sequence_output = target_entity_sequence_output.view(-1, self.config.hidden_size)
-                target_entity_labels = torch.masked_select(masked_entity_labels, entity_mask)
-
-                entity_scores = self.entity_predictions(target_entity_sequence_output)
-                entity_scores = entity_scores.view(-1, self.config.entity_vocab_size)
+                target_entity_labels = torch.masked_select(masked_entity_labels, entity_mask).long()
 
-                ret["masked_entity_loss"] = loss_fn(entity_scores, target_entity_labels)
-                ret["masked_entity_correct"] = (torch.argmax(entity_scores, 1).data == target_entity_labels.data).sum()
-                ret["masked_entity_total"] = target_entity_labels.ne(-1).sum()
+                if self.entity_loss == "full":
+                    ret["masked_entity_loss"], ret["masked_entity_correct"] = self._compute_cross_entropy(
+                        self.entity_predictions, target_entity_sequence_output, target_entity_labels
+                    )
+                    ret["masked_entity_total"] = target_entity_labels.ne(-1).sum()
+                else:
+                    entity_hidden_states = self.entity_predictions.transform(target_entity_sequence_output)
+                    ret["masked_entity_loss"] = self._compute_sampled_entity_loss(
+                        entity_hidden_states, target_entity_labels
+                    )
+                    if compute_masked_entity_accuracy:
+                        # the accuracy is computed using the full softmax
+                        with torch.no_grad():
+                            entity_scores = self.entity_predictions.decoder(entity_hidden_states)
+                            entity_predictions = torch.argmax(entity_scores + self.entity_predictions.bias, 1)
+                        ret["masked_entity_correct"] = (entity_predictions == target_entity_labels).sum()
+                        ret["masked_entity_total"] = target_entity_labels.ne(-1).sum()
+                    else:
+                        ret["masked_entity_correct"] = word_ids.new_tensor(0, dtype=torch.long)
+                        ret["masked_entity_total"] = word_ids.new_tensor(0, dtype=torch.long)
                 ret["loss"] += ret["masked_entity_loss"]
             else:
                 ret["masked_entity_loss"] = word_ids.new_tensor(0.0, dtype=model_dtype)
@@ -111,14 +191,14 @@ class LukePretrainingModel(LukeModel):
                 masked_word_sequence_output = masked_word_sequence_output.view(-1, self.config.hidden_size)
 
                 if self.config.bert_model_name and "roberta" in self.config.bert_model_name:
-                    masked_lm_scores = self.lm_head(masked_word_sequence_output)
+                    lm_head = self.lm_head
                 else:
-                    masked_lm_scores = self.cls.predictions(masked_word_sequence_output)
-                masked_lm_scores = masked_lm_scores.view(-1, self.config.vocab_size)
-                masked_lm_labels = torch.masked_select(masked_lm_labels, masked_lm_mask)
+                    lm_head = self.cls.predictions
+                masked_lm_labels = torch.masked_select(masked_lm_labels, masked_lm_mask).long()
 
-                ret["masked_lm_loss"] = loss_fn(masked_lm_scores, masked_lm_labels)
-                ret["masked_lm_correct"] = (torch.argmax(masked_lm_scores, 1).data == masked_lm_labels.data).sum()
+                ret["masked_lm_loss"], ret["masked_lm_correct"] = self._compute_cross_entropy(
+                    lm_head, masked_word_sequence_output, masked_lm_labels
+                )
                 ret["masked_lm_total"] = masked_lm_labels.ne(-1).sum()
                 ret["loss"] += ret["masked_lm_loss"]
             else:
@@ -127,3 +207,32 @@ class LukePretrainingModel(LukeModel):
                 ret["masked_lm_total"] = word_ids.new_tensor(0, dtype=torch.long)
 
         return ret
+
+    def _compute_cross_entropy(self, head: nn.Module, hidden_states: torch.Tensor, labels: torch.LongTensor):
+        if self.loss_chunk_size:
+            return chunked_cross_entropy(head, hidden_states, labels, self.loss_chunk_size)
+
+        scores = head(hidden_states)
+        loss = CrossEntropyLoss(ignore_index=-1)(scores, labels)
+        correct = (torch.argmax(scores, 1).data == labels.data).sum()
+        return loss, correct
+
+    def _compute_sampled_entity_loss(self, hidden_states: torch.Tensor, labels: torch.LongTensor):
+        weight = self.entity_predictions.decoder.weight
+        bias = self.entity_predictions.bias
+        log_probs = self.entity_sampling_probs.log()
+
+        if self.entity_loss == "sampled":
+            negative_ids = torch.multinomial(self.entity_sampling_probs, self.num_entity_negatives, replacement=True)
+            positive_scores = (hidden_states * weight[labels]).sum(-1) + bias[labels] - log_probs[labels]
+            negative_scores = F.linear(hidden_states, weight[negative_ids], bias[negative_ids])
+            negative_scores = negative_scores - log_probs[negative_ids]
+            # the negatives that are identical to the target entities are excluded from the softmax
+            negative_scores = negative_scores.masked_fill(negative_ids.unsqueeze(0) == labels.unsqueeze(1), -10000.0)
+            scores = torch.cat([positive_scores.unsqueeze(1), negative_scores], dim=1)
+            targets = labels.new_zeros(labels.size(0))
+        else:
+            candidate_ids, targets = torch.unique(labels, return_inverse=True)
+            scores = F.linear(hidden_states, weight[candidate_ids], bias[candidate_ids]) - log_probs[candidate_ids]
+
+        return F.cross_entropy(scores, targets)
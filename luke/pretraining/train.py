@@ -20,11 +20,12 @@ from transformers import (
     get_linear_schedule_with_warmup,
 )
 
-from luke.model import LukeConfig
+from luke.model import ATTENTION_BACKENDS, GRADIENT_CHECKPOINTING_POLICIES, LukeConfig
 from luke.optimization import LukeAdamW
 from luke.pretraining.batch_generator import LukePretrainingBatchGenerator, MultilingualBatchGenerator
 from luke.pretraining.dataset import WikipediaPretrainingDataset
-from luke.pretraining.model import LukePretrainingModel
+from luke.pretraining.model import ENTITY_LOSSES, LukePretrainingModel
+from luke.utils.mixed_precision import autocast, create_grad_scaler
 from luke.utils.model_utils import ENTITY_VOCAB_FILE
 
 logger = logging.getLogger(__name__)
@@ -39,6 +40,9 @@ logger = logging.getLogger(__name__)
 @click.option("--cpu", is_flag=True)
 @click.option("--bert-model-name", default="roberta-large")
 @click.option("--entity-emb-size", default=256, type=int)
+@click.option("--attention-backend", type=click.Choice(ATTENTION_BACKENDS), default="eager")
+@click.option("--gradient-checkpointing", type=click.Choice(GRADIENT_CHECKPOINTING_POLICIES), default="none")
+@click.option("--gradient-checkpointing-interval", default=1)
 @click.option("--batch-size", default=2048)
 @click.option("--gradient-accumulation-steps", default=1024)
 @click.option("--learning-rate", default=1e-5)
@@ -57,15 +61,19 @@ logger = logging.getLogger(__name__)
 @click.option("--unmasked-entity-prob", default=0.0)
 @click.option("--random-entity-prob", default=0.0)
 @click.option("--mask-words-in-entity-span", is_flag=True)
+@click.option("--num-data-workers", default=1)
+@click.option("--entity-position-format", type=click.Choice(["dense", "span"]), default="dense")
+@click.option("--max-tokens-per-batch", default=None, type=int)
+@click.option("--entity-loss", type=click.Choice(ENTITY_LOSSES), default="full")
+@click.option("--num-entity-negatives", default=8192)
+@click.option("--entity-acc-interval", default=100)
+@click.option("--loss-chunk-size", default=None, type=int)
 @click.option("--fix-bert-weights", is_flag=True)
 @click.option("--grad-avg-on-cpu/--grad-avg-on-gpu", default=False)
 @click.option("--num-epochs", default=20)
 @click.option("--global-step", default=0)
 @click.option("--fp16", is_flag=True)
-@click.option("--fp16-opt-level", default="O2", type=click.Choice(["O1", "O2"]))
-@click.option("--fp16-master-weights/--fp16-no-master-weights", default=True)
-@click.option("--fp16-min-loss-scale", default=1)
-@click.option("--fp16-max-loss-scale", default=4)
+@click.option("--bf16", is_flag=True)
 @click.option("--local-rank", "--local_rank", default=-1)
 @click.option("--num-nodes", default=1)
 @click.option("--node-rank", default=0)
@@ -75,7 +83,6 @@ logger = logging.getLogger(__name__)
 @click.option("--model-file", type=click.Path(exists=True), default=None)
 @click.option("--optimizer-file", type=click.Path(exists=True), default=None)
 @click.option("--scheduler-file", type=click.Path(exists=True), default=None)
-@click.option("--amp-file", type=click.Path(exists=True), default=None)
 @click.option("--save-interval-sec", default=None, type=int)
 @click.option("--save-interval-steps", default=None, type=int)
 def pretrain(**kwargs):
@@ -87,6 +94,7 @@ def pretrain(**kwargs):
 @click.option("--batch-size", default=None, type=int)
 @click.option("--gradient-accumulation-steps", default=None, type=int)
 @click.option("--grad-avg-on-cpu", is_flag=True, default=None)
+@click.option("--num-data-workers", default=None, type=int)
 @click.option("--num-nodes", default=1)
 @click.option("--node-rank", default=0)
 @click.option("--master-addr", default="127.0.0.1")
@@ -108,6 +116,25 @@ def resume_pretraining(output_dir: str, **kwargs):
         args["unmasked_entity_prob"] = 0.0
         args["random_entity_prob"] = 0.0
         args["mask_words_in_entity_span"] = False
+    if "num_data_workers" not in args:
+        args["num_data_workers"] = 1
+    if "entity_position_format" not in args:
+        args["entity_position_format"] = "dense"
+    if "max_tokens_per_batch" not in args:
+        args["max_tokens_per_batch"] = None
+    if "attention_backend" not in args:
+        args["attention_backend"] = "eager"
+    if "entity_loss" not in args:
+        args["entity_loss"] = "full"
+        args["num_entity_negatives"] = 8192
+        args["entity_acc_interval"] = 100
+    if "loss_chunk_size" not in args:
+        args["loss_chunk_size"] = None
+    if "bf16" not in args:
+        args["bf16"] = False
+    if "gradient_checkpointing" not in args:
+        args["gradient_checkpointing"] = "none"
+        args["gradient_checkpointing_interval"] = 1
 
     step_metadata_file = sorted(
         [f for f in os.listdir(output_dir) if f.startswith("metadata_") and f.endswith(".json")]
@@ -119,9 +146,8 @@ def resume_pretraining(output_dir: str, **kwargs):
     args["optimizer_file"] = os.path.join(output_dir, step_metadata["optimizer_file"])
     args["scheduler_file"] = os.path.join(output_dir, step_metadata["scheduler_file"])
     if "amp_file" in step_metadata:
-        args["amp_file"] = os.path.join(output_dir, step_metadata["amp_file"])
-    else:
-        args["amp_file"] = None
+        logger.warning("The apex amp state in %s is ignored", step_metadata["amp_file"])
+    args["grad_scaler_state"] = step_metadata.get("grad_scaler")
     args["global_step"] = step_metadata["global_step"]
     args["local_rank"] = -1
 
@@ -185,9 +211,24 @@ def run_pretraining(args):
         entity_vocab_size=entity_vocab.size,
         bert_model_name=args.bert_model_name,
         entity_emb_size=args.entity_emb_size,
+        attention_backend=args.attention_backend,
         **bert_config.to_dict(),
     )
-    model = LukePretrainingModel(config)
+    entity_counts = None
+    if args.entity_loss != "full":
+        entity_counts = np.zeros(entity_vocab.size, dtype=np.int64)
+        for entity, index in entity_vocab.vocab.items():
+            entity_counts[index] = entity_vocab.counter[entity]
+        entity_counts = torch.from_numpy(entity_counts)
+    model = LukePretrainingModel(
+        config,
+        entity_loss=args.entity_loss,
+        num_entity_negatives=args.num_entity_negatives,
+        entity_counts=entity_counts,
+        loss_chunk_size=args.loss_chunk_size,
+    )
+    if args.gradient_checkpointing != "none":
+        model.set_gradient_checkpointing(args.gradient_checkpointing, args.gradient_checkpointing_interval)
 
     global_step = args.global_step
 
@@ -201,6 +242,10 @@ def run_pretraining(args):
         unmasked_entity_prob=args.unmasked_entity_prob,
         random_entity_prob=args.random_entity_prob,
         mask_words_in_entity_span=args.mask_words_in_entity_span,
+        num_data_workers=args.num_data_workers,
+        entity_position_format=args.entity_position_format,
+        max_tokens_per_batch=args.max_tokens_per_batch,
+        gradient_accumulation_steps=args.gradient_accumulation_steps,
         num_workers=num_workers,
         worker_index=worker_index,
         skip=global_step * args.batch_size,
@@ -245,26 +290,11 @@ def run_pretraining(args):
         grad_avg_device=torch.device("cpu") if args.grad_avg_on_cpu else device,
     )
 
-    if args.fp16:
-        from apex import amp
-
-        if args.fp16_opt_level == "O2":
-            model, optimizer = amp.initialize(
-                model,
-                optimizer,
-                opt_level=args.fp16_opt_level,
-                master_weights=args.fp16_master_weights,
-                min_loss_scale=args.fp16_min_loss_scale,
-                max_loss_scale=args.fp16_max_loss_scale,
-            )
-        else:
-            model, optimizer = amp.initialize(
-                model,
-                optimizer,
-                opt_level=args.fp16_opt_level,
-                min_loss_scale=args.fp16_min_loss_scale,
-                max_loss_scale=args.fp16_max_loss_scale,
-            )
+    if args.fp16 and args.bf16:
+        raise ValueError("--fp16 and --bf16 cannot be used together")
+    autocast_dtype = torch.float16 if args.fp16 else torch.bfloat16 if args.bf16 else None
+    # the loss scaling is not required for bfloat16 as it has the same exponent range as float32
+    grad_scaler = create_grad_scaler(device, args.fp16)
 
     if args.model_file is None:
         bert_model = AutoModelForPreTraining.from_pretrained(args.bert_model_name)
@@ -278,8 +308,8 @@ def run_pretraining(args):
     if args.optimizer_file is not None:
         optimizer.load_state_dict(torch.load(args.optimizer_file, map_location="cpu"))
 
-    if args.amp_file is not None:
-        amp.load_state_dict(torch.load(args.amp_file, map_location="cpu"))
+    if grad_scaler is not None and getattr(args, "grad_scaler_state", None) is not None:
+        grad_scaler.load_state_dict(args.grad_scaler_state)
 
     if args.lr_schedule == "warmup_constant":
         scheduler = get_constant_schedule_with_warmup(optimizer, num_warmup_steps=args.warmup_steps)
@@ -329,10 +359,8 @@ def run_pretraining(args):
         metadata = dict(
             global_step=global_step, model_file=model_file, optimizer_file=optimizer_file, scheduler_file=scheduler_file
         )
-        if args.fp16:
-            amp_file = f"amp_{suffix}.bin"
-            torch.save(amp.state_dict(), os.path.join(args.output_dir, amp_file))
-            metadata["amp_file"] = amp_file
+        if grad_scaler is not None:
+            metadata["grad_scaler"] = grad_scaler.state_dict()
         with open(os.path.join(args.output_dir, f"metadata_{suffix}.json"), "w") as f:
             json.dump(metadata, f, indent=2, sort_keys=True)
 
@@ -342,35 +370,45 @@ def run_pretraining(args):
 
     tr_loss = 0
     accumulation_count = 0
+    step_weight = 0.0
+    has_skipped_batch = False
     results = []
     prev_error = False
     prev_step_time = time.time()
     prev_save_time = time.time()
 
     for batch in batch_generator.generate_batches():
+        if "is_window_end" in batch:
+            # the number of batches in each step varies if the batches are created based on the number of tokens
+            batch_weight = float(batch.pop("batch_weight"))
+            is_step_end = bool(batch.pop("is_window_end"))
+        else:
+            batch_weight = None
+            is_step_end = accumulation_count + 1 == args.gradient_accumulation_steps
+
         try:
             batch = {k: torch.from_numpy(v).to(device) for k, v in batch.items()}
-            result = model(**batch)
+            # the accuracy of the masked entity prediction is computed periodically if the full softmax is not used
+            compute_masked_entity_accuracy = args.entity_loss == "full" or global_step % args.entity_acc_interval == 0
+            with autocast(device, autocast_dtype):
+                result = model(**batch, compute_masked_entity_accuracy=compute_masked_entity_accuracy)
             loss = result["loss"]
             result = {k: v.to("cpu").detach().numpy() for k, v in result.items()}
 
-            if args.gradient_accumulation_steps > 1:
+            if batch_weight is not None:
+                loss = loss * batch_weight
+            elif args.gradient_accumulation_steps > 1:
                 loss = loss / args.gradient_accumulation_steps
 
             def maybe_no_sync():
-                if (
-                    hasattr(model, "no_sync")
-                    and num_workers > 1
-                    and accumulation_count + 1 != args.gradient_accumulation_steps
-                ):
+                if hasattr(model, "no_sync") and num_workers > 1 and not is_step_end:
                     return model.no_sync()
                 else:
                     return contextlib.ExitStack()
 
             with maybe_no_sync():
-                if args.fp16:
-                    with amp.scale_loss(loss, optimizer) as scaled_loss:
-                        scaled_loss.backward()
+                if grad_scaler is not None:
+                    grad_scaler.scale(loss).backward()
                 else:
                     loss.backward()
 
@@ -382,24 +420,42 @@ def run_pretraining(args):
             prev_error = True
             loss = None
             torch.cuda.empty_cache()
-            continue
-
-        accumulation_count += 1
-        prev_error = False
-        tr_loss += loss.item()
-        loss = None
-        results.append(result)
-
-        if accumulation_count == args.gradient_accumulation_steps:
+            if batch_weight is None or (is_step_end and accumulation_count == 0):
+                continue
+            has_skipped_batch = True
+            # the step still ends at the end of the window, so that the batches accumulated in the window are not
+            # merged with the batches of the next window
+            if not is_step_end:
+                continue
+        else:
+            accumulation_count += 1
+            prev_error = False
+            tr_loss += loss.item()
+            loss = None
+            results.append(result)
+            if batch_weight is not None:
+                step_weight += batch_weight
+
+        if is_step_end:
+            if has_skipped_batch:
+                # the gradients are normalized by the weight of the batches actually used in the step
+                for param in model.parameters():
+                    if param.grad is not None:
+                        param.grad.div_(step_weight)
             if args.max_grad_norm != 0.0:
-                if args.fp16:
-                    torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), args.max_grad_norm)
-                else:
-                    torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
-            optimizer.step()
+                if grad_scaler is not None:
+                    grad_scaler.unscale_(optimizer)
+                torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
+            if grad_scaler is not None:
+                grad_scaler.step(optimizer)
+                grad_scaler.update()
+            else:
+                optimizer.step()
             scheduler.step()
             model.zero_grad()
             accumulation_count = 0
+            step_weight = 0.0
+            has_skipped_batch = False
 
             summary = {}
             summary["learning_rate"] = max(scheduler.get_last_lr())
@@ -0,0 +1,33 @@
+import contextlib
+from typing import Optional
+
+import torch
+
+
+def create_grad_scaler(device: torch.device, enabled: bool):
+    """
+    Creates the gradient scaler used in float16 training. None is returned if float16 training is not enabled, so
+    that training also works with the versions of PyTorch that do not support automatic mixed precision.
+    """
+    if not enabled:
+        return None
+    if hasattr(torch, "amp") and hasattr(torch.amp, "GradScaler"):
+        return torch.amp.GradScaler(device.type)
+    if not hasattr(torch.cuda, "amp"):
+        raise RuntimeError("Mixed precision training requires PyTorch 1.6 or later")
+    if device.type != "cuda":
+        raise RuntimeError("Mixed precision training on CPU requires a newer version of PyTorch")
+    return torch.cuda.amp.GradScaler()
+
+
+def autocast(device: torch.device, dtype: Optional[torch.dtype]):
+    """Returns the context manager that runs the forward pass in the dtype. Autocasting is disabled if dtype is None."""
+    if dtype is None:
+        return contextlib.ExitStack()
+    if hasattr(torch, "autocast"):
+        return torch.autocast(device.type, dtype=dtype)
+    if not hasattr(torch.cuda, "amp"):
+        raise RuntimeError("Mixed precision training requires PyTorch 1.6 or later")
+    if device.type != "cuda" or dtype != torch.float16:
+        raise RuntimeError("Only float16 autocasting on GPU is supported in this version of PyTorch")
+    return torch.cuda.amp.autocast()
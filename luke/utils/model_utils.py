@@ -1,14 +1,18 @@
+import copy
+import hashlib
 import json
 import os
+import shutil
 from pathlib import Path
 import tarfile
 import tempfile
-from typing import Dict
+from typing import Dict, Optional, Tuple
 
 import click
 import torch
+from torch import nn
 
-from luke.model import LukeConfig
+from luke.model import LukeConfig, LukeEntityAwareAttentionModel, LukeModel
 from .entity_vocab import EntityVocab
 from .word_tokenizer import AutoTokenizer
 
@@ -58,11 +62,297 @@ def create_model_archive(model_file: str, out_file: str, compress: str):
             archive_file.add(metadata_file.name, arcname=METADATA_FILE)
 
 
+EXPORT_INPUT_NAMES = (
+    "word_ids",
+    "word_segment_ids",
+    "word_attention_mask",
+    "entity_ids",
+    "entity_position_ids",
+    "entity_segment_ids",
+    "entity_attention_mask",
+)
+
+
+def create_example_inputs(
+    max_mention_length: int, word_length: int = 8, entity_length: int = 2, batch_size: int = 1
+) -> Tuple[torch.Tensor, ...]:
+    word_ids = torch.full((batch_size, word_length), 1, dtype=torch.long)
+    word_segment_ids = torch.zeros(batch_size, word_length, dtype=torch.long)
+    word_attention_mask = torch.ones(batch_size, word_length, dtype=torch.long)
+    entity_ids = torch.full((batch_size, entity_length), 1, dtype=torch.long)
+    entity_position_ids = torch.full((batch_size, entity_length, max_mention_length), -1, dtype=torch.long)
+    entity_position_ids[:, :, 0] = 1
+    entity_segment_ids = torch.zeros(batch_size, entity_length, dtype=torch.long)
+    entity_attention_mask = torch.ones(batch_size, entity_length, dtype=torch.long)
+
+    return (
+        word_ids,
+        word_segment_ids,
+        word_attention_mask,
+        entity_ids,
+        entity_position_ids,
+        entity_segment_ids,
+        entity_attention_mask,
+    )
+
+
+def export_model(
+    model: nn.Module,
+    out_file: str,
+    export_format: str,
+    example_inputs: Tuple[torch.Tensor, ...],
+    opset_version: int = 14,
+):
+    """
+    Exports a model taking the word and entity inputs in the order of ``EXPORT_INPUT_NAMES`` (e.g., LukeModel,
+    LukeEntityAwareAttentionModel, or the task models built on them) by tracing it with ``example_inputs``. The batch,
+    word, and entity axes of the exported graph are dynamic.
+    """
+    model.eval()
+    if export_format == "torchscript":
+        with torch.no_grad():
+            traced_model = torch.jit.trace(model, example_inputs)
+        traced_model.save(out_file)
+
+    elif export_format == "onnx":
+        dynamic_axes = {
+            "word_ids": {0: "batch", 1: "word"},
+            "word_segment_ids": {0: "batch", 1: "word"},
+            "word_attention_mask": {0: "batch", 1: "word"},
+            "entity_ids": {0: "batch", 1: "entity"},
+            "entity_position_ids": {0: "batch", 1: "entity"},
+            "entity_segment_ids": {0: "batch", 1: "entity"},
+            "entity_attention_mask": {0: "batch", 1: "entity"},
+        }
+        torch.onnx.export(
+            model,
+            example_inputs,
+            out_file,
+            input_names=list(EXPORT_INPUT_NAMES),
+            dynamic_axes=dynamic_axes,
+            opset_version=opset_version,
+        )
+
+    else:
+        raise ValueError(f"Invalid export format: {export_format}")
+
+
+# the names of the classifiers and the number of entities whose hidden states are fed into them in the task models
+EXPORT_TASK_HEADS = {"entity-typing": ("typing", 1, True), "relation-classification": ("classifier", 2, False)}
+
+# the prefixes of the pretraining heads that are not used by the exported encoders
+PRETRAINING_HEAD_PREFIXES = ("lm_head.", "cls.", "entity_predictions.")
+
+
+class LukeForEntityClassification(LukeEntityAwareAttentionModel):
+    """
+    LukeEntityAwareAttentionModel with a linear classifier over the concatenated hidden states of the first
+    ``num_entities`` entities. The classifier is named after those of LukeForEntityTyping and
+    LukeForRelationClassification in the examples, so that their fine-tuned weights can be loaded and exported.
+    """
+
+    def __init__(self, config: LukeConfig, num_labels: int, head_name: str, num_entities: int, bias: bool = True):
+        super(LukeForEntityClassification, self).__init__(config)
+
+        self.head_name = head_name
+        self.num_entities = num_entities
+        setattr(self, head_name, nn.Linear(config.hidden_size * num_entities, num_labels, bias))
+
+    def forward(
+        self,
+        word_ids,
+        word_segment_ids,
+        word_attention_mask,
+        entity_ids,
+        entity_position_ids,
+        entity_segment_ids,
+        entity_attention_mask,
+    ):
+        encoder_outputs = super(LukeForEntityClassification, self).forward(
+            word_ids,
+            word_segment_ids,
+            word_attention_mask,
+            entity_ids,
+            entity_position_ids,
+            entity_segment_ids,
+            entity_attention_mask,
+        )
+        feature_vector = encoder_outputs[1][:, : self.num_entities, :].flatten(1)
+        return getattr(self, self.head_name)(feature_vector)
+
+
+def create_export_model(
+    model_archive: "ModelArchive",
+    entity_aware_attention: bool = True,
+    task_head: Optional[str] = None,
+    task_state_dict: Optional[Dict[str, torch.Tensor]] = None,
+) -> nn.Module:
+    """
+    Creates the model to be exported. If ``task_head`` is specified, the encoder and the classifier are loaded from
+    ``task_state_dict`` saved by the corresponding task model in the examples. Otherwise, the encoder is loaded from
+    the archive ignoring only the pretraining heads.
+    """
+    if task_head is None:
+        if entity_aware_attention:
+            model = LukeEntityAwareAttentionModel(model_archive.config)
+        else:
+            model = LukeModel(model_archive.config)
+        missing_keys, unexpected_keys = model.load_state_dict(model_archive.state_dict, strict=False)
+        unexpected_keys = [key for key in unexpected_keys if not key.startswith(PRETRAINING_HEAD_PREFIXES)]
+        if missing_keys or unexpected_keys:
+            raise RuntimeError(
+                f"Error(s) in loading state_dict for {model.__class__.__name__}: "
+                f"missing keys: {missing_keys}, unexpected keys: {unexpected_keys}"
+            )
+        return model
+
+    if not entity_aware_attention:
+        raise ValueError("The task heads are built on the entity-aware attention model")
+    if task_state_dict is None:
+        raise ValueError("The fine-tuned weights are required to export the task head")
+
+    head_name, num_entities, bias = EXPORT_TASK_HEADS[task_head]
+    # the entity vocabulary of the task models is usually replaced with a smaller one
+    config = copy.deepcopy(model_archive.config)
+    config.entity_vocab_size = task_state_dict["entity_embeddings.entity_embeddings.weight"].size(0)
+    num_labels = task_state_dict[f"{head_name}.weight"].size(0)
+    model = LukeForEntityClassification(config, num_labels, head_name, num_entities, bias)
+    model.load_state_dict(task_state_dict)
+    return model
+
+
+@click.command(name="export-model")
+@click.argument("model_file", type=click.Path(exists=True))
+@click.argument("out_file", type=click.Path())
+@click.option("--format", "export_format", type=click.Choice(["torchscript", "onnx"]), default="torchscript")
+@click.option("--entity-aware-attention/--no-entity-aware-attention", default=True)
+@click.option("--task-head", type=click.Choice(list(EXPORT_TASK_HEADS.keys())), default=None)
+@click.option("--task-model-file", type=click.Path(exists=True), default=None)
+def export_model_file(
+    model_file: str,
+    out_file: str,
+    export_format: str,
+    entity_aware_attention: bool,
+    task_head: Optional[str],
+    task_model_file: Optional[str],
+):
+    model, max_mention_length = load_export_model(model_file, entity_aware_attention, task_head, task_model_file)
+    export_model(model, out_file, export_format, create_example_inputs(max_mention_length))
+
+
+def load_export_model(
+    model_file: str, entity_aware_attention: bool, task_head: Optional[str], task_model_file: Optional[str]
+) -> Tuple[nn.Module, int]:
+    if (task_head is None) != (task_model_file is None):
+        raise click.UsageError("--task-head and --task-model-file must be specified together")
+
+    model_archive = ModelArchive.load(model_file)
+    task_state_dict = None
+    if task_model_file is not None:
+        task_state_dict = load_state_dict(task_model_file)
+    model = create_export_model(model_archive, entity_aware_attention, task_head, task_state_dict)
+
+    return model, model_archive.max_mention_length
+
+
+def get_cache_dir() -> str:
+    return os.environ.get("LUKE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "luke"))
+
+
+def extract_model_archive(archive_path: str) -> str:
+    """
+    Extracts the archive into the cache directory and returns the path of the extracted directory. The extracted
+    files are reused as long as the path, size, and modification time of the archive are unchanged. The archive is
+    extracted into a temporary directory which is then atomically renamed, so that multiple processes can safely
+    extract the same archive concurrently. The extracted directories are never removed automatically; they can be
+    removed using the ``clear-model-cache`` command.
+    """
+    archive_stat = os.stat(archive_path)
+    cache_key = f"{os.path.abspath(archive_path)}:{archive_stat.st_size}:{archive_stat.st_mtime_ns}"
+    cache_dir = get_cache_dir()
+    extracted_dir = os.path.join(cache_dir, hashlib.sha1(cache_key.encode("utf-8")).hexdigest())
+    if os.path.isdir(extracted_dir):
+        return extracted_dir
+
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_dir = tempfile.mkdtemp(dir=cache_dir)
+    try:
+        with tarfile.open(archive_path) as f:
+            f.extractall(temp_dir)
+        try:
+            os.rename(temp_dir, extracted_dir)
+        except OSError:
+            # the archive has been extracted by another process
+            if not os.path.isdir(extracted_dir):
+                raise
+    finally:
+        if os.path.isdir(temp_dir):
+            shutil.rmtree(temp_dir)
+
+    return extracted_dir
+
+
+@click.command(name="clear-model-cache")
+def clear_model_cache():
+    """Removes the model archives extracted into the cache directory."""
+    cache_dir = get_cache_dir()
+    if not os.path.isdir(cache_dir):
+        return
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+    click.echo(f"Removed the extracted model archives in {cache_dir}")
+
+
+def load_state_dict(model_file: str) -> Dict[str, torch.Tensor]:
+    try:
+        # the tensors are memory-mapped so that they are loaded lazily and shared among processes
+        return torch.load(model_file, map_location="cpu", mmap=True)
+    except (TypeError, RuntimeError):
+        # old versions of PyTorch do not support mmap, and files in the legacy format cannot be memory-mapped
+        return torch.load(model_file, map_location="cpu")
+
+
+# the metadata and tokenizers are loaded once per process, and each archive receives its own copies of them so that
+# the configs and tokenizers modified by one caller are not visible to the others
+_metadata_cache = {}
+_tokenizer_cache = {}
+
+
 class ModelArchive(object):
-    def __init__(self, state_dict: Dict[str, torch.Tensor], metadata: dict, entity_vocab: EntityVocab):
-        self.state_dict = state_dict
+    def __init__(
+        self,
+        state_dict: Optional[Dict[str, torch.Tensor]],
+        metadata: dict,
+        entity_vocab: Optional[EntityVocab],
+        model_file: Optional[str] = None,
+        entity_vocab_file: Optional[str] = None,
+    ):
+        """
+        The state dict and entity vocab are loaded from ``model_file`` and ``entity_vocab_file`` on first access if
+        they are not given.
+        """
+        self._state_dict = state_dict
         self.metadata = metadata
-        self.entity_vocab = entity_vocab
+        self._entity_vocab = entity_vocab
+        self._model_file = model_file
+        self._entity_vocab_file = entity_vocab_file
+
+        self._config = None
+        self._tokenizer = None
+
+    @property
+    def state_dict(self) -> Dict[str, torch.Tensor]:
+        if self._state_dict is None:
+            self._state_dict = load_state_dict(self._model_file)
+        return self._state_dict
+
+    @property
+    def entity_vocab(self) -> EntityVocab:
+        if self._entity_vocab is None:
+            self._entity_vocab = EntityVocab(self._entity_vocab_file)
+        return self._entity_vocab
 
     @property
     def bert_model_name(self):
@@ -70,11 +360,17 @@ class ModelArchive(object):
 
     @property
     def config(self):
-        return LukeConfig(**self.metadata["model_config"])
+        if self._config is None:
+            self._config = LukeConfig(**copy.deepcopy(self.metadata["model_config"]))
+        return self._config
 
     @property
     def tokenizer(self):
-        return AutoTokenizer.from_pretrained(self.bert_model_name)
+        if self._tokenizer is None:
+            if self.bert_model_name not in _tokenizer_cache:
+                _tokenizer_cache[self.bert_model_name] = AutoTokenizer.from_pretrained(self.bert_model_name)
+            self._tokenizer = copy.deepcopy(_tokenizer_cache[self.bert_model_name])
+        return self._tokenizer
 
     @property
     def max_seq_length(self):
@@ -95,16 +391,19 @@ class ModelArchive(object):
         elif archive_path.endswith(".bin"):
             return cls._load(os.path.dirname(archive_path), os.path.basename(archive_path))
 
-        with tempfile.TemporaryDirectory() as temp_path:
-            f = tarfile.open(archive_path)
-            f.extractall(temp_path)
-            return cls._load(temp_path, MODEL_FILE)
+        return cls._load(extract_model_archive(archive_path), MODEL_FILE)
 
     @staticmethod
     def _load(path: str, model_file: str):
-        state_dict = torch.load(os.path.join(path, model_file), map_location="cpu")
-        with open(os.path.join(path, METADATA_FILE)) as metadata_file:
-            metadata = json.load(metadata_file)
-        entity_vocab = EntityVocab(get_entity_vocab_file_path(path))
+        metadata_file_path = os.path.abspath(os.path.join(path, METADATA_FILE))
+        if metadata_file_path not in _metadata_cache:
+            with open(metadata_file_path) as metadata_file:
+                _metadata_cache[metadata_file_path] = json.load(metadata_file)
 
-        return ModelArchive(state_dict, metadata, entity_vocab)
+        return ModelArchive(
+            None,
+            copy.deepcopy(_metadata_cache[metadata_file_path]),
+            None,
+            model_file=os.path.join(path, model_file),
+            entity_vocab_file=get_entity_vocab_file_path(path),
+        )
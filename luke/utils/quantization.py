@@ -0,0 +1,49 @@
+import copy
+from typing import Optional
+
+import click
+import torch
+from torch import nn
+
+try:
+    from torch.ao.quantization import quantize_dynamic
+except ImportError:
+    # torch.ao.quantization is not available in PyTorch < 1.10
+    from torch.quantization import quantize_dynamic
+
+from .model_utils import EXPORT_TASK_HEADS, create_example_inputs, export_model, load_export_model
+
+
+def quantize_model(model: nn.Module, inplace: bool = False) -> nn.Module:
+    """
+    Converts the linear layers of the model, including the query, key, and value projections of the entity-aware
+    self-attention, into layers using int8 weights and dynamically quantized activations. The quantized model runs
+    only on CPU.
+    """
+    if not inplace:
+        model = copy.deepcopy(model)
+    model.to("cpu")
+    model.eval()
+    return quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+@click.command(name="quantize-model")
+@click.argument("model_file", type=click.Path(exists=True))
+@click.argument("out_file", type=click.Path())
+@click.option("--entity-aware-attention/--no-entity-aware-attention", default=True)
+@click.option("--task-head", type=click.Choice(list(EXPORT_TASK_HEADS.keys())), default=None)
+@click.option("--task-model-file", type=click.Path(exists=True), default=None)
+def quantize_model_file(
+    model_file: str,
+    out_file: str,
+    entity_aware_attention: bool,
+    task_head: Optional[str],
+    task_model_file: Optional[str],
+):
+    """
+    Quantizes the model into int8 and saves it as a TorchScript file that can be loaded using ``torch.jit.load``
+    without the model code.
+    """
+    model, max_mention_length = load_export_model(model_file, entity_aware_attention, task_head, task_model_file)
+    model = quantize_model(model, inplace=True)
+    export_model(model, out_file, "torchscript", create_example_inputs(max_mention_length))
@@ -0,0 +1,88 @@
+from argparse import Namespace
+
+import pytest
+import torch
+
+from examples.entity_disambiguation.main import predict_with_context_entities
+
+
+class StubModel(object):
+    """Scores the candidates using fixed weights shifted by the entities already fed as the context."""
+
+    def __init__(self, entity_vocab_size=100, max_forward_calls=100):
+        generator = torch.Generator().manual_seed(0)
+        self.weights = torch.randn(entity_vocab_size, generator=generator)
+        self.context_weights = torch.randn(entity_vocab_size, generator=generator)
+        self.max_forward_calls = max_forward_calls
+        self.num_forward_calls = 0
+
+    def __call__(self, entity_ids, entity_attention_mask, entity_candidate_ids, **kwargs):
+        self.num_forward_calls += 1
+        assert self.num_forward_calls <= self.max_forward_calls
+
+        context_entity_ids = entity_ids.masked_fill(entity_ids == 1, 0) * entity_attention_mask
+        context = (self.weights[context_entity_ids] * (context_entity_ids != 0)).sum(dim=1)
+        logits = (
+            self.weights[entity_candidate_ids] + context[:, None, None] * self.context_weights[entity_candidate_ids]
+        )
+        return (logits.masked_fill(entity_candidate_ids == 0, torch.finfo(logits.dtype).min),)
+
+
+def _predict(model, entity_candidate_ids, entity_attention_mask, context_entity_order="highest_prob", threshold=None):
+    args = Namespace(context_entity_order=context_entity_order, context_entity_threshold=threshold)
+    inputs = dict(entity_candidate_ids=entity_candidate_ids)
+    input_entity_ids = torch.ones_like(entity_attention_mask)
+    return predict_with_context_entities(args, model, inputs, input_entity_ids, entity_attention_mask)
+
+
+def test_predict_with_context_entities_mention_without_candidates():
+    entity_candidate_ids = torch.LongTensor([[[5, 6, 7], [0, 0, 0]]])
+    entity_attention_mask = torch.LongTensor([[1, 1]])
+    model = StubModel(max_forward_calls=2)
+    result, prediction_order = _predict(model, entity_candidate_ids, entity_attention_mask)
+
+    assert result[0, 0].item() in (5, 6, 7)
+    assert result[0, 1].item() == 0
+    assert sorted(prediction_order[0].tolist()) == [0, 1]
+
+
+def _create_documents(num_documents=6, max_mentions=5, max_candidates=4):
+    generator = torch.Generator().manual_seed(1)
+    documents = []
+    for _ in range(num_documents):
+        num_mentions = torch.randint(1, max_mentions + 1, (), generator=generator).item()
+        entity_candidate_ids = torch.randint(2, 100, (num_mentions, max_candidates), generator=generator)
+        num_candidates = torch.randint(0, max_candidates + 1, (num_mentions,), generator=generator)
+        entity_candidate_ids[torch.arange(max_candidates)[None, :] >= num_candidates[:, None]] = 0
+        documents.append(entity_candidate_ids)
+    return documents
+
+
+@pytest.mark.parametrize(
+    "context_entity_order,threshold", [("natural", None), ("highest_prob", None), ("highest_prob", 0.5)]
+)
+def test_predict_with_context_entities_batch(context_entity_order, threshold):
+    documents = _create_documents()
+    entity_candidate_ids = torch.nn.utils.rnn.pad_sequence(documents, batch_first=True)
+    entity_attention_mask = torch.nn.utils.rnn.pad_sequence(
+        [torch.ones(len(d), dtype=torch.long) for d in documents], batch_first=True
+    )
+    model = StubModel()
+    result, prediction_order = _predict(
+        model, entity_candidate_ids, entity_attention_mask, context_entity_order, threshold
+    )
+    assert model.num_forward_calls <= entity_candidate_ids.size(1)
+
+    for index, document in enumerate(documents):
+        num_mentions = document.size(0)
+        single_result, single_prediction_order = _predict(
+            StubModel(),
+            document.unsqueeze(0),
+            torch.ones(1, num_mentions, dtype=torch.long),
+            context_entity_order,
+            threshold,
+        )
+        assert result[index, :num_mentions].tolist() == single_result[0].tolist()
+        assert prediction_order[index, :num_mentions].tolist() == single_prediction_order[0].tolist()
+        if context_entity_order == "natural" and threshold is None:
+            assert single_prediction_order[0].tolist() == list(range(num_mentions))
@@ -0,0 +1,35 @@
+import torch
+
+from examples.entity_disambiguation.model import LukeForEntityDisambiguation
+from luke.model import LukeConfig
+
+
+def test_forward_with_candidates():
+    config = LukeConfig(
+        vocab_size=100,
+        entity_vocab_size=10,
+        bert_model_name="bert-base-uncased",
+        hidden_size=32,
+        num_hidden_layers=1,
+        num_attention_heads=4,
+        intermediate_size=64,
+        max_position_embeddings=64,
+    )
+    model = LukeForEntityDisambiguation(config)
+    model.eval()
+
+    # the model replaces the entity embeddings with those taking only the dense position ids
+    ret = model(
+        word_ids=torch.LongTensor([[1, 20, 21, 2], [1, 22, 2, 0]]),
+        word_segment_ids=torch.zeros(2, 4, dtype=torch.long),
+        word_attention_mask=torch.LongTensor([[1, 1, 1, 1], [1, 1, 1, 0]]),
+        entity_ids=torch.LongTensor([[1, 1], [1, 0]]),
+        entity_position_ids=torch.LongTensor([[[1, -1], [2, -1]], [[1, -1], [-1, -1]]]),
+        entity_segment_ids=torch.zeros(2, 2, dtype=torch.long),
+        entity_attention_mask=torch.LongTensor([[1, 1], [1, 0]]),
+        entity_candidate_ids=torch.LongTensor([[[3, 4, 0], [5, 0, 0]], [[6, 7, 8], [0, 0, 0]]]),
+        entity_labels=torch.LongTensor([[4, 5], [8, -1]]),
+    )
+    loss, logits = ret
+    assert logits.size() == (2, 2, 3)
+    assert torch.isfinite(loss)
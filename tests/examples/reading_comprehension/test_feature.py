@@ -0,0 +1,110 @@
+import random
+from argparse import Namespace
+
+from transformers import BertTokenizer
+
+from examples.reading_comprehension.utils import feature
+from examples.reading_comprehension.utils.feature import PassageEncoder
+
+VOCAB = [
+    "[PAD]",
+    "[UNK]",
+    "[CLS]",
+    "[SEP]",
+    "[MASK]",
+    "the",
+    "new",
+    "york",
+    "city",
+    "paris",
+    "u",
+    ".",
+    "s",
+    ",",
+    "'",
+    "(",
+    ")",
+    "e",
+    "-",
+    "mail",
+    "xy",
+    "##lo",
+    "##phon",
+    "##ist",
+]
+WORDS = ["the", "New", "York", "City", "Paris", "U.S.", "e-mail", "xylophonist", "(", ")", ",", "'s"]
+
+
+def _detect_mentions_by_brute_force(encoder, tokens, mention_candidates):
+    # the original implementation decoding every span ending at a word boundary from the longest one
+    mentions = []
+    cur = 0
+    for start, token in enumerate(tokens):
+        if start < cur or encoder._is_subword(token):
+            continue
+        for end in range(min(start + encoder._max_mention_length, len(tokens)), start, -1):
+            if end < len(tokens) and encoder._is_subword(tokens[end]):
+                continue
+            mention_text = encoder._normalize_mention(encoder._tokenizer.convert_tokens_to_string(tokens[start:end]))
+            if mention_text in mention_candidates:
+                cur = end
+                title = mention_candidates[mention_text]
+                if title in encoder._entity_vocab:
+                    mentions.append((encoder._entity_vocab[title], start, end))
+                break
+    return mentions
+
+
+def _create_tokenizer(tmpdir):
+    vocab_file = tmpdir.join("vocab.txt")
+    vocab_file.write("\n".join(VOCAB) + "\n")
+    return BertTokenizer(str(vocab_file))
+
+
+def test_detect_mentions(tmpdir):
+    tokenizer = _create_tokenizer(tmpdir)
+    entity_vocab = {f"Title{i}": i for i in range(10)}
+
+    rnd = random.Random(0)
+    for _ in range(200):
+        tokens = tokenizer.tokenize(" ".join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 20))))
+        encoder = PassageEncoder(tokenizer, entity_vocab, None, {}, {}, rnd.randint(1, 6), 0.0, False, 1)
+        mention_candidates = {}
+        for _ in range(rnd.randint(0, 6)):
+            start = rnd.randrange(len(tokens))
+            end = rnd.randint(start + 1, min(len(tokens), start + 5))
+            mention_text = encoder._normalize_mention(tokenizer.convert_tokens_to_string(tokens[start:end]))
+            mention_candidates[mention_text] = f"Title{rnd.randint(0, 12)}"
+
+        mention_trie = encoder._build_mention_trie(mention_candidates)
+        assert encoder._detect_mentions(tokens, mention_candidates, mention_trie) == _detect_mentions_by_brute_force(
+            encoder, tokens, mention_candidates
+        )
+
+
+def _improve_answer_span_by_brute_force(doc_tokens, input_start, input_end, tokenizer, orig_answer_text):
+    # the original implementation converting the tokens of every span into a string
+    tok_answer_text = tokenizer.convert_tokens_to_string(tokenizer.tokenize(orig_answer_text)).strip()
+    for new_start in range(input_start, input_end + 1):
+        for new_end in range(input_end, new_start - 1, -1):
+            text_span = tokenizer.convert_tokens_to_string(doc_tokens[new_start : (new_end + 1)]).strip()
+            if text_span == tok_answer_text:
+                return new_start, new_end
+    return input_start, input_end
+
+
+def test_improve_answer_span(tmpdir, monkeypatch):
+    tokenizer = _create_tokenizer(tmpdir)
+    monkeypatch.setattr(feature, "params", Namespace(tokenizer=tokenizer), raising=False)
+
+    rnd = random.Random(0)
+    for _ in range(200):
+        doc_tokens = tokenizer.tokenize(" ".join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 15))))
+        input_start = rnd.randrange(len(doc_tokens))
+        input_end = rnd.randint(input_start, min(len(doc_tokens) - 1, input_start + 8))
+        answer_start = rnd.randint(input_start, input_end)
+        answer_end = rnd.randint(answer_start, input_end)
+        answer_text = tokenizer.convert_tokens_to_string(doc_tokens[answer_start : answer_end + 1])
+
+        args = (doc_tokens, input_start, input_end, tokenizer, answer_text)
+        assert feature._improve_answer_span(*args) == _improve_answer_span_by_brute_force(*args)
@@ -0,0 +1,97 @@
+import numpy as np
+
+from luke.pretraining.batch_generator import SharedMemoryBatchQueue, mask_word_ids, split_into_token_budget_batches
+
+CLS_ID = 1
+SEP_ID = 2
+MASK_ID = 3
+VOCAB_SIZE = 20
+# token IDs larger than or equal to 10 are subwords
+IS_SUBWORD_TABLE = np.arange(VOCAB_SIZE) >= 10
+
+
+def _create_word_ids(rows):
+    word_ids = np.zeros((len(rows), max(len(row) for row in rows) + 2), dtype=np.int64)
+    for i, row in enumerate(rows):
+        word_ids[i, : len(row) + 2] = [CLS_ID] + row + [SEP_ID]
+    return word_ids, np.array([len(row) for row in rows])
+
+
+def _mask_word_ids(word_ids, word_lengths, **kwargs):
+    args = dict(
+        masked_lm_prob=0.15,
+        whole_word_masking=True,
+        mask_id=MASK_ID,
+        random_word_prob=0.0,
+        unmasked_word_prob=0.0,
+        random_word_id_range=(4, VOCAB_SIZE),
+    )
+    args.update(kwargs)
+    return mask_word_ids(word_ids, word_lengths, IS_SUBWORD_TABLE, **args)
+
+
+def test_mask_word_ids():
+    np.random.seed(0)
+    rows = [[4, 10, 11, 5, 6, 12, 7, 8, 9, 4, 5, 6, 13, 7, 8, 9, 4, 5, 6, 7], [5, 6, 7, 8, 9, 4, 5]]
+    for _ in range(100):
+        word_ids, word_lengths = _create_word_ids(rows)
+        original_word_ids = word_ids.copy()
+        labels = _mask_word_ids(word_ids, word_lengths)
+
+        masked = labels != -1
+        assert (labels[masked] == original_word_ids[masked]).all()
+        assert (word_ids[masked] == MASK_ID).all()
+        assert (word_ids[~masked] == original_word_ids[~masked]).all()
+        assert masked.sum(axis=1).tolist() == [3, 1]
+        assert not masked[:, 0].any()
+        # the whole word consisting of [4, 10, 11] is always masked together
+        assert masked[0, 1:4].all() or not masked[0, 1:4].any()
+
+
+def test_mask_word_ids_with_entity_spans():
+    np.random.seed(0)
+    rows = [[4, 5, 6, 7, 8, 9, 4, 5, 6, 7, 8, 9, 4, 5, 6, 7, 8, 9, 4, 5]]
+    for _ in range(100):
+        word_ids, word_lengths = _create_word_ids(rows)
+        entity_span_ids = np.full(word_ids.shape, -1)
+        entity_span_ids[0, 5:7] = 0
+        labels = _mask_word_ids(word_ids, word_lengths, entity_span_ids=entity_span_ids)
+
+        masked = labels != -1
+        assert masked[0, 5:7].all()
+        assert masked.sum() == 3
+
+
+def test_mask_word_ids_without_maskable_words():
+    np.random.seed(0)
+    # the single whole word is longer than the number of words to be predicted
+    word_ids, word_lengths = _create_word_ids([[4, 10, 11, 12, 13]])
+    labels = _mask_word_ids(word_ids, word_lengths)
+    assert (labels != -1).sum() == 1
+    assert (word_ids == MASK_ID).sum() == 1
+
+
+def test_shared_memory_batch_queue():
+    batch_queue = SharedMemoryBatchQueue(num_slots=2, slot_nbytes=128)
+    for i in range(3):
+        batch_queue.put(dict(word_ids=np.full((2, 3), i, dtype=np.int64), word_attention_mask=np.ones(5, np.uint8)))
+        batch = batch_queue.get(timeout=1)
+        assert batch["word_ids"].tolist() == [[i] * 3] * 2
+        assert batch["word_attention_mask"].dtype == np.uint8
+        assert batch["word_attention_mask"].tolist() == [1] * 5
+
+    # a batch larger than the slot is sent without using shared memory
+    batch_queue.put(dict(word_ids=np.arange(100)))
+    assert batch_queue.get(timeout=1)["word_ids"].tolist() == list(range(100))
+    batch_queue.close()
+
+
+def test_split_into_token_budget_batches():
+    word_lengths = np.array([10, 3, 8, 3, 20, 4])
+    entity_lengths = np.array([1, 0, 2, 1, 0, 1])
+    batches = split_into_token_budget_batches(word_lengths, entity_lengths, max_tokens_per_batch=16)
+
+    assert sorted(np.concatenate(batches).tolist()) == list(range(6))
+    assert [batch.tolist() for batch in batches] == [[1, 3, 5], [2], [0], [4]]
+    for batch in batches[:-1]:
+        assert batch.size * (word_lengths[batch].max() + entity_lengths[batch].max()) <= 16
@@ -0,0 +1,135 @@
+import itertools
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from luke.pretraining.dataset import (
+    NUMPY_SHARD_DIR,
+    NumpyShardWriter,
+    WikipediaPretrainingDataset,
+    convert_entity_position_ids_to_spans,
+    convert_entity_position_spans_to_ids,
+)
+from luke.utils.model_utils import METADATA_FILE
+
+MAX_MENTION_LENGTH = 3
+
+
+def _build_numpy_dataset(output_dir, num_items, shard_size):
+    items = []
+    with NumpyShardWriter(os.path.join(output_dir, NUMPY_SHARD_DIR), shard_size) as writer:
+        for n in range(num_items):
+            word_ids = list(range(n, n + 5 + n % 3))
+            entity_ids = list(range(n % 2 + 1))
+            entity_position_spans = [(i, i + 1 + n % MAX_MENTION_LENGTH) for i in range(len(entity_ids))]
+            writer.write((n, word_ids, entity_ids, entity_position_spans))
+            items.append((n, word_ids, entity_ids, entity_position_spans))
+
+    with open(os.path.join(output_dir, METADATA_FILE), "w") as metadata_file:
+        json.dump(
+            dict(
+                number_of_items=num_items,
+                max_mention_length=MAX_MENTION_LENGTH,
+                dataset_format="numpy",
+                shard_sizes=writer.shard_sizes,
+            ),
+            metadata_file,
+        )
+    return items
+
+
+def test_numpy_dataset_roundtrip():
+    with tempfile.TemporaryDirectory() as output_dir:
+        items = _build_numpy_dataset(output_dir, 10, shard_size=4)
+        dataset = WikipediaPretrainingDataset(output_dir)
+        assert dataset.dataset_format == "numpy"
+        assert dataset.metadata["shard_sizes"] == [4, 4, 2]
+
+        it = dataset.create_iterator()
+        ret = {obj["page_id"]: obj for obj in itertools.islice(it, 10)}
+        assert sorted(ret.keys()) == list(range(10))
+        for page_id, word_ids, entity_ids, entity_position_spans in items:
+            obj = ret[page_id]
+            assert obj["word_ids"].tolist() == word_ids
+            assert obj["entity_ids"].tolist() == entity_ids
+            assert [tuple(span) for span in obj["entity_position_spans"].tolist()] == entity_position_spans
+
+
+def test_convert_entity_position_spans():
+    entity_position_spans = np.array([[0, 1], [2, 5], [3, 3]])
+    entity_position_ids = np.array([[0, -1, -1], [2, 3, 4], [-1, -1, -1]])
+    assert (convert_entity_position_spans_to_ids(entity_position_spans, 3) == entity_position_ids).all()
+    assert convert_entity_position_ids_to_spans(entity_position_ids).tolist() == [[0, 1], [2, 5], [0, 0]]
+
+
+def test_numpy_dataset_skip_and_shard():
+    with tempfile.TemporaryDirectory() as output_dir:
+        _build_numpy_dataset(output_dir, 7, shard_size=3)
+        dataset = WikipediaPretrainingDataset(output_dir)
+
+        stream = [obj["page_id"] for obj in itertools.islice(dataset.create_iterator(shuffle_seed=1), 30)]
+        # every epoch visits each item exactly once
+        assert sorted(stream[:7]) == list(range(7))
+        assert sorted(stream[7:14]) == list(range(7))
+
+        resumed = [obj["page_id"] for obj in itertools.islice(dataset.create_iterator(skip=5, shuffle_seed=1), 25)]
+        assert resumed == stream[5:]
+
+        for worker_index in range(3):
+            it = dataset.create_iterator(skip=5, num_workers=3, worker_index=worker_index, shuffle_seed=1)
+            sharded = [obj["page_id"] for obj in itertools.islice(it, 8)]
+            assert sharded == stream[5 + worker_index :: 3][:8]
+
+
+def test_numpy_dataset_blockwise_shuffle():
+    with tempfile.TemporaryDirectory() as output_dir:
+        _build_numpy_dataset(output_dir, 11, shard_size=3)
+        dataset = WikipediaPretrainingDataset(output_dir)
+
+        it = dataset.create_iterator(shuffle_buffer_size=4, shuffle_seed=1)
+        stream = [obj["page_id"] for obj in itertools.islice(it, 33)]
+        for epoch in range(3):
+            epoch_stream = stream[epoch * 11 : (epoch + 1) * 11]
+            assert sorted(epoch_stream) == list(range(11))
+            # the items of each block are yielded consecutively
+            blocks = [page_id // 4 for page_id in epoch_stream]
+            assert sum(1 for n in range(1, 11) if blocks[n] != blocks[n - 1]) == 2
+        assert stream[:11] != stream[11:22]
+
+        it = dataset.create_iterator(skip=6, shuffle_buffer_size=4, shuffle_seed=1)
+        assert [obj["page_id"] for obj in itertools.islice(it, 27)] == stream[6:]
+
+
+def test_numpy_dataset_empty():
+    with tempfile.TemporaryDirectory() as output_dir:
+        _build_numpy_dataset(output_dir, 0, shard_size=3)
+        dataset = WikipediaPretrainingDataset(output_dir)
+        assert list(dataset.create_iterator()) == []
+
+
+def test_numpy_dataset_data_worker_windows():
+    with tempfile.TemporaryDirectory() as output_dir:
+        _build_numpy_dataset(output_dir, 7, shard_size=3)
+        dataset = WikipediaPretrainingDataset(output_dir)
+
+        for skip in (0, 5):
+            stream = [
+                obj["page_id"]
+                for obj in itertools.islice(dataset.create_iterator(skip=skip, num_workers=2, shuffle_seed=1), 24)
+            ]
+            iterators = [
+                dataset.create_iterator(
+                    skip=skip,
+                    num_workers=2,
+                    shuffle_seed=1,
+                    num_data_workers=3,
+                    data_worker_index=data_worker_index,
+                    window_size=2,
+                )
+                for data_worker_index in range(3)
+            ]
+            # the windows of the data workers are merged in the round-robin order as in LukePretrainingBatchGenerator
+            merged = [obj["page_id"] for n in range(12) for obj in itertools.islice(iterators[n % 3], 2)]
+            assert merged == stream
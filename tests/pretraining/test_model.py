@@ -0,0 +1,83 @@
+import torch
+import torch.nn.functional as F
+
+from luke.model import LukeConfig
+from luke.pretraining.model import LukePretrainingModel, chunked_cross_entropy
+
+
+def _create_model(**kwargs):
+    config = LukeConfig(
+        vocab_size=100,
+        entity_vocab_size=10,
+        bert_model_name="bert-base-uncased",
+        entity_emb_size=16,
+        hidden_size=32,
+        num_hidden_layers=1,
+        num_attention_heads=4,
+        intermediate_size=64,
+        max_position_embeddings=64,
+    )
+    return LukePretrainingModel(config, **kwargs)
+
+
+def _create_inputs():
+    return dict(
+        word_ids=torch.LongTensor([[1, 20, 21, 2], [1, 22, 2, 0]]),
+        word_segment_ids=torch.zeros(2, 4, dtype=torch.long),
+        word_attention_mask=torch.LongTensor([[1, 1, 1, 1], [1, 1, 1, 0]]),
+        entity_ids=torch.LongTensor([[2, 2], [2, 0]]),
+        entity_position_ids=torch.LongTensor([[[1, -1], [2, -1]], [[1, -1], [-1, -1]]]),
+        entity_segment_ids=torch.zeros(2, 2, dtype=torch.long),
+        entity_attention_mask=torch.LongTensor([[1, 1], [1, 0]]),
+        masked_entity_labels=torch.LongTensor([[5, 7], [5, -1]]),
+    )
+
+
+def test_in_batch_entity_loss():
+    entity_counts = torch.arange(10)
+    model = _create_model(entity_loss="in_batch", entity_counts=entity_counts)
+    model.eval()
+
+    hidden_states = torch.randn(3, 16)
+    labels = torch.LongTensor([5, 7, 5])
+    loss = model._compute_sampled_entity_loss(hidden_states, labels)
+
+    log_probs = entity_counts.float().clamp(min=1).log() - entity_counts.float().clamp(min=1).sum().log()
+    candidate_ids = torch.LongTensor([5, 7])
+    scores = hidden_states @ model.entity_predictions.decoder.weight[candidate_ids].t()
+    scores = scores + model.entity_predictions.bias[candidate_ids] - log_probs[candidate_ids]
+    assert torch.allclose(loss, F.cross_entropy(scores, torch.LongTensor([0, 1, 0])), atol=1e-5)
+
+
+def test_sampled_entity_loss():
+    model = _create_model(entity_loss="sampled", num_entity_negatives=4, entity_counts=torch.ones(10))
+    model.eval()
+    ret = model(**_create_inputs(), compute_masked_entity_accuracy=False)
+    assert torch.isfinite(ret["masked_entity_loss"])
+    assert ret["masked_entity_total"].item() == 0
+
+    ret = model(**_create_inputs())
+    ret["loss"].backward()
+    assert ret["masked_entity_total"].item() == 3
+    assert model.entity_embeddings.entity_embeddings.weight.grad is not None
+    assert "entity_sampling_probs" not in model.state_dict()
+
+
+def test_chunked_cross_entropy():
+    head = torch.nn.Linear(8, 20)
+    hidden_states = torch.randn(7, 8, requires_grad=True)
+    labels = torch.randint(20, (7,))
+
+    loss, correct = chunked_cross_entropy(head, hidden_states, labels, 3)
+    loss.backward()
+    grads = [hidden_states.grad, head.weight.grad]
+    hidden_states.grad = None
+    head.zero_grad()
+
+    scores = head(hidden_states)
+    target_loss = F.cross_entropy(scores, labels)
+    target_loss.backward()
+    assert torch.allclose(loss, target_loss, atol=1e-5)
+    assert correct.item() == (scores.argmax(1) == labels).sum().item()
+    assert torch.allclose(grads[0], hidden_states.grad, atol=1e-5)
+    assert torch.allclose(grads[1], head.weight.grad, atol=1e-5)
@@ -1,11 +1,18 @@
 import functools
+import math
 import operator
 import pytest
 
 import torch
 from transformers import AutoConfig, AutoModel
 
-from luke.model import EntityEmbeddings, LukeConfig, LukeModel
+from luke.model import (
+    EntityAwareSelfAttention,
+    EntityEmbeddings,
+    LukeConfig,
+    LukeEntityAwareAttentionModel,
+    LukeModel,
+)
 
 BERT_MODEL_NAME = "bert-base-uncased"
 
@@ -66,3 +73,198 @@ def test_load_bert_weights(bert_config):
 
     for key, tensor in bert_state_dict.items():
         assert torch.equal(luke_state_dict[key], tensor)
+
+
+def test_narrow_integer_inputs(bert_config):
+    bert_config.num_hidden_layers = 2
+    config = _create_luke_config(bert_config, 5, bert_config.hidden_size)
+    model = LukeModel(config)
+    model.eval()
+
+    inputs = dict(
+        word_ids=torch.LongTensor([[101, 2000, 2001, 102]]),
+        word_segment_ids=torch.LongTensor([[0, 0, 0, 0]]),
+        word_attention_mask=torch.LongTensor([[1, 1, 1, 1]]),
+        entity_ids=torch.LongTensor([[2, 0]]),
+        entity_position_ids=torch.LongTensor([[[1, 2, -1], [-1, -1, -1]]]),
+        entity_segment_ids=torch.LongTensor([[0, 0]]),
+        entity_attention_mask=torch.LongTensor([[1, 0]]),
+    )
+    narrow_inputs = {k: v.int() for k, v in inputs.items()}
+    narrow_inputs["word_segment_ids"] = inputs["word_segment_ids"].byte()
+    narrow_inputs["word_attention_mask"] = inputs["word_attention_mask"].byte()
+    narrow_inputs["entity_segment_ids"] = inputs["entity_segment_ids"].byte()
+    narrow_inputs["entity_attention_mask"] = inputs["entity_attention_mask"].byte()
+
+    with torch.no_grad():
+        for output, narrow_output in zip(model(**inputs), model(**narrow_inputs)):
+            assert torch.equal(output, narrow_output)
+
+
+def test_entity_embedding_with_position_spans(bert_config):
+    config = _create_luke_config(bert_config, 5, bert_config.hidden_size)
+    entity_embeddings = EntityEmbeddings(config)
+    entity_embeddings.eval()
+    entity_ids = torch.LongTensor([[2, 3, 4, 0]])
+    position_ids = torch.LongTensor([[[0, 1, -1], [3, -1, -1], [5, 6, 7], [-1, -1, -1]]])
+    position_spans = torch.LongTensor([[[0, 2], [3, 4], [5, 8], [0, 0]]])
+
+    emb = entity_embeddings(entity_ids, position_ids)
+    span_emb = entity_embeddings(entity_ids, position_spans=position_spans)
+    assert torch.allclose(emb, span_emb, atol=1e-5)
+
+
+def test_entity_aware_self_attention(bert_config):
+    bert_config.attention_probs_dropout_prob = 0.0
+    config = _create_luke_config(bert_config, 5, bert_config.hidden_size)
+    hidden_size = config.hidden_size
+    legacy_state_dict = {
+        f"{name}.{attr_name}": torch.randn(hidden_size, hidden_size)
+        if attr_name == "weight"
+        else torch.randn(hidden_size)
+        for name in ("query", "key", "value", "w2e_query", "e2w_query", "e2e_query")
+        for attr_name in ("weight", "bias")
+    }
+    attention = EntityAwareSelfAttention(config)
+    attention.load_state_dict(legacy_state_dict)
+
+    word_hidden_states = torch.randn(2, 5, hidden_size)
+    entity_hidden_states = torch.randn(2, 3, hidden_size)
+    attention_mask = torch.zeros(2, 1, 1, 8)
+    attention_mask[1, :, :, 4:] = -10000.0
+    hidden_states = torch.cat([word_hidden_states, entity_hidden_states], dim=1)
+    output = attention(hidden_states, 5, attention_mask)
+
+    def project(name, hidden_states):
+        output = torch.nn.functional.linear(
+            hidden_states, legacy_state_dict[name + ".weight"], legacy_state_dict[name + ".bias"]
+        )
+        return attention.transpose_for_scores(output)
+
+    key_layer = project("key", hidden_states)
+    word_key_layer, entity_key_layer = key_layer[:, :, :5], key_layer[:, :, 5:]
+    attention_scores = torch.cat(
+        [
+            torch.cat(
+                [
+                    project("query", word_hidden_states) @ word_key_layer.transpose(-1, -2),
+                    project("w2e_query", word_hidden_states) @ entity_key_layer.transpose(-1, -2),
+                ],
+                dim=3,
+            ),
+            torch.cat(
+                [
+                    project("e2w_query", entity_hidden_states) @ word_key_layer.transpose(-1, -2),
+                    project("e2e_query", entity_hidden_states) @ entity_key_layer.transpose(-1, -2),
+                ],
+                dim=3,
+            ),
+        ],
+        dim=2,
+    )
+    attention_probs = torch.softmax(attention_scores / math.sqrt(attention.attention_head_size) + attention_mask, -1)
+    context_layer = (attention_probs @ project("value", hidden_states)).permute(0, 2, 1, 3).reshape(2, 8, hidden_size)
+
+    assert torch.allclose(output, context_layer, atol=1e-4)
+
+
+def test_load_legacy_query_projections(bert_config):
+    bert_config.num_hidden_layers = 1
+    config = _create_luke_config(bert_config, 5, bert_config.hidden_size)
+    state_dict = LukeModel(config).state_dict()
+    model = LukeEntityAwareAttentionModel(config)
+    model.load_state_dict(state_dict)
+
+    query_weight = state_dict["encoder.layer.0.attention.self.query.weight"]
+    attention = model.encoder.layer[0].attention.self
+    assert torch.equal(attention.word_query.weight, torch.cat([query_weight, query_weight]))
+    assert torch.equal(attention.entity_query.weight, torch.cat([query_weight, query_weight]))
+
+    state_dict["encoder.layer.0.attention.self.unknown.weight"] = query_weight
+    with pytest.raises(RuntimeError):
+        model.load_state_dict(state_dict)
+
+
+@pytest.mark.skipif(
+    not hasattr(torch.nn.functional, "scaled_dot_product_attention"), reason="requires scaled_dot_product_attention"
+)
+@pytest.mark.parametrize("model_class", [LukeModel, LukeEntityAwareAttentionModel])
+def test_sdpa_attention_backend(bert_config, model_class, monkeypatch):
+    bert_config.num_hidden_layers = 2
+    bert_config.attention_probs_dropout_prob = 0.0
+    config = _create_luke_config(bert_config, 5, bert_config.hidden_size)
+    model = model_class(config)
+    model.eval()
+    config.attention_backend = "sdpa"
+    sdpa_model = model_class(config)
+    sdpa_model.load_state_dict(model.state_dict())
+    sdpa_model.eval()
+
+    inputs = dict(
+        word_ids=torch.LongTensor([[101, 2000, 2001, 102], [101, 2002, 102, 0]]),
+        word_segment_ids=torch.LongTensor([[0, 0, 0, 0], [0, 0, 0, 0]]),
+        word_attention_mask=torch.LongTensor([[1, 1, 1, 1], [1, 1, 1, 0]]),
+        entity_ids=torch.LongTensor([[2, 0], [3, 4]]),
+        entity_position_ids=torch.LongTensor([[[1, 2, -1], [-1, -1, -1]], [[1, -1, -1], [2, -1, -1]]]),
+        entity_segment_ids=torch.LongTensor([[0, 0], [0, 0]]),
+        entity_attention_mask=torch.LongTensor([[1, 0], [1, 1]]),
+    )
+    scaled_dot_product_attention = torch.nn.functional.scaled_dot_product_attention
+    num_calls = [0]
+
+    def count_scaled_dot_product_attention(*args, **kwargs):
+        num_calls[0] += 1
+        return scaled_dot_product_attention(*args, **kwargs)
+
+    monkeypatch.setattr(torch.nn.functional, "scaled_dot_product_attention", count_scaled_dot_product_attention)
+    with torch.no_grad():
+        for output, sdpa_output in zip(model(**inputs), sdpa_model(**inputs)):
+            assert torch.allclose(output, sdpa_output, atol=1e-5)
+    assert num_calls[0] > 0
+
+    model.train()
+    sdpa_model.train()
+    gradients = []
+    for target_model in (model, sdpa_model):
+        target_model.zero_grad()
+        outputs = target_model(**inputs)
+        sum(output.sum() for output in outputs[:2]).backward()
+        parameters = target_model.named_parameters()
+        gradients.append({name: param.grad for name, param in parameters if param.grad is not None})
+    assert gradients[0].keys() == gradients[1].keys()
+    for name, gradient in gradients[0].items():
+        assert torch.allclose(gradient, gradients[1][name], atol=1e-4)
+
+
+@pytest.mark.parametrize("model_class", [LukeModel, LukeEntityAwareAttentionModel])
+@pytest.mark.parametrize("policy,interval", [("full", 1), ("attention", 1), ("full", 2)])
+def test_gradient_checkpointing(bert_config, model_class, policy, interval):
+    bert_config.num_hidden_layers = 2
+    config = _create_luke_config(bert_config, 5, bert_config.hidden_size)
+    model = model_class(config)
+    model.train()
+
+    inputs = dict(
+        word_ids=torch.LongTensor([[101, 2000, 2001, 102]]),
+        word_segment_ids=torch.LongTensor([[0, 0, 0, 0]]),
+        word_attention_mask=torch.LongTensor([[1, 1, 1, 1]]),
+        entity_ids=torch.LongTensor([[2, 0]]),
+        entity_position_ids=torch.LongTensor([[[1, 2, -1], [-1, -1, -1]]]),
+        entity_segment_ids=torch.LongTensor([[0, 0]]),
+        entity_attention_mask=torch.LongTensor([[1, 0]]),
+    )
+
+    def compute_gradients():
+        model.zero_grad()
+        torch.manual_seed(0)
+        outputs = model(**inputs)
+        sum(output.sum() for output in outputs[:2]).backward()
+        return {name: param.grad.clone() for name, param in model.named_parameters() if param.grad is not None}
+
+    gradients = compute_gradients()
+    model.set_gradient_checkpointing(policy, interval)
+    checkpointed_gradients = compute_gradients()
+
+    assert gradients.keys() == checkpointed_gradients.keys()
+    for name, gradient in gradients.items():
+        assert torch.allclose(gradient, checkpointed_gradients[name], atol=1e-5)
@@ -0,0 +1,16 @@
+import torch
+
+from luke.utils.mixed_precision import autocast, create_grad_scaler
+
+
+def test_disabled_mixed_precision():
+    device = torch.device("cpu")
+    assert create_grad_scaler(device, False) is None
+    with autocast(device, None):
+        assert torch.matmul(torch.ones(2, 2), torch.ones(2, 2)).dtype == torch.float32
+
+
+def test_bfloat16_autocast():
+    device = torch.device("cpu")
+    with autocast(device, torch.bfloat16):
+        assert torch.matmul(torch.ones(2, 2), torch.ones(2, 2)).dtype == torch.bfloat16
@@ -0,0 +1,186 @@
+import json
+import os
+import shutil
+import tempfile
+
+import pytest
+import torch
+from click.testing import CliRunner
+from transformers import BertTokenizer
+
+from luke.model import LukeConfig, LukeEntityAwareAttentionModel, LukeModel
+from luke.utils import model_utils
+from luke.utils.model_utils import (
+    EXPORT_INPUT_NAMES,
+    LukeForEntityClassification,
+    ModelArchive,
+    clear_model_cache,
+    create_example_inputs,
+    create_export_model,
+    create_model_archive,
+    export_model,
+)
+
+ENTITY_VOCAB_FIXTURE_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "../fixtures/enwiki_20181220_entvocab_100.tsv"
+)
+
+
+MODEL_CONFIG = dict(
+    vocab_size=100,
+    entity_vocab_size=5,
+    bert_model_name="bert-base-uncased",
+    hidden_size=32,
+    num_hidden_layers=2,
+    num_attention_heads=4,
+    intermediate_size=64,
+    max_position_embeddings=64,
+)
+
+
+def _create_model(model_class):
+    config = LukeConfig(**MODEL_CONFIG)
+    model = model_class(config)
+    model.eval()
+    return model
+
+
+def _create_test_inputs():
+    inputs = create_example_inputs(3, word_length=5, entity_length=3, batch_size=2)
+    inputs[0][:, 1:] = torch.randint(100, (2, 4))
+    inputs[2][1, 3:] = 0
+    inputs[6][1, 2:] = 0
+    return inputs
+
+
+@pytest.mark.parametrize("model_class", [LukeModel, LukeEntityAwareAttentionModel])
+def test_export_model_torchscript(model_class):
+    model = _create_model(model_class)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        out_file = os.path.join(temp_dir, "model.pt")
+        export_model(model, out_file, "torchscript", create_example_inputs(3))
+        traced_model = torch.jit.load(out_file)
+
+    inputs = _create_test_inputs()
+    with torch.no_grad():
+        for output, traced_output in zip(model(*inputs), traced_model(*inputs)):
+            assert torch.allclose(output, traced_output, atol=1e-5)
+
+
+def test_export_model_onnx():
+    onnxruntime = pytest.importorskip("onnxruntime")
+    model = _create_model(LukeEntityAwareAttentionModel)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        out_file = os.path.join(temp_dir, "model.onnx")
+        export_model(model, out_file, "onnx", create_example_inputs(3))
+        session = onnxruntime.InferenceSession(out_file)
+
+    inputs = _create_test_inputs()
+    onnx_outputs = session.run(None, {name: tensor.numpy() for name, tensor in zip(EXPORT_INPUT_NAMES, inputs)})
+    with torch.no_grad():
+        for output, onnx_output in zip(model(*inputs), onnx_outputs):
+            assert torch.allclose(output, torch.from_numpy(onnx_output), atol=1e-4)
+
+
+def test_create_export_model():
+    state_dict = _create_model(LukeModel).state_dict()
+    state_dict["entity_predictions.bias"] = torch.zeros(5)
+    model_archive = ModelArchive(state_dict, dict(model_config=MODEL_CONFIG), None)
+    model = create_export_model(model_archive)
+    assert torch.equal(model.embeddings.word_embeddings.weight, state_dict["embeddings.word_embeddings.weight"])
+
+    state_dict["unknown.weight"] = torch.zeros(5)
+    with pytest.raises(RuntimeError):
+        create_export_model(model_archive)
+
+
+def test_create_export_model_with_task_head():
+    task_model = LukeForEntityClassification(
+        LukeConfig(**dict(MODEL_CONFIG, entity_vocab_size=2)), 3, "classifier", 2, bias=False
+    )
+    task_model.eval()
+    model_archive = ModelArchive(None, dict(model_config=MODEL_CONFIG), None)
+    model = create_export_model(
+        model_archive, task_head="relation-classification", task_state_dict=task_model.state_dict()
+    )
+    model.eval()
+    assert model_archive.config.entity_vocab_size == 5
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        out_file = os.path.join(temp_dir, "model.pt")
+        export_model(model, out_file, "torchscript", create_example_inputs(3))
+        traced_model = torch.jit.load(out_file)
+
+    inputs = _create_test_inputs()
+    inputs[3][:] = 1
+    with torch.no_grad():
+        logits = traced_model(*inputs)
+        assert logits.size() == (2, 3)
+        assert torch.allclose(logits, task_model(*inputs), atol=1e-5)
+
+
+def test_load_model_archive(tmpdir, monkeypatch):
+    monkeypatch.setenv("LUKE_CACHE_DIR", str(tmpdir.join("cache")))
+    model_dir = tmpdir.mkdir("model")
+    state_dict = {"weight": torch.randn(3, 4)}
+    torch.save(state_dict, str(model_dir.join("model.bin")))
+    shutil.copy(ENTITY_VOCAB_FIXTURE_FILE, str(model_dir.join("entity_vocab.tsv")))
+    metadata = dict(model_config=dict(bert_model_name="bert-base-uncased"), max_mention_length=30, arguments={})
+    with open(str(model_dir.join("metadata.json")), "w") as f:
+        json.dump(metadata, f)
+
+    archive_file = str(tmpdir.join("model.tar"))
+    result = CliRunner().invoke(create_model_archive, [str(model_dir.join("model.bin")), archive_file])
+    assert result.exit_code == 0
+
+    model_archive = ModelArchive.load(archive_file)
+    assert model_archive.max_mention_length == 30
+    assert torch.equal(model_archive.state_dict["weight"], state_dict["weight"])
+    assert model_archive.state_dict is model_archive.state_dict
+    assert len(model_archive.entity_vocab) == 103
+    assert len(os.listdir(str(tmpdir.join("cache")))) == 1
+
+    ModelArchive.load(archive_file)
+    assert len(os.listdir(str(tmpdir.join("cache")))) == 1
+
+
+def test_copy_config_and_tokenizer_and_clear_model_cache(tmpdir, monkeypatch):
+    monkeypatch.setenv("LUKE_CACHE_DIR", str(tmpdir.join("cache")))
+    model_dir = tmpdir.mkdir("model")
+    torch.save({}, str(model_dir.join("model.bin")))
+    shutil.copy(ENTITY_VOCAB_FIXTURE_FILE, str(model_dir.join("entity_vocab.tsv")))
+    with open(str(model_dir.join("metadata.json")), "w") as f:
+        json.dump(dict(model_config=MODEL_CONFIG, max_mention_length=30, arguments={}), f)
+    archive_file = str(tmpdir.join("model.tar"))
+    assert CliRunner().invoke(create_model_archive, [str(model_dir.join("model.bin")), archive_file]).exit_code == 0
+
+    vocab_file = str(tmpdir.join("vocab.txt"))
+    with open(vocab_file, "w") as f:
+        f.write("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", "hello"]))
+    tokenizer_names = []
+
+    def create_tokenizer(bert_model_name):
+        tokenizer_names.append(bert_model_name)
+        return BertTokenizer(vocab_file)
+
+    monkeypatch.setattr(model_utils, "_tokenizer_cache", {})
+    monkeypatch.setattr(model_utils.AutoTokenizer, "from_pretrained", create_tokenizer)
+
+    model_archive = ModelArchive.load(archive_file)
+    assert model_archive.config is model_archive.config
+    model_archive.config.vocab_size += 2
+    model_archive.config.entity_vocab_size = 3
+    model_archive.tokenizer.add_special_tokens(dict(additional_special_tokens=["[ENT]"]))
+
+    model_archive = ModelArchive.load(archive_file)
+    assert model_archive.config.vocab_size == MODEL_CONFIG["vocab_size"]
+    assert model_archive.config.entity_vocab_size == MODEL_CONFIG["entity_vocab_size"]
+    assert model_archive.metadata["model_config"] == MODEL_CONFIG
+    assert len(model_archive.tokenizer) == 6
+    assert tokenizer_names == [MODEL_CONFIG["bert_model_name"]]
+
+    assert len(os.listdir(str(tmpdir.join("cache")))) == 1
+    assert CliRunner().invoke(clear_model_cache, []).exit_code == 0
+    assert len(os.listdir(str(tmpdir.join("cache")))) == 0
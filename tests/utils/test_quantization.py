@@ -0,0 +1,70 @@
+import json
+import shutil
+
+import torch
+from click.testing import CliRunner
+
+from luke.model import LukeConfig, LukeEntityAwareAttentionModel
+from luke.utils.model_utils import create_example_inputs, create_model_archive
+from luke.utils.quantization import quantize_model, quantize_model_file
+
+from .test_model_utils import ENTITY_VOCAB_FIXTURE_FILE
+
+MODEL_CONFIG = dict(
+    vocab_size=100,
+    entity_vocab_size=5,
+    bert_model_name="bert-base-uncased",
+    hidden_size=32,
+    num_hidden_layers=2,
+    num_attention_heads=4,
+    intermediate_size=64,
+    max_position_embeddings=64,
+)
+
+
+def test_quantize_model():
+    config = LukeConfig(**MODEL_CONFIG)
+    model = LukeEntityAwareAttentionModel(config)
+    model.eval()
+    quantized_model = quantize_model(model)
+
+    self_attention = quantized_model.encoder.layer[0].attention.self
+    for name in ("word_query", "entity_query", "key", "value"):
+        assert isinstance(getattr(self_attention, name), torch.nn.quantized.dynamic.Linear)
+    assert isinstance(model.encoder.layer[0].attention.self.key, torch.nn.Linear)
+
+    inputs = dict(
+        word_ids=torch.LongTensor([[1, 20, 21, 2]]),
+        word_segment_ids=torch.LongTensor([[0, 0, 0, 0]]),
+        word_attention_mask=torch.LongTensor([[1, 1, 1, 1]]),
+        entity_ids=torch.LongTensor([[2, 0]]),
+        entity_position_ids=torch.LongTensor([[[1, 2, -1], [-1, -1, -1]]]),
+        entity_segment_ids=torch.LongTensor([[0, 0]]),
+        entity_attention_mask=torch.LongTensor([[1, 0]]),
+    )
+    with torch.no_grad():
+        for output, quantized_output in zip(model(**inputs), quantized_model(**inputs)):
+            assert torch.allclose(output, quantized_output, atol=0.1)
+
+
+def test_quantize_model_file(tmpdir, monkeypatch):
+    monkeypatch.setenv("LUKE_CACHE_DIR", str(tmpdir.join("cache")))
+    model = LukeEntityAwareAttentionModel(LukeConfig(**MODEL_CONFIG))
+    model.eval()
+    model_dir = tmpdir.mkdir("model")
+    torch.save(model.state_dict(), str(model_dir.join("model.bin")))
+    shutil.copy(ENTITY_VOCAB_FIXTURE_FILE, str(model_dir.join("entity_vocab.tsv")))
+    with open(str(model_dir.join("metadata.json")), "w") as f:
+        json.dump(dict(model_config=MODEL_CONFIG, max_mention_length=3, arguments={}), f)
+    archive_file = str(tmpdir.join("model.tar"))
+    assert CliRunner().invoke(create_model_archive, [str(model_dir.join("model.bin")), archive_file]).exit_code == 0
+
+    out_file = str(tmpdir.join("quantized_model.pt"))
+    result = CliRunner().invoke(quantize_model_file, [archive_file, out_file])
+    assert result.exit_code == 0, result.output
+    quantized_model = torch.jit.load(out_file)
+
+    inputs = create_example_inputs(3, batch_size=2)
+    with torch.no_grad():
+        for output, quantized_output in zip(model(*inputs), quantized_model(*inputs)):
+            assert torch.allclose(output, quantized_output, atol=0.1)